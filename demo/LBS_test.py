@@ -1,34 +1,260 @@
+import argparse
 import asyncio
+import os
+import random
+import sys
+import time
 from bleak import BleakClient, BleakScanner
 
-# UUIDs for the LED and Button characteristics (blefund_less4_exer2)
+from lbs_monitor import LBSMonitor
+from lbs_session import LBSPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project"))
+import device_cache  # project/device_cache.py
+import simulator  # project/simulator.py
+
+# UUIDs for the LED Button Service and its LED and Button characteristics (blefund_less4_exer2)
+LBS_SERVICE_UUID = "00001523-1212-efde-1523-785feabcd123"
 LBS_LED_UUID = "00001525-1212-efde-1523-785feabcd123"
 LBS_BUTTON_UUID = "00001524-1212-efde-1523-785feabcd123"
 
-# Function to write to the LED characteristic
-async def write_led(address, state):
-    async with BleakClient(address) as client:
+# Function to write to the LED characteristic, connects for this single write
+async def write_led(address, state, client_class=BleakClient):
+    async with client_class(address) as client:
         await client.write_gatt_char(LBS_LED_UUID, bytearray([state]))
-        print(f"LED state set to {state}")
 
-# Function to read the Button characteristic
-async def read_button(address):
-    async with BleakClient(address) as client:
+# Function to read the Button characteristic, connects for this single read
+async def read_button(address, client_class=BleakClient):
+    async with client_class(address) as client:
         button_state = await client.read_gatt_char(LBS_BUTTON_UUID)
-        print(f"Button state: {int(button_state[0])}")
+        return int(button_state[0])
 
-# Main function to scan for devices and perform read/write operations
-async def main():
-    devices = await BleakScanner.discover()
+# Function to scan for devices and let the user choose one, returns the address and the scan time
+async def choose_device(scanner=BleakScanner):
+    start = time.perf_counter()
+    devices = await scanner.discover()
+    scan_time = time.perf_counter() - start
     for device in devices:
         print(device)
 
-    address = input("Enter the address of the device you want to connect to: ")
-    
+    return input("Enter the address of the device you want to connect to: "), scan_time
+
+# Function comparing a connection per operation with pooled connections
+async def benchmark(address, count, client_class=BleakClient):
+    start = time.perf_counter()
+    for i in range(count):
+        await write_led(address, i & 1, client_class)
+        await read_button(address, client_class)
+    per_call = 2 * count / (time.perf_counter() - start)
+    print(f"connection per operation: {per_call:8.1f} ops/s")
+
+    async with LBSPool(client_class) as pool:
+        start = time.perf_counter()
+        for i in range(count):
+            await pool.write_led(address, i & 1)
+            await pool.read_button(address)
+        pooled = 2 * count / (time.perf_counter() - start)
+        print(f"pooled connection:        {pooled:8.1f} ops/s ({pooled / per_call:.1f}x)")
+
+        start = time.perf_counter()
+        await pool.session(address).run([op for i in range(count) for op in (('led', i & 1), ('button',))])
+        batched = 2 * count / (time.perf_counter() - start)
+        print(f"pooled, batched:          {batched:8.1f} ops/s ({batched / per_call:.1f}x)")
+
+# Function to scan for every device with the LBS
+async def find_lbs_devices(scanner=BleakScanner, timeout=5.0):
+    found = await scanner.discover(timeout, return_adv=True)
+    return [device.address for device, adv in found.values() if LBS_SERVICE_UUID in adv.service_uuids]
+
+# Function mirroring the button of every device onto its LED until interrupted
+async def monitor(addresses, client_class=BleakClient):
+    async with LBSMonitor(LBSPool(client_class)) as lbs:
+        for address, error in (await lbs.add(addresses)).items():
+            print(f"Could not subscribe to {address}: {error}")
+        print(f"Monitoring {len(lbs.leds)} devices, press Ctrl+C to stop")
+        async for event in lbs:
+            print(f"{event.address}: button {event.state}")
+            lbs.set_led(event.address, event.state)
+
+# Function generating button changes of a simulated user, returns [(seconds, device index, state)] in time order
+def press_schedule(devices, duration, rate, seed=0):
+    rng = random.Random(seed)
+    schedule = []
+    for index in range(devices):
+        at, state = rng.expovariate(rate), 1
+        while at < duration:
+            schedule.append((at, index, state))
+            at, state = at + rng.expovariate(rate), state ^ 1
+    return sorted(schedule)
+
+# Function pressing the buttons of the simulated devices, the press times are appended to presses.
+# The first device loses its link after drop_at seconds if given.
+async def press_buttons(devices, schedule, presses, drop_at=None):
+    start = time.perf_counter()
+    if drop_at is not None:
+        asyncio.get_running_loop().call_later(drop_at, devices[0].drop_connection)
+    for at, index, state in schedule:
+        await asyncio.sleep(max(0.0, start + at - time.perf_counter()))
+        device = devices[index]
+        device.send(device.peripheral.set_button(state))
+        presses[device.address].append((time.perf_counter(), state))
+
+# Function matching the button changes seen to the presses, returns the latencies and the number of missed presses
+def match_presses(presses, seen):
+    latencies, missed = [], 0
+    for address, pressed in presses.items():
+        first = after = 0  # First unmatched press, first press after the change was seen
+        for seen_at, state in seen[address]:
+            while after < len(pressed) and pressed[after][0] <= seen_at:
+                after += 1
+            match = after - 1  # The newest press before the change was seen
+            while match >= first and pressed[match][1] != state:
+                match -= 1
+            if match >= first:
+                latencies.append(seen_at - pressed[match][0])
+                missed += match - first  # Changed and changed back between two reads
+                first = match + 1
+        missed += len(pressed) - first
+    return latencies, missed
+
+# Function polling the button and writing the LED of one device with one GATT operation per call
+async def poll(pool, address, stop, seen, counts):
+    last = 0
+    while not stop.is_set():
+        state = await pool.read_button(address)
+        if state != last:
+            seen[address].append((time.perf_counter(), state))
+            last = state
+        await pool.write_led(address, state)
+        counts['operations'] += 2
+
+# Function receiving the button notifications of all devices, the LED follows the button through the LED queue
+async def watch(lbs, seen):
+    async for event in lbs:
+        seen[event.address].append((event.timestamp, event.state))
+        lbs.set_led(event.address, event.state)
+
+# Function comparing polling with read/write per call against button notifications and coalesced LED writes
+async def compare(devices, duration, rate, client_class):
+    addresses = [device.address for device in devices]
+    schedule = press_schedule(len(devices), duration, rate)
+    print(f"{len(devices)} devices, {len(schedule)} button changes in {duration:.1f} s, "
+          f"{devices[0].address} loses its link after {duration / 2:.1f} s")
+    print(f"{'':32} {'GATT ops/s':>10} {'missed':>7} {'p50 ms':>7} {'p99 ms':>7} {'max ms':>7} {'LED writes':>10}")
+
+    def report(name, operations, presses, seen, led_writes):
+        latencies, missed = match_presses(presses, seen)
+        latencies.sort()
+        p50, p99, worst = (latencies[int(q * (len(latencies) - 1))] * 1000 if latencies else 0.0
+                           for q in (0.5, 0.99, 1.0))
+        print(f"{name:32} {operations / duration:10.1f} {missed:7} {p50:7.1f} {p99:7.1f} {worst:7.1f} {led_writes:10}")
+
+    for mode in ("polling, read/write per call", "notifications, coalesced LED"):
+        for device in devices:
+            device.peripheral.set_button(0)
+        presses = {address: [] for address in addresses}
+        seen = {address: [] for address in addresses}
+        pool = LBSPool(client_class)
+        if mode.startswith("polling"):
+            await asyncio.gather(*(pool.session(address).connect() for address in addresses))
+            stop, counts = asyncio.Event(), {'operations': 0}
+            pollers = [asyncio.create_task(poll(pool, address, stop, seen, counts)) for address in addresses]
+            await press_buttons(devices, schedule, presses, duration / 2)
+            stop.set()
+            await asyncio.gather(*pollers)
+            reconnects = sum(session.connects - 1 for session in pool.sessions.values())
+            await pool.close()
+            report(mode, counts['operations'], presses, seen, counts['operations'] // 2)
+            print(f"{reconnects} reconnects")
+        else:
+            async with LBSMonitor(pool) as lbs:
+                await lbs.add(addresses)
+                watcher = asyncio.create_task(watch(lbs, seen))
+                await press_buttons(devices, schedule, presses, duration / 2)
+                await asyncio.sleep(0.1)  # The last notifications
+                await lbs.flush()
+                stats = lbs.stats()
+            await watcher
+            report(mode, stats['notifications'] + stats['led_writes'], presses, seen, stats['led_writes'])
+            in_sync = sum(device.peripheral.led == device.peripheral.button for device in devices)
+            print(f"{stats['reconnects']} reconnects, LED requests {stats['led_requests']}, "
+                  f"written {stats['led_writes']}, {in_sync} of {len(devices)} LEDs show their button")
+
+# Main function to find the device and perform read/write operations
+async def main(args):
+    scanner, client_class = BleakScanner, BleakClient
+    cache = device_cache.DeviceCache()
+    if args.simulate:
+        for _ in range(args.sim_devices):
+            simulator.add_device(simulator.LedButtonPeripheral(), connect_time=args.sim_connect_time)
+        scanner, client_class = simulator.SimulatedScanner, simulator.SimulatedClient
+        cache = device_cache.DeviceCache(device_cache.default_path("simulated"))
+
+    if args.compare:
+        await compare(simulator.devices, args.compare, args.press_rate, client_class)
+        return
+
+    if args.monitor:
+        addresses = await find_lbs_devices(scanner)
+        if not addresses:
+            print("No device with the LED Button Service found.")
+            return
+        await monitor(addresses, client_class)  # Until Ctrl+C
+        return
+
+    # The last used device is tried first, scanning is only needed when it cannot be reached
+    cached = cache.candidates(LBS_SERVICE_UUID)
+    address = cached[0]["address"] if cached else None
+    if address:
+        print(f"Using cached device {address}")
+
+    if args.benchmark:
+        if not address:
+            address, _ = await choose_device(scanner)
+        await benchmark(address, args.benchmark, client_class)
+        cache.remember(LBS_SERVICE_UUID, address)
+        return
+
     state = int(input("Enter LED state (0 or 1): "))
-    await write_led(address, state)
-    
-    await read_button(address)
+
+    start = time.perf_counter()
+    if address:
+        try:
+            await write_led(address, state, client_class)
+            print(f"Startup: {time.perf_counter() - start:.2f} s (cache hit)")
+        except Exception as error:
+            print(f"Could not connect to cached device {address}: {error}")
+            cache.failed(LBS_SERVICE_UUID, address)
+            address = None
+
+    if not address:
+        address, scan_time = await choose_device(scanner)
+        start = time.perf_counter()
+        await write_led(address, state, client_class)
+        print(f"Startup: {scan_time + time.perf_counter() - start:.2f} s (cache miss, scanned)")
+    cache.remember(LBS_SERVICE_UUID, address)
+    print(f"LED state set to {state}")
+
+    print(f"Button state: {await read_button(address, client_class)}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", type=int, metavar="<n>",
+                        help="compare n LED writes and button reads per connection against pooled connections")
+    parser.add_argument("--monitor", action="store_true",
+                        help="follow the buttons of all LBS devices in range by notifications, the LEDs mirror them")
+    parser.add_argument("--compare", type=float, metavar="<s>",
+                        help="compare polling with button notifications for s seconds (needs --simulate)")
+    parser.add_argument("--press-rate", type=float, default=5.0, metavar="<n>",
+                        help="button changes per second and device of --compare")
+    parser.add_argument("--simulate", action="store_true", help="use a local simulated LBS device")
+    parser.add_argument("--sim-devices", type=int, default=1, metavar="<n>", help="number of simulated LBS devices")
+    parser.add_argument("--sim-connect-time", type=float, default=0.5, metavar="<s>",
+                        help="time to connect and discover services of the simulated device")
+    args = parser.parse_args()
+    if args.compare and not args.simulate:
+        parser.error("--compare presses the buttons of simulated devices, use it with --simulate")
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -6,28 +6,64 @@ Example showing how to scan for BLE devices.
 
 Updated on 2019-03-25 by hbldh <henrik.blidh@nedomkull.com>
 
+Devices are printed as their advertisements arrive (project/discovery.py),
+the scan stops early once --count devices (with --min-rssi) were found.
+
 """
 
 import argparse
 import asyncio
+import os
+import sys
+import time
 
 from bleak import BleakScanner
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project"))
+import discovery  # project/discovery.py
+import simulator  # project/simulator.py
+
 
 async def main(args: argparse.Namespace):
-    print("scanning for 5 seconds, please wait...")
+    scanner = BleakScanner
+    if args.simulate:
+        for _ in range(args.simulate):
+            simulator.add_device(rssi=-40 - len(simulator.devices) % 60)
+        scanner = simulator.SimulatedScanner
+
+    print(f"scanning for up to {args.timeout} seconds, please wait...")
+    start = time.perf_counter()
+    first = None
 
-    devices = await BleakScanner.discover(
-        return_adv=True,
+    def on_change(entry, changes):
+        nonlocal first
+        if "new" in changes:
+            if first is None and discovery.matches(entry, min_rssi=args.min_rssi):
+                first = time.perf_counter() - start
+            print()
+            print(entry.device)
+            print("-" * len(str(entry.device)))
+            print(entry.adv)
+        elif args.updates:
+            print(f"{entry.address}: {', '.join(changes)} -> rssi={entry.rssi} services={sorted(entry.service_uuids)}")
+
+    predicate = None
+    if args.count:
+        predicate = discovery.until_found(args.count, min_rssi=args.min_rssi)
+
+    index = await discovery.discover(
+        predicate,
+        scanner,
+        args.timeout,
+        on_change,
         service_uuids=args.services,
         cb=dict(use_bdaddr=args.macos_use_bdaddr),
     )
 
-    for d, a in devices.values():
-        print()
-        print(d)
-        print("-" * len(str(d)))
-        print(a)
+    elapsed = time.perf_counter() - start
+    print()
+    print(f"{len(index)} devices ({index.advertisements} advertisements) in {elapsed:.2f} s", end="")
+    print(f", first match after {first * 1000:.0f} ms" if first is not None else "")
 
 
 if __name__ == "__main__":
@@ -46,6 +82,40 @@ if __name__ == "__main__":
         help="when true use Bluetooth address instead of UUID on macOS",
     )
 
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=5.0,
+        help="maximum scan duration in seconds",
+    )
+
+    parser.add_argument(
+        "--count",
+        type=int,
+        metavar="<n>",
+        help="stop scanning as soon as this many devices were found",
+    )
+
+    parser.add_argument(
+        "--min-rssi",
+        type=int,
+        metavar="<dBm>",
+        help="only count devices with at least this RSSI",
+    )
+
+    parser.add_argument(
+        "--updates",
+        action="store_true",
+        help="also print RSSI, name and service changes of known devices",
+    )
+
+    parser.add_argument(
+        "--simulate",
+        type=int,
+        metavar="<n>",
+        help="scan <n> local simulated devices instead of real ones",
+    )
+
     args = parser.parse_args()
 
-    asyncio.run(main(args))
\ No newline at end of file
+    asyncio.run(main(args))
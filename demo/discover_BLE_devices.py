@@ -1,11 +1,16 @@
-# Discover Bluetooth devices
+# Discover Bluetooth devices, printed as soon as their first advertisement arrives
 
 import asyncio
+import os
+import sys
 from bleak import BleakScanner
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project"))
+import discovery  # project/discovery.py
+
 async def main():
-    devices = await BleakScanner.discover()
-    for d in devices:
-        print(d)
+    async for entry, changes in discovery.stream(BleakScanner, timeout=5.0):
+        if "new" in changes:
+            print(entry.device)
 
-asyncio.run(main())
\ No newline at end of file
+asyncio.run(main())
@@ -0,0 +1,143 @@
+"""
+LBS Monitor
+-------------
+
+Event-driven monitoring of many LED Button Service (LBS) devices.
+
+Instead of reading the button characteristic of every device in turn, the
+monitor subscribes to the button notifications of all devices concurrently
+and merges them into one async stream of ButtonEvents. The radio is only used
+when a button actually changes, and a change is seen in the next connection
+event instead of after the next poll.
+
+LED commands go through one LedQueue per device: while a write is on air only
+the newest requested state is kept, and it is not written at all if the LED
+already shows it, so a burst of commands costs at most one more write.
+
+A link lost while monitoring is reconnected and subscribed again by its
+LBSSession, a button change missed meanwhile is reported once it is back.
+
+"""
+
+import asyncio
+import time
+from collections import namedtuple
+
+from lbs_session import LBSPool
+
+ButtonEvent = namedtuple('ButtonEvent', 'address state timestamp')  # timestamp: time.perf_counter() on reception
+
+
+class LedQueue:
+    """LED commands of one device, redundant state changes are coalesced before writing."""
+
+    def __init__(self, session):
+        self.session = session
+        self.state = None  # Newest requested state
+        self.written = None  # State the LED was last set to
+        self.requested = 0
+        self.writes = 0
+        self.errors = 0
+        self._changed = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def set(self, state):
+        self.requested += 1
+        self.state = state
+        self._idle.clear()
+        self._changed.set()  # Compared with the LED state by _run(), a write may be on air now
+
+    async def flush(self):
+        """Wait until the newest requested state is written (or its write failed)."""
+        await self._idle.wait()
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            state = self.state
+            if state != self.written:
+                try:
+                    await self.session.write_led(state)
+                    self.written = state
+                    self.writes += 1
+                except Exception:
+                    self.errors += 1  # Dropped, the next set() tries again
+            if not self._changed.is_set():  # Nothing newer was requested meanwhile
+                self._idle.set()
+
+    async def close(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+class LBSMonitor:
+    """
+    Button notifications of many LBS devices as one async event stream, use with "async for".
+    LED writes go through a coalescing LedQueue per device.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool or LBSPool()
+        self.leds = {}  # Address -> LedQueue
+        self.buttons = {}  # Address -> last notified button state
+        self.events = asyncio.Queue()
+        self.received = 0
+
+    async def add(self, addresses):
+        """
+        Connect to and subscribe to the buttons of all *addresses* concurrently,
+        returns {address: error} of the failures.
+        """
+        results = await asyncio.gather(*(self._add(address) for address in addresses), return_exceptions=True)
+        return {address: result for address, result in zip(addresses, results) if isinstance(result, Exception)}
+
+    async def _add(self, address):
+        session = self.pool.session(address)
+        await session.subscribe_button(lambda state: self._on_button(address, state))
+        self.leds[address] = LedQueue(session)
+
+    def _on_button(self, address, state):
+        self.received += 1
+        self.buttons[address] = state
+        self.events.put_nowait(ButtonEvent(address, state, time.perf_counter()))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.events.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    def set_led(self, address, state):
+        self.leds[address].set(state)
+
+    async def flush(self):
+        """Wait until every LED shows its newest requested state."""
+        await asyncio.gather(*(queue.flush() for queue in self.leds.values()))
+
+    def stats(self):
+        return dict(devices=len(self.leds), notifications=self.received,
+                    led_requests=sum(queue.requested for queue in self.leds.values()),
+                    led_writes=sum(queue.writes for queue in self.leds.values()),
+                    led_errors=sum(queue.errors for queue in self.leds.values()),
+                    reconnects=sum(max(0, queue.session.connects - 1) for queue in self.leds.values()))
+
+    async def close(self):
+        """End the event stream, stop the LED queues and disconnect."""
+        self.events.put_nowait(None)
+        await asyncio.gather(*(queue.close() for queue in self.leds.values()))
+        await self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
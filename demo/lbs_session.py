@@ -0,0 +1,155 @@
+"""
+LBS Sessions
+-------------
+
+Keeps connections to LED Button Service (LBS) devices open and reuses them,
+instead of connecting and discovering services for every single GATT operation.
+
+"""
+
+import asyncio
+
+from bleak import BleakClient
+from bleak.exc import BleakError
+
+LBS_LED_UUID = "00001525-1212-efde-1523-785feabcd123"
+LBS_BUTTON_UUID = "00001524-1212-efde-1523-785feabcd123"
+
+
+class LBSSession:
+    """
+    One reusable connection to an LBS device, reconnected on demand. While the button is
+    subscribed a lost link is reconnected right away, see subscribe_button().
+    """
+
+    def __init__(self, address, client_class=BleakClient, retries=1):
+        self.address = address
+        self.client_class = client_class
+        self.retries = retries  # Reconnect attempts when an operation fails on a dead link
+        self.client = None
+        self.connects = 0
+        self._button_callback = None  # Called with the state of every button notification
+        self.button = None  # Last notified button state
+        self._reconnecting = None  # Task reconnecting a lost link while subscribed
+        self._lock = asyncio.Lock()  # One GATT procedure at a time per link
+
+    @property
+    def is_connected(self):
+        return self.client is not None and self.client.is_connected
+
+    async def connect(self):
+        """Health check: reconnect if the link is gone."""
+        if not self.is_connected:
+            self.client = self.client_class(self.address, disconnected_callback=self._on_disconnect)
+            await self.client.connect()
+            self.connects += 1
+            if self._button_callback is not None:
+                await self._start_notify(self.client)  # A new link has no subscriptions
+        return self.client
+
+    async def close(self):
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+        client, self.client = self.client, None  # Not reconnected by _on_disconnect()
+        if client is not None:
+            await client.disconnect()
+
+    def _on_disconnect(self, client):
+        if client is self.client and self._button_callback is not None and self._reconnecting is None:
+            self._reconnecting = asyncio.get_running_loop().create_task(self._resubscribe())
+
+    async def _resubscribe(self, backoff=0.1, max_backoff=5.0):
+        """Reconnect a link lost while subscribed, a button change missed meanwhile is reported after it."""
+        try:
+            while True:
+                try:
+                    async with self._lock:
+                        await self.connect()  # Subscribes again
+                        state = int((await self.client.read_gatt_char(LBS_BUTTON_UUID))[0])
+                    break
+                except (BleakError, OSError, RuntimeError, asyncio.TimeoutError):
+                    if self.client is not None and self.client.is_connected:
+                        await self.client.disconnect()  # Connected but not subscribed, start over
+                    await asyncio.sleep(backoff)
+                    backoff = min(2 * backoff, max_backoff)
+        finally:
+            self._reconnecting = None
+        if state != self.button:
+            self._on_button(state)
+
+    async def _run(self, operation):
+        async with self._lock:
+            for attempt in range(self.retries + 1):
+                client = await self.connect()
+                try:
+                    return await operation(client)
+                except (BleakError, OSError, RuntimeError):
+                    if attempt == self.retries or client.is_connected:
+                        raise  # Not a broken link, or reconnecting did not help
+
+    async def write_led(self, state):
+        await self._run(lambda client: client.write_gatt_char(LBS_LED_UUID, bytearray([state])))
+
+    async def read_button(self):
+        state = await self._run(lambda client: client.read_gatt_char(LBS_BUTTON_UUID))
+        return int(state[0])
+
+    async def subscribe_button(self, callback):
+        """Call callback(state) on every button notification, the subscription is renewed after a reconnect."""
+        async with self._lock:
+            self._button_callback = callback
+            if self.is_connected:
+                await self._start_notify(self.client)
+            else:
+                await self.connect()
+
+    async def _start_notify(self, client):
+        await client.start_notify(LBS_BUTTON_UUID, lambda _, data: self._on_button(int(data[0])))
+
+    def _on_button(self, state):
+        self.button = state
+        self._button_callback(state)
+
+    async def run(self, operations):
+        """
+        Run consecutive operations over one link: ('led', state) writes the LED,
+        ('button',) reads the button. Returns the button states that were read.
+        """
+        async def batch(client):
+            states = []
+            for operation in operations:
+                if operation[0] == 'led':
+                    await client.write_gatt_char(LBS_LED_UUID, bytearray([operation[1]]))
+                else:
+                    states.append(int((await client.read_gatt_char(LBS_BUTTON_UUID))[0]))
+            return states
+
+        return await self._run(batch)
+
+
+class LBSPool:
+    """Sessions to many LBS devices, keyed by address."""
+
+    def __init__(self, client_class=BleakClient):
+        self.client_class = client_class
+        self.sessions = {}
+
+    def session(self, address):
+        if address not in self.sessions:
+            self.sessions[address] = LBSSession(address, self.client_class)
+        return self.sessions[address]
+
+    async def write_led(self, address, state):
+        await self.session(address).write_led(state)
+
+    async def read_button(self, address):
+        return await self.session(address).read_button()
+
+    async def close(self):
+        await asyncio.gather(*(s.close() for s in self.sessions.values()), return_exceptions=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
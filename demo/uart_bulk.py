@@ -0,0 +1,150 @@
+"""
+UART Bulk Transfer
+-------------
+
+Streams a large buffer over the Nordic UART Service (NUS) RX characteristic
+and verifies the echo coming back on TX (UART loopback on the device).
+
+The number of bytes written but not echoed yet is limited by a congestion
+window (in chunks): it grows while the echo keeps up and is halved when the
+echo stalls or skips data, which is how overruns of the peripheral RX buffer
+show up. The window never exceeds the RX buffer of the peripheral if its size
+is known, and stays below the size that overran it once that happened.
+
+Data is sent go-back-N: after a loss the echoes still on their way are
+discarded and everything not echoed yet is sent again, so the whole buffer
+arrives in order. A transfer that does not get past the same offset after
+several attempts fails with TransferError.
+
+"""
+
+import asyncio
+import time
+import zlib
+from typing import Iterator
+
+
+class TransferError(Exception):
+    pass
+
+
+def chunks(data, n: int) -> Iterator[memoryview]:
+    """
+    Slices *data* into memoryview chunks of size *n* without copying.
+    The last chunk may be smaller than *n*.
+    """
+    view = memoryview(data)
+    return (view[i : i + n] for i in range(0, len(view), n))
+
+
+def pattern(size: int) -> bytes:
+    """Generated test data: 0x00 .. 0xFF repeated."""
+    return (bytes(range(256)) * (size // 256 + 1))[:size]
+
+
+class BulkTransfer:
+    def __init__(self, data, chunk_size, max_window=32, stall_timeout=0.5, buffer_size=None, retries=5):
+        """
+        buffer_size: RX buffer of the peripheral in bytes if known, caps the window
+        retries:     attempts to send the data at one offset again before giving up
+        """
+        self.data = memoryview(data)
+        self.chunk_size = chunk_size
+        if buffer_size is not None:
+            max_window = min(max_window, max(1, buffer_size // chunk_size))
+        self.max_window = max_window
+        self.window = float(min(4, max_window))  # Congestion window in chunks
+        self.stall_timeout = stall_timeout
+        self.retries = retries
+        self.sent = 0  # Bytes written, goes back to echoed after a loss
+        self.echoed = 0  # Bytes received back in order
+        self.lost = 0  # Bytes sent again
+        self.losses = 0  # Number of times data was sent again
+        self.mismatched = 0  # Bytes echoed with different content
+        self.stalls = 0
+        self.crc_sent = zlib.crc32(self.data)
+        self.crc_received = 0
+        self._recovering = False  # Data was lost, the echoes on their way are discarded
+        self._attempts = 0  # Times the data at offset _rewound_at was sent again
+        self._rewound_at = None
+        self._progress = asyncio.Event()
+
+    def handle_rx(self, _, data: bytearray):
+        """Notification callback for the TX characteristic: verifies the echo."""
+        self._progress.set()
+        start = self.echoed
+        if self._recovering or start >= self.sent:
+            return  # Echo of data sent before a loss, it is sent again
+        if self.data[start : start + len(data)] != data:
+            if self._resync(data) is None:
+                # Nothing matches: the data was corrupted on the way
+                self.mismatched += sum(a != b for a, b in zip(self.data[start : start + len(data)], data))
+            else:
+                # Whole chunks were dropped by the peripheral (RX buffer overrun), stay below this window
+                self.max_window = max(1, min(self.max_window, int(self.window) - 1))
+            self._recovering = True
+            return
+        self.crc_received = zlib.crc32(data, self.crc_received)
+        self.echoed = min(self.sent, start + len(data))
+        # Additive increase: one chunk per window of echoed chunks
+        self.window = min(self.max_window, self.window + len(data) / self.chunk_size / self.window)
+
+    def _resync(self, data):
+        """Offset of the next outstanding chunk that *data* is the echo of, None if there is none."""
+        offset = (self.echoed // self.chunk_size + 1) * self.chunk_size
+        while offset < self.sent:
+            if self.data[offset : offset + len(data)] == data:
+                return offset
+            offset += self.chunk_size
+        return None
+
+    async def _wait_for_echo(self):
+        """Wait for the next echo, returns False after a stall."""
+        self._progress.clear()
+        try:
+            await asyncio.wait_for(self._progress.wait(), self.stall_timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def _rewind(self):
+        """Multiplicative decrease and go back to the first byte not echoed."""
+        if self._rewound_at == self.echoed:
+            self._attempts += 1
+            if self._attempts >= self.retries:
+                raise TransferError(f"no echo of the data at offset {self.echoed} after {self._attempts} attempts")
+        else:
+            self._rewound_at, self._attempts = self.echoed, 0
+        self.losses += 1
+        self.lost += self.sent - self.echoed
+        self.sent = self.echoed
+        self.window = max(1.0, self.window / 2)
+        self._recovering = False
+
+    async def run(self, write):
+        """Send all data with *write* (coroutine function taking one chunk), returns the elapsed time."""
+        start = time.perf_counter()
+        while self.echoed < len(self.data):
+            if self._recovering:
+                while await self._wait_for_echo():
+                    pass  # Until the echoes of the data sent before the loss stopped
+                self._rewind()
+                continue
+            chunk = self.data[self.sent : self.sent + self.chunk_size]
+            if chunk and self.sent + len(chunk) - self.echoed <= int(self.window) * self.chunk_size:
+                await write(chunk)
+                self.sent += len(chunk)
+            elif not await self._wait_for_echo():
+                # The peripheral is not keeping up, or the last packets were lost
+                self.stalls += 1
+                self._rewind()
+        return time.perf_counter() - start
+
+    def report(self, elapsed):
+        written = self.sent + self.lost
+        print(f"sent {len(self.data)} bytes in {elapsed:.2f} s: {self.echoed / elapsed / 1024:.1f} KB/s sustained")
+        print(f"loss rate {self.lost / max(1, written) * 100:.2f} % ({self.lost} bytes sent again after "
+              f"{self.losses} losses, {self.mismatched} bytes corrupted, {self.stalls} stalls), "
+              f"final window {int(self.window)} chunks of {self.chunk_size} bytes")
+        crc_ok = "OK" if self.crc_received == self.crc_sent else "MISMATCH"
+        print(f"checksum {self.crc_sent:08x} sent, {self.crc_received:08x} received: {crc_ok}")
@@ -7,9 +7,10 @@ An example showing how to write a simple program using the Nordic Semiconductor
 
 """
 
+import argparse
 import asyncio
+import os
 import sys
-from itertools import count, takewhile
 from typing import Iterator
 
 from bleak import BleakClient, BleakScanner
@@ -17,25 +18,49 @@ from bleak.backends.characteristic import BleakGATTCharacteristic
 from bleak.backends.device import BLEDevice
 from bleak.backends.scanner import AdvertisementData
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project"))
+import device_cache  # project/device_cache.py
+import recorder  # project/recorder.py
+import simulator  # project/simulator.py
+import tracing  # project/tracing.py
+from uart_bulk import BulkTransfer, TransferError, chunks, pattern
+
 UART_SERVICE_UUID = "6E400001-B5A3-F393-E0A9-E50E24DCCA9E"
 UART_RX_CHAR_UUID = "6E400002-B5A3-F393-E0A9-E50E24DCCA9E"
 UART_TX_CHAR_UUID = "6E400003-B5A3-F393-E0A9-E50E24DCCA9E"
 
 
-# TIP: you can get this function and more from the ``more-itertools`` package.
-def sliced(data: bytes, n: int) -> Iterator[bytes]:
+def sliced(data: bytes, n: int) -> Iterator[memoryview]:
     """
-    Slices *data* into chunks of size *n*. The last slice may be smaller than
-    *n*.
+    Slices *data* into chunks of size *n* without copying. The last slice may
+    be smaller than *n*.
     """
-    return takewhile(len, (data[i : i + n] for i in count(0, n)))
+    return chunks(data, n)
 
 
-async def uart_terminal():
+async def uart_terminal(args, tracer=None, session_recorder=None):
     """This is a simple "terminal" program that uses the Nordic Semiconductor
     (nRF) UART service. It reads from stdin and sends each line of data to the
     remote device. Any data received from the device is printed to stdout.
+    With --bulk or --pattern it streams the data instead and measures the
+    throughput (the device has to echo the data back).
+    Every phase, write and notification is recorded by *tracer* (a tracing.Tracer) if given,
+    every frame is logged by *session_recorder* (a recorder.Recorder) if given.
     """
+    scanner, client_class = BleakScanner, BleakClient
+    rx_buffer = args.rx_buffer
+    if args.replay:
+        scanner, client_class = recorder.replay_transport(args)
+    elif args.simulate:
+        peripheral = simulator.UartPeripheral()
+        simulator.add_device(peripheral, mtu=args.sim_mtu)
+        if rx_buffer is None:
+            rx_buffer = peripheral.buffer_size
+        scanner, client_class = simulator.SimulatedScanner, simulator.SimulatedClient
+    # Simulated devices get their own cache file, None with --no-cache
+    cache = device_cache.from_args(args, "simulated" if args.replay or args.simulate else "devices")
+    if session_recorder is not None:
+        client_class = recorder.recording_client(client_class, session_recorder)
 
     def match_nus_uuid(device: BLEDevice, adv: AdvertisementData):
         # This assumes that the device includes the UART service UUID in the
@@ -46,12 +71,6 @@ async def uart_terminal():
 
         return False
 
-    device = await BleakScanner.find_device_by_filter(match_nus_uuid)
-
-    if device is None:
-        print("no matching device found, you may need to edit match_nus_uuid().")
-        sys.exit(1)
-
     def handle_disconnect(_: BleakClient):
         print("Device was disconnected, goodbye.")
         # cancelling all tasks effectively ends the program
@@ -61,14 +80,51 @@ async def uart_terminal():
     def handle_rx(_: BleakGATTCharacteristic, data: bytearray):
         print("received:", data)
 
-    async with BleakClient(device, disconnected_callback=handle_disconnect) as client:
+    # Connect directly to the last used device if possible, scanning takes seconds
+    async with device_cache.connect(UART_SERVICE_UUID, match_nus_uuid, scanner, client_class, cache, tracer,
+                                    disconnected_callback=handle_disconnect) as client:
+        if client is None:
+            print("no matching device found, you may need to edit match_nus_uuid().")
+            sys.exit(1)
+
+        if tracer is not None:
+            tracer.start("discovery")
+        nus = client.services.get_service(UART_SERVICE_UUID)
+        rx_char = nus.get_characteristic(UART_RX_CHAR_UUID)
+
+        async def write(chunk):
+            await client.write_gatt_char(rx_char, chunk, response=False)
+
+        if tracer is not None:
+            write = tracer.wrap_write(write)
+
+        if args.bulk or args.pattern:
+            if args.bulk:
+                with open(args.bulk, "rb") as file:
+                    data = file.read()
+            else:
+                data = pattern(args.pattern)
+            transfer = BulkTransfer(data, rx_char.max_write_without_response_size, args.window,
+                                    buffer_size=rx_buffer)
+            handle_rx = transfer.handle_rx
+        if tracer is not None:
+            handle_rx = tracer.wrap_notify(handle_rx)
         await client.start_notify(UART_TX_CHAR_UUID, handle_rx)
+        if tracer is not None:
+            tracer.end("discovery")
+
+        if args.bulk or args.pattern:
+            try:
+                elapsed = await transfer.run(write)
+            except TransferError as error:
+                print("transfer failed:", error)
+                sys.exit(1)
+            transfer.report(elapsed)
+            return
 
         print("Connected, start typing and press ENTER...")
 
         loop = asyncio.get_running_loop()
-        nus = client.services.get_service(UART_SERVICE_UUID)
-        rx_char = nus.get_characteristic(UART_RX_CHAR_UUID)
 
         while True:
             # This waits until you type a line and press ENTER.
@@ -89,14 +145,36 @@ async def uart_terminal():
             # property to split the data into chunks that will fit.
 
             for s in sliced(data, rx_char.max_write_without_response_size):
-                await client.write_gatt_char(rx_char, s, response=False)
+                await write(s)
 
             print("sent:", data)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bulk", metavar="<file>", help="stream this file and verify the echo")
+    parser.add_argument("--pattern", type=int, metavar="<bytes>", help="stream a generated pattern of this size")
+    parser.add_argument("--window", type=int, default=32, help="maximum number of chunks not echoed yet")
+    parser.add_argument("--rx-buffer", type=int, metavar="<bytes>",
+                        help="UART RX buffer of the device, caps the window (default: learned from overruns)")
+    parser.add_argument("--simulate", action="store_true", help="use a local simulated NUS loopback device")
+    parser.add_argument("--sim-mtu", type=int, default=247, metavar="<bytes>", help="ATT MTU of the simulated link")
+    device_cache.add_arguments(parser)
+    tracing.add_arguments(parser)
+    recorder.add_arguments(parser)
+    args = parser.parse_args()
+    tracer = tracing.from_args(args)
+    session_recorder = recorder.from_args(args)
+
     try:
-        asyncio.run(uart_terminal())
+        asyncio.run(uart_terminal(args, tracer, session_recorder))
     except asyncio.CancelledError:
         # task is cancelled on disconnect, so we ignore this error
-        pass
\ No newline at end of file
+        pass
+    finally:
+        if tracer is not None:
+            tracer.export(args.trace, args.trace_format)
+            tracer.print_summary()
+        if session_recorder is not None:
+            session_recorder.close()
+        recorder.print_replay_report()
\ No newline at end of file
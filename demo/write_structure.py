@@ -7,8 +7,8 @@ An example showing how to send structure
 """
 
 import asyncio
+import os
 import sys
-import struct
 
 from itertools import count, takewhile
 from typing import Iterator
@@ -18,6 +18,10 @@ from bleak.backends.characteristic import BleakGATTCharacteristic
 from bleak.backends.device import BLEDevice
 from bleak.backends.scanner import AdvertisementData
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project"))
+import calculator  # project/calculator.py
+import device_cache  # project/device_cache.py
+
 SERVICE_UUID = "6e7e652f-0b5d-4de6-bcd9-a071d34c3e9f"
 WRITE_UUID = "448e4b02-b99a-4f57-a76d-d283933c2fd5"
 NOTIFY_UUID = "4d19fe91-2164-49a8-9022-55ba662ce6fc"
@@ -47,12 +51,6 @@ async def calculator_terminal():
 
         return False
 
-    device = await BleakScanner.find_device_by_filter(match_cds_uuid)
-
-    if device is None:
-        print("no matching device found, you may need to edit match_cds_uuid().")
-        sys.exit(1)
-
     def handle_disconnect(_: BleakClient):
         print("Device was disconnected, goodbye.")
         # Cancelling all tasks effectively ends the program
@@ -62,7 +60,14 @@ async def calculator_terminal():
     def handle_notification(_: BleakGATTCharacteristic, data: bytearray):
         print("received:", data)
 
-    async with BleakClient(device, disconnected_callback=handle_disconnect) as client:
+    # Connect directly to the last used device if possible, scanning takes seconds
+    cache = device_cache.DeviceCache()
+    async with device_cache.connect(SERVICE_UUID, match_cds_uuid, BleakScanner, BleakClient, cache,
+                                    disconnected_callback=handle_disconnect) as client:
+        if client is None:
+            print("no matching device found, you may need to edit match_cds_uuid().")
+            sys.exit(1)
+
         await client.start_notify(NOTIFY_UUID, handle_notification)
 
         print("Connected, start typing and press ENTER...")
@@ -72,34 +77,17 @@ async def calculator_terminal():
         write_data = cds.get_characteristic(WRITE_UUID)
 
         while True:
-            operation = 5         # For example, 1 could represent an addition operation
-            q31_operand = 1.23456  # Fixed-point operand
-            mode = 0              # 1 for fixed-point, 0 for floating-point
-            
-            
+            operation = 1               # 1: addition, 2: subtraction, 3: multiplication, 4: division
+            operand_1 = 1.23456         # Floats, converted to Q31 by pack_task() in fixed-point mode
+            operand_2 = 0.5
+            mode = calculator.FLOAT_MODE  # FIXED_MODE for fixed-point (operands in range <-1, 1))
+
             # Waits until you type a line and press ENTER.
             # data = await loop.run_in_executor(None, sys.stdin.buffer.readline)
-            data = struct.pack('<BfB', operation, q31_operand, mode)  # Convert the values to a byte array
-            # data = struct.pack('<BfB', operation, q31_operand, mode)  # Convert the values to a byte array
-            # '<BIB': This is the data format which tells the pack function how to pack the values. Here's what it means:
-            # '<': Indicates that the data will be packed in little-endian order (the least significant byte is first).
-            # B: Means that the first value (operation) will be represented as a single byte.
-            # I: Means that the second value (q31_operand) will be represented as a 32-bit unsigned integer.
-            #   f: represents a 32-bit floating-point number.
-            # B: Means that the third value (mode) will be represented as a single byte.
-            
-            """
-            /* struct template in C */
-            struct calculator_task {
-                uint8_t operation;
-                union {
-                    float f_operand;
-                    int32_t q31_operand;
-                };
-                bool mode;
-            };
-            """
-            
+            # The codec is generated from the C declaration of struct calculator_task
+            # (calculator.FIRMWARE_MESSAGES), there is no hand-written format string to keep in sync.
+            data = calculator.pack_task(operation, operand_1, operand_2, mode)  # Convert the values to a byte array
+
             print("send data:")
             print(data)
             await client.write_gatt_char(write_data, data, response=False)
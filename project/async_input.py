@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+
+"""
+async_input.py
+-------------
+Line input for asyncio programs. input() blocks the event loop thread: while the
+user types, notifications, disconnect callbacks and bleak's housekeeping are
+frozen. AsyncInput reads stdin in a background thread instead.
+---------
+"""
+import asyncio
+import sys
+import threading
+
+
+class AsyncInput:
+    """
+    Async replacement of input(): stdin is read by a daemon thread, so the event loop keeps
+    handling notifications while the user types. Lines typed ahead are queued, several
+    operations can be entered before their results arrive. Raises EOFError at the end of stdin.
+    (A daemon thread instead of run_in_executor: a readline() still blocked at exit does not
+    keep the program alive.)
+    """
+    def __init__(self, file=None):
+        self.file = file or sys.stdin
+        self.lines = None
+        self._thread = None
+
+    def _read(self, loop):
+        while True:
+            line = self.file.readline()
+            loop.call_soon_threadsafe(self.lines.put_nowait, line)
+            if not line:
+                break  # EOF
+
+    async def __call__(self, prompt=""):
+        if self._thread is None:
+            self.lines = asyncio.Queue()
+            self._thread = threading.Thread(target=self._read, args=(asyncio.get_running_loop(),), daemon=True)
+            self._thread.start()
+        if self.lines.empty():
+            print(prompt, end="", flush=True)  # Nothing typed ahead
+        line = await self.lines.get()
+        if not line:
+            self.lines.put_nowait(line)  # Every later call sees the EOF too
+            raise EOFError
+        return line.rstrip("\n")
+
+
+# Guard condition to check if the module is being run directly
+if __name__ == "__main__":
+    async def echo():
+        read = AsyncInput()
+        try:
+            while True:
+                print("read:", await read("> "))
+        except EOFError:
+            pass
+
+    asyncio.run(echo())
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+"""
+batch_codec.py
+-------------
+Batch codec for calculator_task frames built on a NumPy structured dtype.
+Encodes/decodes any number of operations into/out of one contiguous buffer
+(10 bytes per task, same layout as the packed C struct in calculator.py).
+Output is byte-for-byte identical to calculator.pack_task().
+---------
+"""
+import numpy as np
+
+import calculator  # calculator.py
+
+# Generated from the packed calculator_task struct, the unions are fields sharing the same offset
+TASK_DTYPE = calculator.TASK.dtype()
+
+Q31_MIN = -(1 << 31)
+Q31_MAX = (1 << 31) - 1
+
+
+def float_to_q31(values):
+    """
+    Vectorized calculator.float_to_q31(): multiply by 2^31 and truncate towards zero.
+    Values outside <-1, 1) saturate to the Q31 range instead of overflowing.
+    """
+    q31 = np.trunc(np.asarray(values, dtype=np.float64) * float(1 << 31))
+    return np.clip(q31, Q31_MIN, Q31_MAX).astype('<i4')
+
+
+def q31_to_float(values):
+    """Vectorized Q31 to float conversion (same as decoding a FIXED_MODE notification)."""
+    return np.asarray(values, dtype='<i4') / float(1 << 31)
+
+
+def encode(operations, num1, num2, mode):
+    """
+    Encode many calculator_tasks at once. All arguments are scalars or arrays of the same length,
+    operands are floats (converted to Q31 for the FIXED_MODE rows).
+    Returns a structured array, use .tobytes() or memoryview() on it to get the frames.
+    """
+    operations, num1, num2, mode = np.broadcast_arrays(operations, num1, num2, mode)
+    tasks = np.empty(operations.shape[0] if operations.ndim else 1, dtype=TASK_DTYPE)
+    tasks['operation'] = operations.ravel()
+    tasks['mode'] = mode.ravel()
+    tasks['f_operand_1'] = num1.ravel()
+    tasks['f_operand_2'] = num2.ravel()
+
+    fixed = tasks['mode'] == calculator.FIXED_MODE
+    if fixed.any():
+        tasks['q31_operand_1'][fixed] = float_to_q31(num1.ravel()[fixed])
+        tasks['q31_operand_2'][fixed] = float_to_q31(num2.ravel()[fixed])
+    return tasks
+
+
+def decode(buffer):
+    """Zero-copy view of a buffer of packed calculator_tasks as a structured array."""
+    return np.frombuffer(buffer, dtype=TASK_DTYPE)
+
+
+def operands(tasks):
+    """Operands of decoded tasks as float64 arrays, Q31 operands converted back to float."""
+    fixed = tasks['mode'] == calculator.FIXED_MODE
+    num1 = np.where(fixed, q31_to_float(tasks['q31_operand_1']), tasks['f_operand_1'])
+    num2 = np.where(fixed, q31_to_float(tasks['q31_operand_2']), tasks['f_operand_2'])
+    return num1, num2
+
+
+def encode_results(results, mode):
+    """Encode device results (4 bytes each) the way the firmware sends them in notifications."""
+    if mode == calculator.FLOAT_MODE:
+        return np.asarray(results, dtype='<f4')
+    return float_to_q31(results)
+
+
+def decode_results(buffer, mode):
+    """Decode a buffer of concatenated result notifications to float64."""
+    if mode == calculator.FLOAT_MODE:
+        return np.frombuffer(buffer, dtype='<f4').astype(np.float64)
+    return q31_to_float(np.frombuffer(buffer, dtype='<i4'))
+
+
+def benchmark(count=1_000_000):
+    """Compare the scalar calculator.pack_task() path against the batch codec."""
+    import time
+
+    rng = np.random.default_rng(0)
+    operations = rng.integers(1, 5, count, dtype=np.uint8)
+    num1 = rng.uniform(-1.0, 1.0, count)
+    num2 = rng.uniform(-1.0, 1.0, count)
+    mode = rng.integers(0, 2, count, dtype=np.uint8)
+
+    scalar_count = min(count, 200_000)
+    args = list(zip(operations[:scalar_count].tolist(), num1[:scalar_count].tolist(),
+                    num2[:scalar_count].tolist(), mode[:scalar_count].tolist()))
+    start = time.perf_counter()
+    scalar = b''.join([calculator.pack_task(*a) for a in args])
+    scalar_time = (time.perf_counter() - start) / scalar_count
+
+    start = time.perf_counter()
+    batch = encode(operations, num1, num2, mode).tobytes()
+    batch_time = (time.perf_counter() - start) / count
+
+    assert batch[:len(scalar)] == scalar, "batch codec differs from calculator.pack_task()"
+    print(f"scalar encode: {1 / scalar_time:14,.0f} ops/s")
+    print(f"batch encode:  {1 / batch_time:14,.0f} ops/s  ({scalar_time / batch_time:.0f}x)")
+
+    start = time.perf_counter()
+    operands(decode(batch))
+    print(f"batch decode:  {count / (time.perf_counter() - start):14,.0f} ops/s")
+
+
+# Guard condition to check if the module is being run directly
+if __name__ == "__main__":
+    print("** benchmark: batch_codec.py **")
+    benchmark()
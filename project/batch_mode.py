@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+
+"""
+batch_mode.py
+-------------
+Non-interactive streaming batch mode for the calculator.
+Operations are read from a CSV or JSONL file (or stdin), sent through a
+pipeline.RequestEngine and the results are streamed to an output file.
+Reading, encoding, sending, receiving and writing overlap, and the number of
+operations held in memory is bounded by the pipeline window.
+
+Input format (one operation per line):
+CSV:   op,num1,num2[,mode]            e.g.  +,0.5,0.25,fixed
+JSONL: {"op": "+", "num1": 0.5, "num2": 0.25, "mode": "fixed"}
+op is one of + - * / , mode is float or fixed (default: --mode).
+An operand "prev" uses the result of the previous line, like
+"2. Use previous result" in the interactive menu.
+---------
+"""
+import asyncio
+import csv
+import io
+import json
+import sys
+
+import calculator  # calculator.py
+
+PREVIOUS = "prev"
+MODES = {'float': calculator.FLOAT_MODE, 'fixed': calculator.FIXED_MODE,
+         '0': calculator.FLOAT_MODE, '1': calculator.FIXED_MODE}
+OUTPUT_FIELDS = ['line', 'op', 'num1', 'num2', 'mode', 'result', 'error']
+
+
+class BatchError(Exception):
+    pass
+
+
+class Operation:
+    __slots__ = ('line', 'op', 'num1', 'num2', 'mode', 'result', 'error')
+
+    def __init__(self, line, op, num1, num2, mode):
+        self.line = line
+        self.op = op
+        self.num1 = num1
+        self.num2 = num2
+        self.mode = mode
+        self.result = None
+        self.error = None
+
+    def row(self):
+        return {'line': self.line, 'op': self.op, 'num1': self.num1, 'num2': self.num2,
+                'mode': 'fixed' if self.mode == calculator.FIXED_MODE else 'float',
+                'result': self.result, 'error': self.error}
+
+
+def parse_operand(value):
+    if isinstance(value, str) and value.strip().lower() == PREVIOUS:
+        return PREVIOUS
+    return float(value)
+
+
+def parse_line(number, line, default_mode):
+    """Parse one CSV or JSONL line, returns an Operation or None for blank lines and comments."""
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    try:
+        if line.startswith('{'):
+            record = json.loads(line)
+            fields = [record['op'], record['num1'], record['num2'], record.get('mode')]
+            if not isinstance(fields[0], str) or not all(
+                    isinstance(value, (str, int, float)) and not isinstance(value, bool) for value in fields[1:3]):
+                raise BatchError(f"op must be a string, num1 and num2 numbers or {PREVIOUS!r}")
+        else:
+            fields = next(csv.reader([line])) + [None]
+            if fields[0].strip().lower() == 'op':
+                return None  # CSV header
+        op = fields[0].strip()
+        if op not in calculator.OPERATIONS:
+            raise BatchError(f"invalid operation {op!r}")
+        mode = default_mode if fields[3] in (None, '') else MODES[str(fields[3]).strip().lower()]
+        return Operation(number, op, parse_operand(fields[1]), parse_operand(fields[2]), mode)
+    except (ValueError, KeyError, IndexError, TypeError, OverflowError, BatchError) as error:
+        operation = Operation(number, line, None, None, default_mode)
+        operation.error = f"parse error: {error}"
+        return operation
+
+
+async def read_operations(file, default_mode, chunk_size=1 << 16):
+    """Yield Operations read from *file* in chunks, blocking reads run in the executor."""
+    loop = asyncio.get_running_loop()
+    number = 0
+    while True:
+        lines = await loop.run_in_executor(None, file.readlines, chunk_size)
+        if not lines:
+            break
+        for line in lines:
+            number += 1
+            operation = parse_line(number, line, default_mode)
+            if operation is not None:
+                yield operation
+
+
+class ResultWriter:
+    """Write results as JSONL or CSV, buffered so writing does not slow the pipeline down."""
+    def __init__(self, file, output_format):
+        self.file = file
+        self.output_format = output_format
+        self.count = 0
+        self.errors = 0
+        if output_format == 'csv':
+            self.writer = csv.DictWriter(file, OUTPUT_FIELDS, lineterminator='\n')
+            self.writer.writeheader()
+
+    def write(self, operation):
+        self.count += 1
+        if operation.error:
+            self.errors += 1
+        if self.output_format == 'csv':
+            self.writer.writerow(operation.row())
+        else:
+            self.file.write(json.dumps(operation.row()) + '\n')
+
+
+async def run(engine, operations, writer):
+    """
+    Stream *operations* (async iterator) through *engine* and write every result with *writer*.
+    Chained operations ("prev") wait for the result of the line before them.
+    """
+    queue = asyncio.Queue(maxsize=engine.window * 2)  # Operations in flight, in input order
+    done = object()
+
+    async def send():
+        previous = None  # Future of the previous result, None if it failed
+        async for operation in operations:
+            future = None
+            if operation.error is None:
+                if PREVIOUS in (operation.num1, operation.num2):
+                    result = await previous if previous is not None else None
+                    if result is None:
+                        operation.error = "previous result unavailable"
+                    else:
+                        operation.num1 = result if operation.num1 == PREVIOUS else operation.num1
+                        operation.num2 = result if operation.num2 == PREVIOUS else operation.num2
+            if operation.error is None:
+                operation.error = calculator.check_task(calculator.OPERATIONS[operation.op],
+                                                        operation.num1, operation.num2, operation.mode)
+            if operation.error is None:
+                data = calculator.pack_task(calculator.OPERATIONS[operation.op],
+                                            operation.num1, operation.num2, operation.mode)
+                future = await engine.submit(data)
+            previous = asyncio.ensure_future(decoded(future, operation.mode)) if future else None
+            await queue.put((operation, previous))
+        await queue.put(done)
+
+    async def decoded(future, mode):
+        try:
+            return calculator.unpack_result(await future, mode)
+        except Exception:
+            return None
+
+    async def receive():
+        while (item := await queue.get()) is not done:
+            operation, result = item
+            if result is not None:
+                operation.result = await result
+                if operation.result is None:
+                    operation.error = "no result received"
+            writer.write(operation)
+
+    await asyncio.gather(send(), receive())
+
+
+def open_input(path):
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def open_output(path, output_format):
+    """Returns (file, format), the format is guessed from the file name if not given."""
+    if output_format is None:
+        output_format = 'csv' if path.endswith('.csv') else 'jsonl'
+    if path == '-':
+        return sys.stdout, output_format
+    return open(path, 'w', encoding='utf-8', newline=''), output_format
+
+
+def add_arguments(parser):
+    """Add the batch mode command line options to an argparse parser."""
+    parser.add_argument("input", help="CSV or JSONL file with operations, - for stdin")
+    parser.add_argument("-o", "--output", default='-', help="file for the results, - for stdout (default)")
+    parser.add_argument("--output-format", choices=['csv', 'jsonl'],
+                        help="format of the results (default: from the output file name, else jsonl)")
+    parser.add_argument("--mode", choices=['float', 'fixed'], default='float',
+                        help="mode of the lines that do not specify one")
+    parser.add_argument("--window", type=int, default=32, help="operations in flight")
@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+
+"""
+benchmark.py
+-------------
+Round-trip latency and throughput benchmark of the CDS write/notify path.
+Drives N operations through a pipeline.RequestEngine for every combination of
+mode (float/fixed), payload mix and pipeline depth, and reports ops/sec,
+p50/p95/p99/max latency and an HDR-style histogram per run.
+Results are saved as JSON so runs of different commits can be compared.
+---------
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import time
+
+import calculator  # calculator.py
+import notify_path  # notify_path.py
+import pipeline  # pipeline.py
+import reference  # reference.py
+
+MODES = {'float': calculator.FLOAT_MODE, 'fixed': calculator.FIXED_MODE}
+
+# Operation weights (+, -, *, /) of the payload mixes
+MIXES = {
+    'add': (1, 0, 0, 0),
+    'mixed': (1, 1, 1, 1),
+    'muldiv': (0, 0, 1, 1),
+}
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram: values are recorded in microseconds with a fixed number of
+    significant bits, so the relative error of every bucket is bounded while the
+    memory use only grows with the logarithm of the value range.
+    """
+    def __init__(self, significant_bits=7):
+        self.significant_bits = significant_bits
+        self.counts = {}
+        self.count = 0
+        self.min = None
+        self.max = 0
+        self.total = 0
+
+    def bucket(self, value):
+        shift = max(0, value.bit_length() - self.significant_bits)
+        return (value >> shift) << shift
+
+    def record(self, seconds):
+        value = int(seconds * 1e6)
+        key = self.bucket(value)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.min = value if self.min is None else min(self.min, value)
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+
+    def percentile(self, p):
+        """Latency in microseconds below which p percent of the values fall."""
+        if not self.count:
+            return 0
+        rank = max(1, round(p / 100 * self.count))
+        seen = 0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            if seen >= rank:
+                return min(key, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'min_us': self.min or 0,
+            'mean_us': self.total / self.count if self.count else 0,
+            'p50_us': self.percentile(50),
+            'p95_us': self.percentile(95),
+            'p99_us': self.percentile(99),
+            'max_us': self.max,
+        }
+
+    def to_dict(self):
+        return {**self.summary(), 'significant_bits': self.significant_bits,
+                'buckets': [[key, self.counts[key]] for key in sorted(self.counts)]}
+
+    def print_histogram(self, width=40):
+        """Print the distribution with one line per power of two."""
+        rows = {}
+        for key, count in self.counts.items():
+            upper = 1 << key.bit_length()
+            rows[upper] = rows.get(upper, 0) + count
+        peak = max(rows.values(), default=1)
+        for upper in sorted(rows):
+            bar = '#' * max(1, round(rows[upper] / peak * width))
+            print(f"    < {upper:>9} us {rows[upper]:>9}  {bar}")
+
+
+def generate_frames(count, mode, mix, seed=0):
+    """Random packed calculator_tasks with valid operands for the given mode and mix."""
+    rng = random.Random(seed)
+    operations = rng.choices((1, 2, 3, 4), weights=MIXES[mix], k=count)
+    for operation in operations:
+        num1 = rng.uniform(-0.5, 0.5)
+        num2 = rng.uniform(-0.5, 0.5)
+        if operation == 4:
+            # Same constraints as Calculator.num1_less_than_num2() and the division by zero check
+            num2 = max(abs(num2), abs(num1) * 1.01, calculator.epsilon * 2) * (1 if num2 >= 0 else -1)
+            if mode == calculator.FIXED_MODE:
+                num2 = max(-0.999, min(0.999, num2))
+                num1 = max(-abs(num2) * 0.99, min(abs(num2) * 0.99, num1))
+        yield calculator.pack_task(operation, num1, num2, mode)
+
+
+async def run(engine, frames, timeout=60.0, verifier=None):
+    """
+    Send all *frames* through *engine*, returns (histogram, elapsed seconds, lost requests).
+    Requests still waiting after *timeout* seconds are counted as lost.
+    Results are checked against the reference model if a reference.Verifier is given.
+    """
+    histogram = LatencyHistogram()
+    futures = []
+    clock = time.perf_counter
+
+    def completed(future, sent, data):
+        if not future.cancelled() and future.exception() is None:
+            histogram.record(clock() - sent)
+            if verifier is not None:
+                verifier.add(data, future.result())
+
+    async def send_all():
+        for data in frames:
+            future = await engine.submit(data)
+            sent = clock()  # After waiting for a free slot in the window, the latency is the round trip only
+            future.add_done_callback(lambda f, sent=sent, data=data: completed(f, sent, data))
+            futures.append(future)
+        await asyncio.gather(*futures, return_exceptions=True)
+
+    start = clock()
+    try:
+        await asyncio.wait_for(send_all(), timeout)
+    except asyncio.TimeoutError:
+        engine.fail_pending(asyncio.TimeoutError("no notification received"))
+    elapsed = clock() - start
+    lost = sum(1 for f in futures if f.cancelled() or f.exception() is not None)
+    return histogram, elapsed, lost
+
+
+async def run_suite(client, write_char, notify_uuid, count=1000, modes=('float', 'fixed'),
+                    mixes=('mixed',), depths=(1, 8, 32), timeout=60.0, verify=False, log_results=None,
+                    batch_char=None, notify_timeout=1.0, tracer=None):
+    """
+    Run every mode/mix/depth combination on a connected client, returns the list of results.
+    After *notify_timeout* seconds without a notification the requests in flight fail with
+    pipeline.NotificationLost, the run is reported as out of sync (desyncs).
+    Every write and notification is recorded by *tracer* (a tracing.Tracer) if given.
+    With *batch_char* (the batch characteristic of the firmware) several tasks share a write.
+    With *verify* every result is checked bit-exactly against the reference model.
+    With *log_results* (a file) every decoded result is written to it by a background task.
+    """
+    engine = None  # None between runs: late results of a timed-out run are dropped
+    last_notification = 0.0
+    decoder = notify_path.ResultDecoder()
+    logger = None
+
+    def handle_notification(char, data):
+        nonlocal last_notification
+        last_notification = time.perf_counter()
+        if engine is not None:
+            engine.handle_notification(char, data)
+
+    def handle_notification_logged(char, data):
+        if engine is None:
+            return handle_notification(char, data)
+        for offset in range(0, len(data), pipeline.RESULT_SIZE):  # One result per task of the write
+            logger.push(decoder.decode(memoryview(data)[offset:offset + pipeline.RESULT_SIZE]))
+        handle_notification(char, data)
+
+    async def drain(quiet=0.5):
+        """
+        Wait until the board stopped answering the requests of a timed-out run,
+        their results would be matched FIFO to the requests of the next run.
+        """
+        nonlocal engine
+        engine = None
+        while time.perf_counter() - last_notification < quiet:
+            await asyncio.sleep(quiet)
+
+    def write(char):
+        async def write_char(data):
+            await client.write_gatt_char(char, data, response=False)
+        return write_char if tracer is None else tracer.wrap_write(write_char)
+
+    callback = handle_notification
+    if log_results is not None:
+        logger = notify_path.ResultLogger(log_results)
+        logger.start()
+        callback = handle_notification_logged
+    if tracer is not None:
+        callback = tracer.wrap_notify(callback)
+    await client.start_notify(notify_uuid, callback)
+    results = []
+    verifier = reference.Verifier() if verify else None
+    for mode in modes:
+        decoder.set_mode(MODES[mode])
+        for mix in mixes:
+            for depth in depths:
+                engine = pipeline.RequestEngine(write(write_char), window=depth, timeout=notify_timeout)
+                if batch_char is not None:
+                    engine.set_batching(write(batch_char),
+                                        batch_char.max_write_without_response_size // pipeline.TASK_SIZE)
+                histogram, elapsed, lost = await run(engine, generate_frames(count, MODES[mode], mix), timeout,
+                                                 verifier)
+                result = {
+                    'mode': mode, 'mix': mix, 'depth': depth, 'operations': count, 'lost': lost,
+                    'desyncs': engine.desyncs, 'tasks_per_write': engine.max_tasks,
+                    'elapsed_s': elapsed, 'ops_per_s': histogram.count / elapsed if elapsed else 0,
+                    'latency': histogram.to_dict(),
+                }
+                print_result(result, histogram)
+                results.append(result)
+                if lost:
+                    if tracer is not None:
+                        tracer.reset('lost')
+                    await drain()
+    await client.stop_notify(notify_uuid)
+    if logger is not None:
+        await logger.stop()
+    if verifier is not None:
+        verifier.finish().print_report()
+    desynced = [result for result in results if result['desyncs']]
+    if desynced:
+        print(f"warning: notifications were lost in {len(desynced)} runs, results received after a loss "
+              f"may have been matched to the wrong requests (FIFO out of sync)")
+    return results
+
+
+def print_result(result, histogram=None):
+    latency = result['latency']
+    print(f"{result['mode']:>5} {result['mix']:>6} depth {result['depth']:>3} "
+          f"x{result.get('tasks_per_write', 1):<2}: "
+          f"{result['ops_per_s']:9.1f} ops/s  p50 {latency['p50_us'] / 1000:7.2f} ms  "
+          f"p95 {latency['p95_us'] / 1000:7.2f} ms  p99 {latency['p99_us'] / 1000:7.2f} ms  "
+          f"max {latency['max_us'] / 1000:7.2f} ms  lost {result['lost']}"
+          + (f"  OUT OF SYNC x{result['desyncs']}" if result.get('desyncs') else ""))
+    if histogram is not None:
+        histogram.print_histogram()
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(path, results, transport):
+    """Save results as JSON together with what is needed to compare them across commits."""
+    report = {
+        'commit': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'transport': transport,
+        'results': results,
+    }
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2)
+    print("Results saved to", path)
+
+
+def add_arguments(parser):
+    """Add the benchmark command line options to an argparse parser."""
+    parser.add_argument("-n", "--count", type=int, default=1000, help="operations per run")
+    parser.add_argument("--modes", nargs="+", choices=sorted(MODES), default=['float', 'fixed'])
+    parser.add_argument("--mixes", nargs="+", choices=sorted(MIXES), default=['mixed'],
+                        help="payload mixes (add: only additions, muldiv: multiplications and divisions)")
+    parser.add_argument("--depths", nargs="+", type=int, default=[1, 8, 32],
+                        help="pipeline depths (operations in flight)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="maximum duration of one run in seconds")
+    parser.add_argument("--notify-timeout", type=float, default=1.0, metavar="<s>",
+                        help="seconds without a notification after which the requests in flight count as lost")
+    parser.add_argument("--verify", action="store_true",
+                        help="check every result bit-exactly against the local reference model")
+    parser.add_argument("--log-results", type=argparse.FileType('w'), metavar="<file>",
+                        help="write every decoded result to a file (written by a background task)")
+    parser.add_argument("--single-frame", action="store_true", default=argparse.SUPPRESS,  # Else main.py --single-frame
+                        help="one calculator_task per write even if the firmware supports batched framing")
+    parser.add_argument("-o", "--output", metavar="<file.json>", help="save the results as JSON")
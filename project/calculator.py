@@ -16,9 +16,11 @@ Calculate operations number:
 (4) division
 ---------
 """
-import struct
+import schema  # schema.py
 
-""" /* struct template in C */
+# Messages of the firmware, the codecs of every tool are generated from these declarations
+FIRMWARE_MESSAGES = """
+/* struct template in C */
 #pragma pack(push, 1) // Preserve current packing settings and set packing to 1 byte
 struct calculator_task {		// Define a structure for calculator tasks
 	uint8_t operation;			// Operation to be performed (e.g., add, subtract)
@@ -32,18 +34,79 @@ struct calculator_task {		// Define a structure for calculator tasks
 	};
 	bool mode;					// Mode: floating-point (0) or fixed-point (1)
 };
+
+union calculator_result {		// Result notification
+	float f_result;				// Mode: floating-point
+	int32_t q31_result;			// Mode: fixed-point (Q31)
+};
 #pragma pack(pop) // Restore original packing
 """
 
+MESSAGES = schema.compile(FIRMWARE_MESSAGES)
+TASK = MESSAGES['calculator_task']
+TASK_FLOAT = TASK.codec('f_operand_1', 'f_operand_2')  # '<BffB'
+TASK_Q31 = TASK.codec('q31_operand_1', 'q31_operand_2')  # '<BiiB'
+RESULT_FLOAT = MESSAGES['calculator_result'].codec('f_result')  # '<f'
+RESULT_Q31 = MESSAGES['calculator_result'].codec('q31_result')  # '<i'
+
 FLOAT_MODE = 0
 FIXED_MODE = 1
 
 epsilon = 1e-10  # Division by zero
+FLOAT32_MAX = 3.4028234663852886e38  # Largest finite float operand of a calculator_task
+FLOAT32_RANGE_ERROR = "Out of range. Operands must be finite and at most 3.4e38 in absolute value"
+
+OPERATIONS = {'+': 1, '-': 2, '*': 3, '/': 4}  # Operation symbol -> calculator_task operation number
+
+
+def float_to_q31(value):
+    """
+    Convert a floating-point number to Q31 fixed-point format. Q31 format represents numbers as a 32-bit signed integer.
+    """
+    return int(value * (1 << 31))  # Multiply `value` by 2^31 and return the result as an integer
+
+
+def pack_task(operation, num1, num2, mode):
+    """
+    Pack one calculator_task. Operands are given as floats, in FIXED_MODE they are converted to Q31.
+    """
+    if mode == FLOAT_MODE:
+        return TASK_FLOAT.pack(operation, num1, num2, mode)
+    return TASK_Q31.pack(operation, float_to_q31(num1), float_to_q31(num2), mode)
+
+
+def unpack_result(data, mode):
+    """Convert the result notification of the device to a Python float."""
+    if mode == FLOAT_MODE:
+        return RESULT_FLOAT.unpack(data)[0]  # [0] retrieves the first (and only) value from the tuple
+    return RESULT_Q31.unpack(data)[0] / float(1 << 31)
+
+
+def check_task(operation, num1, num2, mode):
+    """
+    Same checks as the interactive menu does before sending a task.
+    Returns an error message, or None if the task can be sent.
+    """
+    if operation not in OPERATIONS.values():
+        return "Invalid operation"
+    if mode == FLOAT_MODE and not (abs(num1) <= FLOAT32_MAX and abs(num2) <= FLOAT32_MAX):  # Also inf and nan
+        return FLOAT32_RANGE_ERROR
+    if mode == FIXED_MODE:
+        if not (-1.0 <= num1 < 1.0 and -1.0 <= num2 < 1.0):
+            return "Out of range. Operands must be in range <-1, 1)"
+        if operation == 4 and abs(num1) >= abs(num2):
+            return "First number must be smaller than the second number in absolute value"
+    if operation == 4 and abs(num2) < epsilon:
+        return "Division by zero"
+    return None
+
 
 class Calculator:
-    def __init__(self):
+    def __init__(self, input):
+        self.input = input  # Coroutine function reading one line, e.g. an async_input.AsyncInput
         self.mode = FLOAT_MODE  # Default FLOAT_MODE
         self.result = 0
+        self.pending = None  # Awaitable of the result of the last operation sent, None if there is none
         self.use_previous_result = False  # Flag to use previous result  in calculations
         self.reset()
 
@@ -61,20 +124,19 @@ class Calculator:
         else:
             print("Invalid mode. Mode unchanged.")      
         
-    def operate(self):
+    async def operate(self):
         """
         Perform the specified operation on the current result and given number.
         """
-        valid_operations = {'+': 1, '-': 2, '*': 3, '/': 4}
         while True:
-            operation = input("Enter operation (+, -, *, / ): ")
-            if operation in valid_operations:
-                self.operation = valid_operations[operation]
+            operation = await self.input("Enter operation (+, -, *, / ): ")
+            if operation in OPERATIONS:
+                self.operation = OPERATIONS[operation]
                 break
             else:
                 print("Invalid operation. Try again")
        
-    def get_number(self, prompt):
+    async def get_number(self, prompt):
         while True:
             try:
                 if self.use_previous_result:
@@ -85,9 +147,14 @@ class Calculator:
                     return self.result
                 else:  # Calculate mode
                     if self.mode == FLOAT_MODE:
-                        return float(input(prompt))
+                        prompt = float(await self.input(prompt))
+                        if not abs(prompt) <= FLOAT32_MAX:
+                            print(FLOAT32_RANGE_ERROR)
+                            prompt = ''
+                            continue
+                        return prompt
                     elif self.mode == FIXED_MODE:
-                        prompt = float(input(prompt))
+                        prompt = float(await self.input(prompt))
                         if prompt >= 1.0 or prompt < -1.0:
                             print("Out of range. Please enter a valid number in range <-1, 1)")
                             prompt = ''
@@ -100,15 +167,15 @@ class Calculator:
             """
             Convert a floating-point number to Q31 fixed-point format. Q31 format represents numbers as a 32-bit signed integer.
             """
-            return int(value * (1 << 31))  # Multiply `value` by 2^31 and return the result as an integer
+            return float_to_q31(value)
 
-    def num1_less_than_num2(self):
+    async def num1_less_than_num2(self):
         if self.mode == FIXED_MODE and self.operation == 4:
             while abs(self.num1) >= abs(self.num2):
                 print("First number must be smaller than the second number in absolute value.")
-                self.num2 = self.get_number("Enter second number: ")
+                self.num2 = await self.get_number("Enter second number: ")
     
-    def run_calculator(self):
+    async def run_calculator(self):
         """Main loop to run the calculator"""
         print("\n-------------- Choose operation in mode: --------------")
         if self.mode == FLOAT_MODE:
@@ -117,26 +184,31 @@ class Calculator:
             print("--> FIXED <--")
             
         print("1. Calculate")
-        print("2. Use previous result =", self.result)
+        if self.pending is None or self.pending.done():
+            print("2. Use previous result =", self.result)
+        else:
+            print("2. Use previous result (waiting for the device)")
         print("3. Reset")
         print("4. Change Mode (float or fixed)")
         print("5. Exit")
         print("----------------------------")
-        choice = input("Enter your choice: ")
+        choice = await self.input("Enter your choice: ")
         print("----------------------------")
         
         if choice == '1':  # Calculate
-            self.num1 = self.get_number("Enter first number: ")
-            self.operate()
-            self.num2 = self.get_number("Enter second number: ")
-            self.num1_less_than_num2()
+            self.num1 = await self.get_number("Enter first number: ")
+            await self.operate()
+            self.num2 = await self.get_number("Enter second number: ")
+            await self.num1_less_than_num2()
         elif choice == '2':  # Use previous result
             self.use_previous_result = True
+            if self.pending is not None:
+                await self.pending  # The previous operation may still be on its way
             print("Using previous result: ", self.result)
-            self.num1 = self.get_number("First number: ")
-            self.operate()
-            self.num2 = self.get_number("Enter second number: ")
-            self.num1_less_than_num2()
+            self.num1 = await self.get_number("First number: ")
+            await self.operate()
+            self.num2 = await self.get_number("Enter second number: ")
+            await self.num1_less_than_num2()
         elif choice == '3':  # Reset
             self.reset()
         elif choice == '4':  # Change Mode
@@ -155,26 +227,13 @@ class Calculator:
             return 'go_again'
         
         # Parsing data
-        if self.mode == FLOAT_MODE:
-            data = struct.pack('<BffB', self.operation, self.num1, self.num2, self.mode)  # Convert the values to a byte array
-        elif self.mode == FIXED_MODE:
-            q31_num1 = self.float_to_q31(self.num1)
-            q31_num2 = self.float_to_q31(self.num2)
-            data = struct.pack('<BiiB', self.operation, q31_num1, q31_num2, self.mode)  # Convert the values to a byte array
-        
-        return data
-        """ '<BiiB' or '<BffB'
-        This is the data format which tells the pack function how to pack the values:
-        <: packed in little-endian order (the least significant byte is first).
-        B: first value (operation) will be represented as a single byte.
-        i: value (q31_operand) will be represented as a 32-bit unsigned integer.
-        f: value will be represented as a 32-bit floating-point number.
-        B: last value (mode) will be represented as a single byte.
-        """
+        return pack_task(self.operation, self.num1, self.num2, self.mode)  # Convert the values to a byte array
         
 
 # Guard condition to check if the module is being run directly
 if __name__ == "__main__":
     print("** testing TUI: calculator.py **")
-    calc = Calculator()
-    data = calc.run_calculator()
\ No newline at end of file
+    import asyncio
+    import async_input  # async_input.py
+    calc = Calculator(async_input.AsyncInput())
+    data = asyncio.run(calc.run_calculator())
\ No newline at end of file
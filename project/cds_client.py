@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+"""
+cds_client.py
+-------------
+Thin client of the BLE daemon (main.py daemon). Talks to the daemon over a Unix
+domain socket and never imports bleak, so a call costs a local round trip
+instead of Python startup, scanning, connecting and GATT discovery.
+
+Protocol (little endian), every frame is a header followed by its payload:
+request:  uint32 id | uint8 kind   | uint16 length | payload
+response: uint32 id | uint8 status | uint16 length | payload
+CALCULATE carries one packed calculator_task and is answered with the raw 4 byte
+result, UART_WRITE carries bytes for the NUS RX characteristic, UART_SUBSCRIBE
+is answered with one UART_DATA frame (id of the subscription) per TX
+notification, STATS is answered with JSON. Responses to different requests may
+come in any order, they are matched by id.
+---------
+"""
+import argparse
+import itertools
+import json
+import os
+import socket
+import struct
+import sys
+
+import calculator  # calculator.py
+
+HEADER = struct.Struct('<IBH')
+CALCULATE, UART_WRITE, UART_SUBSCRIBE, STATS = range(1, 5)
+OK, ERROR, UART_DATA = range(3)
+MAX_PAYLOAD = 0xFFFF
+
+
+def default_socket_path():
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return os.path.join(runtime, "ble_test_tool.sock")
+    return os.path.join("/tmp", f"ble_test_tool-{os.getuid()}.sock")
+
+
+class DaemonError(Exception):
+    pass
+
+
+class Client:
+    def __init__(self, path=None, timeout=30.0):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect(path or default_socket_path())
+        self.file = self.socket.makefile('rb')
+        self._ids = itertools.count(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def send(self, kind, payload=b''):
+        """Send one request, returns its id."""
+        request_id = next(self._ids)
+        self.socket.sendall(HEADER.pack(request_id, kind, len(payload)) + payload)
+        return request_id
+
+    def receive(self):
+        """Read one response frame, returns (id, status, payload)."""
+        header = self.file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise DaemonError("the daemon closed the connection")
+        request_id, status, length = HEADER.unpack(header)
+        return request_id, status, self.file.read(length)
+
+    def call(self, kind, payload=b''):
+        request_id = self.send(kind, payload)
+        response_id, status, data = self.receive()
+        if response_id != request_id:
+            raise DaemonError(f"response {response_id} to request {request_id}")
+        if status == ERROR:
+            raise DaemonError(data.decode())
+        return data
+
+    def calculate(self, operation, num1, num2, mode=calculator.FLOAT_MODE):
+        """Run one operation ('+', '-', '*', '/' or 1..4) on the board, returns the result."""
+        operation = calculator.OPERATIONS.get(operation, operation)
+        error = calculator.check_task(operation, num1, num2, mode)
+        if error:
+            raise ValueError(error)
+        return calculator.unpack_result(self.call(CALCULATE, calculator.pack_task(operation, num1, num2, mode)), mode)
+
+    def calculate_many(self, tasks, mode=calculator.FLOAT_MODE, window=256):
+        """
+        Run (operation, num1, num2) tasks with up to *window* requests in flight.
+        Returns the results in order, failed tasks as DaemonError or ValueError.
+        The operands may be strings, a malformed task fails alone.
+        """
+        results = []
+        in_flight = {}  # Request id -> index in results
+        for task in tasks:
+            try:
+                operation, num1, num2 = task
+                operation = calculator.OPERATIONS.get(operation, operation)
+                num1, num2 = float(num1), float(num2)
+                error = calculator.check_task(operation, num1, num2, mode)
+            except (ValueError, TypeError) as exception:
+                error = str(exception)
+            results.append(ValueError(error) if error else None)
+            if error:
+                continue
+            in_flight[self.send(CALCULATE, calculator.pack_task(operation, num1, num2, mode))] = len(results) - 1
+            if len(in_flight) >= window:
+                self._collect(in_flight, results, mode)
+        while in_flight:
+            self._collect(in_flight, results, mode)
+        return results
+
+    def _collect(self, in_flight, results, mode):
+        request_id, status, data = self.receive()
+        index = in_flight.pop(request_id)
+        results[index] = DaemonError(data.decode()) if status == ERROR else calculator.unpack_result(data, mode)
+
+    def uart_write(self, data):
+        for start in range(0, len(data), MAX_PAYLOAD):
+            self.call(UART_WRITE, data[start:start + MAX_PAYLOAD])
+
+    def uart_listen(self):
+        """Yields the data of every UART TX notification."""
+        subscription = self.send(UART_SUBSCRIBE)
+        while True:
+            request_id, status, data = self.receive()
+            if status == ERROR:
+                raise DaemonError(data.decode())
+            if request_id == subscription and status == UART_DATA:
+                yield data
+
+    def stats(self):
+        return json.loads(self.call(STATS))
+
+
+def read_tasks(file):
+    """op,num1,num2 per line, as strings (checked by Client.calculate_many)."""
+    for line in file:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield tuple(field.strip() for field in line.split(',')[:3])
+
+
+# Guard condition to check if the module is being run directly
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Client of the BLE daemon (main.py daemon)")
+    parser.add_argument("operation", nargs="*", metavar="<num1> <op> <num2>", help="e.g. 0.5 + 0.25")
+    parser.add_argument("-f", "--file", metavar="<file>", help="op,num1,num2 per line (- is stdin)")
+    parser.add_argument("--mode", choices=('float', 'fixed'), default='float')
+    parser.add_argument("--uart", metavar="<text>", help="send text over the NUS RX characteristic")
+    parser.add_argument("--uart-listen", action="store_true", help="print the data received over NUS TX")
+    parser.add_argument("--stats", action="store_true", help="print the statistics of the daemon")
+    parser.add_argument("--socket", metavar="<path>", help=f"daemon socket (default: {default_socket_path()})")
+    args = parser.parse_args()
+    mode = calculator.FIXED_MODE if args.mode == 'fixed' else calculator.FLOAT_MODE
+
+    try:
+        with Client(args.socket) as client:
+            if len(args.operation) == 3:
+                num1, operation, num2 = args.operation
+                print(client.calculate(operation, float(num1), float(num2), mode))
+            elif args.operation:
+                parser.error("expected <num1> <op> <num2>")
+            if args.file:
+                file = sys.stdin if args.file == '-' else open(args.file)
+                with file:
+                    for result in client.calculate_many(read_tasks(file), mode):
+                        print(f"error: {result}" if isinstance(result, Exception) else result)
+            if args.uart:
+                client.uart_write(args.uart.encode())
+            if args.stats:
+                print(json.dumps(client.stats(), indent=1))
+            if args.uart_listen:
+                for data in client.uart_listen():
+                    print("received:", bytes(data))
+    except (OSError, DaemonError, ValueError) as error:
+        print("error:", error, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+"""
+daemon.py
+-------------
+Background daemon that holds the BLE link (main.py daemon).
+Scanning, connecting and GATT discovery are paid once, when the daemon starts.
+Local programs then use the calculator and the UART through a Unix domain
+socket with the compact binary protocol of cds_client.py, which does not
+import bleak. Every client may pipeline its requests, the operations of all
+clients share the window of one CDS session (reconnects included), so many
+concurrent clients are multiplexed onto the same link.
+---------
+"""
+import asyncio
+import contextlib
+import json
+import os
+import signal
+import socket
+import sys
+import time
+
+import calculator  # calculator.py
+import cds_client  # cds_client.py
+
+UART_SERVICE_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"
+UART_RX_CHAR_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"
+UART_TX_CHAR_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"
+
+TASK = {calculator.FLOAT_MODE: calculator.TASK_FLOAT, calculator.FIXED_MODE: calculator.TASK_Q31}
+
+
+def check_frame(data):
+    """Checks of the interactive menu for a packed calculator_task, returns an error message or None."""
+    if len(data) != TASK[calculator.FLOAT_MODE].size:
+        return f"a calculator_task is {TASK[calculator.FLOAT_MODE].size} bytes, got {len(data)}"
+    mode = data[-1]
+    if mode not in TASK:
+        return "Invalid mode"
+    operation, num1, num2, _ = TASK[mode].unpack(data)
+    if mode == calculator.FIXED_MODE:
+        num1, num2 = num1 / float(1 << 31), num2 / float(1 << 31)
+    return calculator.check_task(operation, num1, num2, mode)
+
+
+def running(path):
+    """True if a daemon is listening on the Unix socket *path*."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except OSError:
+            return False
+    return True
+
+
+class UartLink:
+    """Connected NUS board: writes are split to the characteristic size, TX data goes to every subscriber."""
+    def __init__(self, client):
+        self.client = client
+        self.rx_char = client.services.get_service(UART_SERVICE_UUID).get_characteristic(UART_RX_CHAR_UUID)
+        self.subscribers = {}  # StreamWriter -> subscription request id
+        self._lock = asyncio.Lock()  # Writes of different clients are not interleaved
+
+    async def start(self):
+        await self.client.start_notify(UART_TX_CHAR_UUID, self.handle_rx)
+
+    def handle_rx(self, _, data: bytearray):
+        for writer, request_id in list(self.subscribers.items()):
+            if writer.is_closing():
+                del self.subscribers[writer]
+            else:
+                writer.write(cds_client.HEADER.pack(request_id, cds_client.UART_DATA, len(data)) + data)
+
+    async def write(self, data):
+        if not self.client.is_connected:
+            raise ConnectionError("the UART device is disconnected")
+        size = self.rx_char.max_write_without_response_size
+        async with self._lock:
+            for start in range(0, len(data), size):
+                await self.client.write_gatt_char(self.rx_char, data[start:start + size], response=False)
+
+
+class Daemon:
+    def __init__(self, engine, uart=None):
+        """
+        engine: session.ResilientSession or pipeline.RequestEngine of the CDS board, raw results
+        uart:   UartLink, None if no UART device is used
+        """
+        self.engine = engine
+        self.uart = uart
+        self.clients = 0
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+        self.started = time.time()
+
+    async def handle_client(self, reader, writer):
+        self.clients += 1
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(cds_client.HEADER.size)
+                    request_id, kind, length = cds_client.HEADER.unpack(header)
+                    payload = await reader.readexactly(length)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                self.requests += 1
+                await self.dispatch(writer, request_id, kind, payload)
+                await writer.drain()  # Stop reading requests of a client that does not read its responses
+        finally:
+            self.clients -= 1
+            if self.uart is not None:
+                self.uart.subscribers.pop(writer, None)
+            writer.close()
+
+    async def dispatch(self, writer, request_id, kind, payload):
+        if kind == cds_client.CALCULATE:
+            error = check_frame(payload)
+            if error:
+                return self.reply(writer, request_id, cds_client.ERROR, error.encode())
+            try:
+                future = await self.engine.submit(payload)  # Waits while the window is full
+            except Exception as error:
+                return self.reply(writer, request_id, cds_client.ERROR, str(error).encode())
+            future.add_done_callback(lambda done: self.reply_result(writer, request_id, done))
+        elif kind in (cds_client.UART_WRITE, cds_client.UART_SUBSCRIBE) and self.uart is None:
+            self.reply(writer, request_id, cds_client.ERROR, b"no UART device, start the daemon with --uart")
+        elif kind == cds_client.UART_WRITE:
+            try:
+                await self.uart.write(payload)
+            except Exception as error:
+                return self.reply(writer, request_id, cds_client.ERROR, str(error).encode())
+            self.reply(writer, request_id, cds_client.OK)
+        elif kind == cds_client.UART_SUBSCRIBE:
+            self.uart.subscribers[writer] = request_id
+        elif kind == cds_client.STATS:
+            self.reply(writer, request_id, cds_client.OK, json.dumps(self.stats()).encode())
+        else:
+            self.reply(writer, request_id, cds_client.ERROR, f"unknown request kind {kind}".encode())
+
+    def reply_result(self, writer, request_id, future):
+        if future.cancelled():
+            self.reply(writer, request_id, cds_client.ERROR, b"cancelled")
+        elif future.exception() is not None:
+            self.reply(writer, request_id, cds_client.ERROR, str(future.exception()).encode())
+        else:
+            self.reply(writer, request_id, cds_client.OK, future.result())
+
+    def reply(self, writer, request_id, status, payload=b''):
+        if status == cds_client.ERROR:
+            self.errors += 1
+        if not writer.is_closing():  # The client may be gone before its result arrived
+            writer.write(cds_client.HEADER.pack(request_id, status, len(payload)) + payload)
+
+    def stats(self):
+        engine = getattr(self.engine, "engine", self.engine)  # The RequestEngine of a ResilientSession
+        stats = dict(uptime=round(time.time() - self.started, 3), clients=self.clients,
+                     connections=self.connections, requests=self.requests, errors=self.errors,
+                     in_flight=engine.in_flight, window=engine.window, uart=self.uart is not None)
+        for name in ("address", "connected", "reconnects", "resent"):
+            if hasattr(self.engine, name):
+                stats[name] = getattr(self.engine, name)
+        return stats
+
+    async def serve(self, path):
+        """Serve clients on the Unix socket *path* until cancelled or SIGTERM."""
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)  # Left over by a daemon that was killed, see running()
+        server = await asyncio.start_unix_server(self.handle_client, path)
+        os.chmod(path, 0o600)
+        print(f"Listening on {path}", file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+
+
+def add_arguments(parser):
+    """Add the daemon command line options to an argparse parser."""
+    parser.add_argument("--socket", default=cds_client.default_socket_path(), metavar="<path>",
+                        help="Unix socket to listen on (default: %(default)s)")
+    parser.add_argument("--window", type=int, default=32, help="operations in flight, shared by all clients")
+    parser.add_argument("--uart", action="store_true", help="also connect to a Nordic UART Service device")
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+"""
+device_cache.py
+-------------
+On-disk cache of recently used devices, keyed by service UUID.
+Stores the last-known address of every device, so the tools can connect
+directly and only fall back to a full scan when the direct connect fails.
+Entries expire by age and after a number of failed connect attempts.
+---------
+"""
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+
+DEFAULT_MAX_AGE = 7 * 24 * 3600  # Seconds
+DEFAULT_MAX_FAILURES = 3
+CONNECT_TIMEOUT = 5.0  # Seconds for a direct connect before falling back to scanning
+
+
+def default_path(name="devices"):
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "ble_test_tool", name + ".json")
+
+
+class DeviceCache:
+    def __init__(self, path=None, max_age=DEFAULT_MAX_AGE, max_failures=DEFAULT_MAX_FAILURES):
+        self.path = path or default_path()
+        self.max_age = max_age
+        self.max_failures = max_failures
+        self.entries = {}  # service uuid -> {address: entry}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(self.entries, file, indent=2)
+        os.replace(temporary, self.path)  # Never leave a half-written cache behind
+
+    def candidates(self, service_uuid):
+        """Valid entries for *service_uuid*, most recently seen first. Expired entries are dropped."""
+        entries = self.entries.get(service_uuid.lower(), {})
+        now = time.time()
+        for address in [a for a, e in entries.items()
+                        if now - e["last_seen"] > self.max_age or e["failures"] >= self.max_failures]:
+            del entries[address]
+        return sorted(entries.values(), key=lambda e: e["last_seen"], reverse=True)
+
+    def remember(self, service_uuid, address, name=None):
+        """Record a successful connection."""
+        entries = self.entries.setdefault(service_uuid.lower(), {})
+        entries[address] = {
+            "address": address,
+            "name": name,
+            "last_seen": time.time(),
+            "failures": 0,
+        }
+        self.save()
+
+    def failed(self, service_uuid, address):
+        """Record a failed direct connect attempt."""
+        entry = self.entries.get(service_uuid.lower(), {}).get(address)
+        if entry is not None:
+            entry["failures"] += 1
+            self.save()
+
+
+@contextlib.asynccontextmanager
+async def connect(service_uuid, filterfunc, scanner, client_class, cache=None, tracer=None, **client_kwargs):
+    """
+    Connect to a device providing *service_uuid*, trying the cached addresses before scanning.
+    Yields the connected client (None if no device was found) and disconnects it on exit.
+    Prints the startup time and whether the cache was hit.
+    The scan and connect phases are reported to *tracer* (a tracing.Tracer) if given.
+    A disconnected_callback in *client_kwargs* is only called for the client that is yielded,
+    not for cached candidates that turned out to be another device.
+    """
+    start = time.perf_counter()
+    client = None
+    callback = client_kwargs.pop("disconnected_callback", None)
+    if callback is not None:
+        def forward(disconnected):
+            if disconnected is client:  # Not a candidate that was rejected
+                callback(disconnected)
+        client_kwargs["disconnected_callback"] = forward
+    name = None
+    source = "cache miss, scanned"
+
+    for entry in cache.candidates(service_uuid) if cache is not None else []:
+        candidate = client_class(entry["address"], **client_kwargs)
+        if tracer is not None:
+            tracer.start("connect")
+        try:
+            await asyncio.wait_for(candidate.connect(), CONNECT_TIMEOUT)
+        except Exception:  # Includes asyncio.TimeoutError
+            if tracer is not None:
+                tracer.end("connect", ok=False)
+            with contextlib.suppress(Exception):
+                await candidate.disconnect()  # A timed out connect may still be pending in the stack
+            cache.failed(service_uuid, entry["address"])
+            continue
+        if tracer is not None:
+            tracer.end("connect")
+        if candidate.services.get_service(service_uuid) is None:
+            await candidate.disconnect()  # Another device took over the address
+            cache.failed(service_uuid, entry["address"])
+            continue
+        client = candidate
+        name = entry["name"]
+        source = "cache hit"
+        break
+
+    if client is None:
+        if tracer is not None:
+            tracer.start("scan")
+        device = await scanner.find_device_by_filter(filterfunc)
+        if tracer is not None:
+            tracer.end("scan", ok=device is not None)
+        if device is None:
+            yield None
+            return
+        client = client_class(device, **client_kwargs)
+        if tracer is not None:
+            tracer.start("connect")
+        await client.connect()
+        if tracer is not None:
+            tracer.end("connect")
+        name = device.name
+
+    if cache is not None:
+        cache.remember(service_uuid, client.address, name)
+    print(f"Connected to {client.address} in {time.perf_counter() - start:.2f} s ({source})", file=sys.stderr)
+    try:
+        yield client
+    finally:
+        await client.disconnect()
+
+
+def add_arguments(parser):
+    """Add the device cache command line options to an argparse parser."""
+    group = parser.add_argument_group("device cache")
+    group.add_argument("--no-cache", action="store_true", help="always scan, do not use the device cache")
+    group.add_argument("--cache-file", metavar="<path>", help=f"device cache file (default: {default_path()})")
+
+
+def from_args(args, name="devices"):
+    """DeviceCache selected on the command line, None if disabled."""
+    if args.no_cache:
+        return None
+    return DeviceCache(args.cache_file or default_path(name))
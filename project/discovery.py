@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+
+"""
+discovery.py
+-------------
+Streaming device discovery.
+stream() is an async generator that yields devices while their advertisements
+arrive instead of waiting for the whole scan window like BleakScanner.discover().
+Every advertisement updates a DeviceIndex: a deduplicated table keyed by
+address that tracks RSSI, name and service UUID changes and is indexed by
+service UUID. discover() stops scanning as soon as a predicate is satisfied,
+e.g. until_found(3, SERVICE_UUID) or until_found(1, min_rssi=-60).
+---------
+"""
+import asyncio
+import time
+
+from bleak import BleakScanner
+
+
+class DeviceEntry:
+    def __init__(self, device, adv, now):
+        self.device = device
+        self.address = device.address
+        self.name = adv.local_name or device.name
+        self.rssi = adv.rssi
+        self.service_uuids = frozenset(uuid.lower() for uuid in adv.service_uuids)
+        self.adv = adv
+        self.first_seen = now
+        self.last_seen = now
+        self.seen = 1  # Number of advertisements received
+
+    def __str__(self):
+        return f"{self.address}: {self.name} ({self.rssi} dBm)"
+
+
+class DeviceIndex:
+    """Deduplicated table of the devices seen, keyed by address and indexed by service UUID."""
+    def __init__(self, rssi_threshold=0):
+        self.rssi_threshold = rssi_threshold  # RSSI changes up to this many dBm are not reported
+        self.entries = {}  # Address -> DeviceEntry, in order of discovery
+        self.by_service = {}  # Service UUID -> set of addresses
+        self.started = time.perf_counter()
+        self.advertisements = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def __contains__(self, address):
+        return address in self.entries
+
+    def get(self, address):
+        return self.entries.get(address)
+
+    def update(self, device, adv):
+        """
+        Add or update the device of one advertisement. Returns the entry and the names
+        of the fields that changed: ('new',) for a new device, empty if nothing changed.
+        """
+        now = time.perf_counter()
+        self.advertisements += 1
+        entry = self.entries.get(device.address)
+        if entry is None:
+            entry = self.entries[device.address] = DeviceEntry(device, adv, now)
+            self._index(entry, entry.service_uuids, ())
+            return entry, ('new',)
+
+        changes = []
+        entry.device = device
+        entry.adv = adv
+        entry.last_seen = now
+        entry.seen += 1
+        if abs(adv.rssi - entry.rssi) > self.rssi_threshold:
+            entry.rssi = adv.rssi
+            changes.append('rssi')
+        name = adv.local_name or device.name
+        if name != entry.name:
+            entry.name = name
+            changes.append('name')
+        service_uuids = frozenset(uuid.lower() for uuid in adv.service_uuids)
+        if service_uuids and service_uuids != entry.service_uuids:
+            # Devices may split their services over advertisements, only a non-empty list replaces the old one
+            self._index(entry, service_uuids, entry.service_uuids)
+            entry.service_uuids = service_uuids
+            changes.append('services')
+        return entry, tuple(changes)
+
+    def _index(self, entry, added, removed):
+        for uuid in removed:
+            self.by_service[uuid].discard(entry.address)
+        for uuid in added:
+            self.by_service.setdefault(uuid, set()).add(entry.address)
+
+    def with_service(self, service_uuid):
+        """Entries advertising *service_uuid*."""
+        return [self.entries[address] for address in self.by_service.get(service_uuid.lower(), ())]
+
+    def strongest(self, count=None):
+        """Entries sorted by RSSI, strongest first."""
+        return sorted(self.entries.values(), key=lambda entry: entry.rssi, reverse=True)[:count]
+
+
+async def stream(scanner_class=BleakScanner, timeout=5.0, index=None, **scanner_kwargs):
+    """
+    Scan for at most *timeout* seconds, yields (entry, changes) for every new device and
+    every change of a known one (see DeviceIndex.update()).
+    Leaving the loop early stops the scan once the generator is closed, use
+    contextlib.aclosing() (or discover()) to stop it right away.
+    """
+    index = index if index is not None else DeviceIndex()
+    queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    def detection_callback(device, adv):
+        queue.put_nowait((device, adv))
+
+    async with scanner_class(detection_callback=detection_callback, **scanner_kwargs):
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                device, adv = await asyncio.wait_for(queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            entry, changes = index.update(device, adv)
+            if changes:
+                yield entry, changes
+
+
+def matches(entry, service_uuid=None, min_rssi=None):
+    if service_uuid is not None and service_uuid.lower() not in entry.service_uuids:
+        return False
+    return min_rssi is None or entry.rssi >= min_rssi
+
+
+def until_found(count=1, service_uuid=None, min_rssi=None):
+    """Predicate for discover(): at least *count* devices with *service_uuid* and at least *min_rssi* dBm."""
+    found = set()
+
+    def predicate(index, entry):
+        if matches(entry, service_uuid, min_rssi):
+            found.add(entry.address)
+        else:
+            found.discard(entry.address)  # E.g. the RSSI dropped below min_rssi again
+        return len(found) >= count
+    return predicate
+
+
+async def discover(predicate=None, scanner_class=BleakScanner, timeout=5.0, on_change=None, **scanner_kwargs):
+    """
+    Scan until predicate(index, entry) is true or *timeout* seconds passed, returns the DeviceIndex.
+    on_change(entry, changes) is called for every new or changed device.
+    """
+    index = DeviceIndex()
+    devices = stream(scanner_class, timeout, index, **scanner_kwargs)
+    try:
+        async for entry, changes in devices:
+            if on_change is not None:
+                on_change(entry, changes)
+            if predicate is not None and predicate(index, entry):
+                break
+    finally:
+        await devices.aclose()
+    return index
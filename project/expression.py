@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+"""
+expression.py
+-------------
+Expression compiler for the calculator.
+Arithmetic expressions like "(0.5 - 0.25) * (0.125 + 0.5) / 0.75" are compiled
+into a dependency graph of calculator_task operations. Every operation is sent
+as soon as its operands are known: independent subexpressions are in flight at
+the same time and a result feeds the operations waiting for it as soon as its
+notification arrives, so the total latency grows with the depth of the
+expression instead of the number of operations.
+The checks of the interactive menu apply: in fixed mode operands must be in
+<-1, 1) and a division needs |num1| < |num2|. Literals are checked when
+compiling, intermediate results when they are known.
+---------
+"""
+import ast
+import asyncio
+import sys
+
+import calculator  # calculator.py
+
+AST_OPERATIONS = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/'}
+
+
+class ExpressionError(Exception):
+    pass
+
+
+class Node:
+    """One calculator_task of the graph. Operands are floats (literals) or other nodes."""
+    __slots__ = ('operation', 'left', 'right', 'text', 'depth')
+
+    def __init__(self, operation, left, right, text):
+        self.operation = operation
+        self.left = left
+        self.right = right
+        self.text = text
+        self.depth = 1 + max(operand.depth if isinstance(operand, Node) else 0 for operand in (left, right))
+
+    def __str__(self):
+        return self.text
+
+
+class Graph:
+    def __init__(self, mode):
+        self.mode = mode
+        self.nodes = []  # In dependency order: operands before the nodes using them
+        self.roots = []  # (expression text, Node, literal or ExpressionError) per expression
+        self._shared = {}  # (operation, left, right) -> Node, the same subexpression is computed once
+
+    @property
+    def depth(self):
+        return max((node.depth for node in self.nodes), default=0)
+
+    def add(self, text):
+        """Compile one expression, errors found while compiling are kept as the result of the expression."""
+        try:
+            tree = ast.parse(text.strip(), mode='eval').body
+            root = self._compile(tree)
+        except (SyntaxError, ExpressionError) as error:
+            root = error if isinstance(error, ExpressionError) else ExpressionError(f"syntax error: {error.msg}")
+        self.roots.append((text.strip(), root))
+
+    def _compile(self, tree):
+        if isinstance(tree, ast.Constant) and isinstance(tree.value, (int, float)) and not isinstance(tree.value, bool):
+            return self._literal(tree.value, tree)
+        if isinstance(tree, ast.UnaryOp) and isinstance(tree.op, (ast.USub, ast.UAdd)):
+            sign = -1.0 if isinstance(tree.op, ast.USub) else 1.0
+            constant = tree.operand.value if isinstance(tree.operand, ast.Constant) else None
+            if isinstance(constant, (int, float)) and not isinstance(constant, bool):
+                return self._literal(-constant if sign < 0 else constant, tree)
+            operand = self._compile(tree.operand)
+            if sign > 0:
+                return operand
+            return self._node(calculator.OPERATIONS['-'], 0.0, operand, tree)
+        if isinstance(tree, ast.BinOp) and type(tree.op) in AST_OPERATIONS:
+            left = self._compile(tree.left)
+            right = self._compile(tree.right)
+            return self._node(calculator.OPERATIONS[AST_OPERATIONS[type(tree.op)]], left, right, tree)
+        raise ExpressionError(f"unsupported element: {ast.unparse(tree)}")
+
+    def _literal(self, value, tree):
+        try:
+            value = float(value)
+        except OverflowError:  # An integer literal too large for a float
+            raise ExpressionError(f"{ast.unparse(tree)}: out of range") from None
+        if self.mode == calculator.FIXED_MODE and not -1.0 <= value < 1.0:
+            raise ExpressionError(f"{ast.unparse(tree)}: out of range. Operands must be in range <-1, 1)")
+        if self.mode == calculator.FLOAT_MODE and not abs(value) <= calculator.FLOAT32_MAX:
+            raise ExpressionError(f"{ast.unparse(tree)}: {calculator.FLOAT32_RANGE_ERROR}")
+        return value
+
+    def _node(self, operation, left, right, tree):
+        if not isinstance(left, Node) and not isinstance(right, Node):
+            error = calculator.check_task(operation, left, right, self.mode)
+            if error:
+                raise ExpressionError(f"{ast.unparse(tree)}: {error}")
+        elif (operation == calculator.OPERATIONS['/'] and not isinstance(right, Node)
+              and abs(right) < calculator.epsilon):
+            raise ExpressionError(f"{ast.unparse(tree)}: Division by zero")
+        key = (operation, id(left) if isinstance(left, Node) else left, id(right) if isinstance(right, Node) else right)
+        node = self._shared.get(key)
+        if node is None:
+            node = self._shared[key] = Node(operation, left, right, ast.unparse(tree))
+            self.nodes.append(node)
+        return node
+
+
+def compile_expressions(texts, mode=calculator.FLOAT_MODE):
+    """Compile all *texts* into one Graph, shared subexpressions are computed once."""
+    graph = Graph(mode)
+    for text in texts:
+        graph.add(text)
+    return graph
+
+
+async def evaluate(engine, graph):
+    """
+    Run *graph* through *engine* (a pipeline.RequestEngine decoding results to floats).
+    Returns (expression text, result) per expression, the result is an ExpressionError if it failed.
+    """
+    tasks = {}
+
+    async def operand(value):
+        return await tasks[id(value)] if isinstance(value, Node) else value
+
+    async def run(node):
+        num1 = await operand(node.left)
+        num2 = await operand(node.right)
+        error = calculator.check_task(node.operation, num1, num2, graph.mode)
+        if error:
+            raise ExpressionError(f"{node} = {num1!r} {'+-*/'[node.operation - 1]} {num2!r}: {error}")
+        return await engine.request(calculator.pack_task(node.operation, num1, num2, graph.mode))
+
+    for node in graph.nodes:  # Dependency order: every operand task exists before its users
+        tasks[id(node)] = asyncio.ensure_future(run(node))
+
+    results = []
+    for text, root in graph.roots:
+        if isinstance(root, Node):
+            try:
+                root = await tasks[id(root)]
+            except ExpressionError as error:
+                root = error
+        results.append((text, root))
+    # Subexpressions whose users failed earlier may still be running, collect them
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
+    return results
+
+
+def read_expressions(paths, expressions):
+    """Expressions from the command line followed by the lines of the files (- is stdin), # starts a comment."""
+    texts = list(expressions)
+    for path in paths:
+        file = sys.stdin if path == '-' else open(path)
+        with file:
+            for line in file:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    texts.append(line)
+    return texts
+
+
+def add_arguments(parser):
+    """Add the expression mode command line options to an argparse parser."""
+    parser.add_argument("expressions", nargs="*", metavar="<expression>",
+                        help="e.g. \"(0.5 - 0.25) * 0.5\", put -- before expressions starting with -")
+    parser.add_argument("-f", "--file", action="append", default=[], metavar="<file>",
+                        help="read expressions from a file, one per line (- is stdin)")
+    parser.add_argument("--mode", choices=('float', 'fixed'), default='float', help="calculation mode")
+    parser.add_argument("--window", type=int, default=32, help="operations in flight")
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+"""
+fanout.py
+-------------
+Fan-out scheduler spreading CDS operations over several boards at once.
+Every board gets its own pipeline.RequestEngine; each operation goes to the
+board with the lowest expected completion time ((in flight + 1) * measured
+latency), so faster boards get more work. When a board disconnects, its
+unanswered operations are queued again for the remaining boards.
+---------
+"""
+import asyncio
+import time
+from collections import deque
+
+import pipeline  # pipeline.py
+
+
+class DeviceDisconnected(Exception):
+    pass
+
+
+class DeviceWorker:
+    """One connected board and its statistics."""
+    def __init__(self, device, client, write_char, window):
+        self.device = device
+        self.client = client
+        self.engine = pipeline.RequestEngine(
+            lambda data: client.write_gatt_char(write_char, data, response=False), window)
+        self.connected = True
+        self.latency = None  # Moving average of the round-trip latency in seconds
+        self.completed = 0
+        self.requeued = 0
+
+    def expected_delay(self, default):
+        return (self.engine.in_flight + 1) * (self.latency or default)
+
+    def record(self, latency, alpha=0.05):
+        self.completed += 1
+        self.latency = latency if self.latency is None else self.latency + alpha * (latency - self.latency)
+
+
+class FanoutScheduler:
+    def __init__(self, window=16):
+        self.window = window
+        self.workers = []
+        self._changed = asyncio.Event()  # Set when a slot becomes free or a board disconnects
+
+    async def connect_all(self, devices, client_class, write_uuid, notify_uuid, service_uuid):
+        """Connect to all *devices* concurrently, returns the number of connected boards."""
+        async def connect(device):
+            worker = None
+
+            def handle_disconnect(_):
+                if worker is not None:
+                    self.handle_disconnect(worker)
+
+            client = client_class(device, disconnected_callback=handle_disconnect)
+            try:
+                await client.connect()
+            except Exception as error:
+                print(f"Could not connect to {device}: {error}")
+                return
+            write_char = client.services.get_service(service_uuid).get_characteristic(write_uuid)
+            worker = DeviceWorker(device, client, write_char, self.window)
+
+            def handle_notification(char, data):
+                worker.engine.handle_notification(char, data)
+                self._changed.set()
+
+            await client.start_notify(notify_uuid, handle_notification)
+            self.workers.append(worker)
+
+        await asyncio.gather(*(connect(device) for device in devices))
+        return len(self.workers)
+
+    async def disconnect_all(self):
+        await asyncio.gather(*(w.client.disconnect() for w in self.workers if w.connected),
+                             return_exceptions=True)
+
+    def handle_disconnect(self, worker):
+        print(f"Device {worker.device} was disconnected, moving its work to the other devices.")
+        worker.connected = False
+        worker.engine.fail_pending(DeviceDisconnected(str(worker.device)))
+        self._changed.set()
+
+    async def _free_worker(self):
+        """Wait for a connected board with a free slot, picks the one expected to answer first."""
+        while True:
+            connected = [w for w in self.workers if w.connected]
+            if not connected:
+                raise DeviceDisconnected("all devices are disconnected")
+            free = [w for w in connected if w.engine.in_flight < w.engine.window]
+            if free:
+                known = [w.latency for w in connected if w.latency is not None]
+                default = min(known) if known else 0.01
+                return min(free, key=lambda w: w.expected_delay(default))
+            self._changed.clear()
+            await self._changed.wait()
+
+    async def run(self, frames):
+        """
+        Send all *frames* over the connected boards.
+        Yields (index of the frame, raw result) in the order the results arrive.
+        """
+        frames = enumerate(frames)
+        retry = deque()  # (index, frame) of operations lost with a disconnected board
+        done = asyncio.Queue()
+        outstanding = 0
+
+        def completed(future, worker, index, data, sent):
+            if future.cancelled() or future.exception() is not None:
+                worker.requeued += 1
+                retry.append((index, data))
+                done.put_nowait(None)  # Wake up the loop below
+            else:
+                latency = time.perf_counter() - sent
+                worker.record(latency)
+                done.put_nowait((index, future.result()))
+
+        exhausted = False
+        while True:
+            while not done.empty():
+                item = done.get_nowait()
+                outstanding -= 1
+                if item is not None:
+                    yield item
+            if retry:
+                index, data = retry.popleft()
+            elif not exhausted:
+                item = next(frames, None)
+                if item is None:
+                    exhausted = True
+                    continue
+                index, data = item
+            elif outstanding:
+                item = await done.get()
+                outstanding -= 1
+                if item is not None:
+                    yield item
+                continue
+            else:
+                break
+
+            worker = await self._free_worker()
+            sent = time.perf_counter()
+            try:
+                future = await worker.engine.submit(data)
+            except Exception:
+                retry.append((index, data))
+                continue
+            outstanding += 1
+            future.add_done_callback(lambda f, w=worker, i=index, d=data, s=sent: completed(f, w, i, d, s))
+
+    def report(self, elapsed):
+        """Print per-device and aggregate throughput."""
+        total = 0
+        for worker in self.workers:
+            total += worker.completed
+            latency = (worker.latency or 0) * 1000
+            state = "" if worker.connected else "  (disconnected)"
+            print(f"{str(worker.device):>40}: {worker.completed:>8} ops {worker.completed / elapsed:9.1f} ops/s "
+                  f"latency {latency:7.2f} ms  requeued {worker.requeued}{state}")
+        print(f"{'aggregate':>40}: {total:>8} ops {total / elapsed:9.1f} ops/s over {len(self.workers)} devices")
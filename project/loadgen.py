@@ -0,0 +1,359 @@
+#!/usr/bin/python3
+
+"""
+loadgen.py
+-------------
+Multi-process load generator for the CDS path (main.py load).
+One asyncio loop in one process becomes CPU bound on encoding, decoding and
+verifying long before the adapters and boards are saturated. The parent
+process generates the workload and hands it out in shards through one
+shared-memory ring buffer per worker; every worker is a process with its own
+event loop, connection (one adapter, or its own simulated device) and
+pipeline. Workers send aggregated latency and throughput statistics back to
+the parent once per report interval, so the aggregate ops/sec grows with the
+number of cores.
+---------
+"""
+import asyncio
+import functools
+import itertools
+import multiprocessing
+import queue
+import sys
+import time
+from multiprocessing import shared_memory
+
+import benchmark  # benchmark.py
+import calculator  # calculator.py
+import reference  # reference.py
+import session  # session.py
+import simulator  # simulator.py
+
+SHARD = 512  # Frames per shard put into a ring
+POLL_INTERVAL = 0.0005  # Seconds a worker sleeps when its ring is empty
+REPORT_INTERVAL = 1.0  # Seconds between the statistics messages of a worker
+
+
+class SharedRing:
+    """
+    Single-producer single-consumer ring of fixed size records in shared memory.
+    The producer only writes head and closed, the consumer only writes tail; both are
+    8 byte counters on their own cache line, records are copied before a counter moves.
+    """
+    HEADER_SIZE = 128
+    HEAD, CLOSED, TAIL = 0, 1, 8  # Indices of the counters in the header seen as uint64
+
+    def __init__(self, memory, capacity, record_size):
+        self.memory = memory
+        self.capacity = capacity
+        self.record_size = record_size
+        self.counters = memory.buf[:self.HEADER_SIZE].cast('Q')
+        self.data = memory.buf[self.HEADER_SIZE:self.HEADER_SIZE + capacity * record_size]
+
+    @classmethod
+    def create(cls, capacity=1 << 14, record_size=calculator.TASK.size):
+        memory = shared_memory.SharedMemory(create=True, size=cls.HEADER_SIZE + capacity * record_size)
+        memory.buf[:cls.HEADER_SIZE] = bytes(cls.HEADER_SIZE)
+        return cls(memory, capacity, record_size)
+
+    @classmethod
+    def attach(cls, name, capacity, record_size=calculator.TASK.size):
+        return cls(shared_memory.SharedMemory(name=name), capacity, record_size)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def free(self):
+        return self.capacity - (self.counters[self.HEAD] - self.counters[self.TAIL])
+
+    def put(self, data):
+        """Copy as many whole records of *data* as fit, returns the number of records written."""
+        head = self.counters[self.HEAD]
+        count = min(len(data) // self.record_size, self.capacity - (head - self.counters[self.TAIL]))
+        self._copy(head, count, data, into_ring=True)
+        self.counters[self.HEAD] = head + count
+        return count
+
+    def get(self, max_records):
+        """Up to *max_records* records as bytes, b'' if the ring is empty, None once it is closed and drained."""
+        closed = self.counters[self.CLOSED]  # Read before head: nothing is put after closing
+        tail = self.counters[self.TAIL]
+        count = min(self.counters[self.HEAD] - tail, max_records)
+        if not count:
+            return None if closed else b''
+        data = bytearray(count * self.record_size)
+        self._copy(tail, count, data, into_ring=False)
+        self.counters[self.TAIL] = tail + count
+        return data
+
+    def _copy(self, position, count, buffer, into_ring):
+        start = position % self.capacity
+        first = min(count, self.capacity - start)  # Records before the end of the ring
+        size = self.record_size
+        for ring_start, buffer_start, records in ((start, 0, first), (0, first, count - first)):
+            if records:
+                ring = self.data[ring_start * size:(ring_start + records) * size]
+                part = slice(buffer_start * size, (buffer_start + records) * size)
+                if into_ring:
+                    ring[:] = buffer[part]
+                else:
+                    buffer[part] = ring
+
+    def close(self):
+        self.counters[self.CLOSED] = 1
+
+    def release(self, unlink=False):
+        self.counters.release()
+        self.data.release()
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+def _match_service(service_uuid, address, device, adv):
+    if address is not None:
+        return device.address.lower() == address.lower()
+    return service_uuid in adv.service_uuids
+
+
+def _transport(config):
+    """Scanner and client classes of a worker: its adapter, or its own simulated device."""
+    if config['simulator'] is not None:
+        options = config['simulator']
+        simulator.devices.clear()  # Devices of the parent, if it was forked
+        simulator.add_device(simulator.SingleFrameCalculatorPeripheral() if options['single_frame']
+                             else simulator.CalculatorPeripheral(),
+                             connection_interval=options['interval'] / 1000, jitter=options['jitter'] / 1000,
+                             mtu=options['mtu'], drop_rate=options['drop'],
+                             link_loss_interval=options['link_loss'],
+                             packets_per_event=options['packets_per_event'],
+                             seed=None if options['seed'] is None else options['seed'] + config['index'])
+        return simulator.SimulatedScanner, simulator.SimulatedClient
+
+    from bleak import BleakClient, BleakScanner  # Only workers on real adapters need bleak
+    adapter = config['adapter']
+    if adapter is None:
+        return BleakScanner, BleakClient
+
+    class AdapterScanner(BleakScanner):
+        @classmethod
+        async def find_device_by_filter(cls, filterfunc, timeout=10.0, **kwargs):
+            return await BleakScanner.find_device_by_filter(filterfunc, timeout, adapter=adapter, **kwargs)
+
+    return AdapterScanner, functools.partial(BleakClient, adapter=adapter)
+
+
+def worker(config, ring_name, capacity, messages):
+    """Process entry point: drive the frames of one ring through one connection."""
+    ring = SharedRing.attach(ring_name, capacity)
+    try:
+        asyncio.run(_drive(config, ring, messages))
+    except Exception as error:
+        messages.put(('error', config['index'], f"{type(error).__name__}: {error}"))
+    finally:
+        ring.release()
+
+
+async def _drive(config, ring, messages):
+    index = config['index']
+    scanner, client_class = _transport(config)
+    filterfunc = functools.partial(_match_service, config['service_uuid'], config['address'])
+    connection = session.ResilientSession(
+        config['service_uuid'], config['write_uuid'], config['notify_uuid'], filterfunc, scanner, client_class,
+        window=config['window'], retries=config['retries'], backoff=config['backoff'],
+        batch_write_uuid=config['batch_write_uuid'])
+    async with connection as engine:
+        if engine is None:
+            messages.put(('error', index, "no device found"))
+            return
+        messages.put(('ready', index, engine.address))
+
+        clock = time.perf_counter
+        histogram = benchmark.LatencyHistogram()
+        counts = {'completed': 0, 'errors': 0}
+        verifier = reference.Verifier() if config['verify'] else None
+        pending = set()
+
+        def completed(future, sent, data):
+            pending.discard(future)
+            if future.cancelled() or future.exception() is not None:
+                counts['errors'] += 1
+                return
+            histogram.record(clock() - sent)
+            counts['completed'] += 1
+            if verifier is not None:
+                verifier.add(data, future.result())
+
+        def report():
+            nonlocal histogram
+            messages.put(('stats', index, counts['completed'], counts['errors'], histogram))
+            histogram = benchmark.LatencyHistogram()  # The parent merges the deltas
+            counts.update(completed=0, errors=0)
+
+        reported = clock()
+        size = calculator.TASK.size
+        while True:
+            shard = ring.get(SHARD)
+            if shard is None:
+                break
+            if not shard:
+                await asyncio.sleep(POLL_INTERVAL)
+            view = memoryview(shard)
+            for offset in range(0, len(shard), size):
+                data = bytes(view[offset:offset + size])
+                future = await engine.submit(data)
+                sent = clock()  # After waiting for a free slot in the window, the latency is the round trip only
+                pending.add(future)
+                future.add_done_callback(lambda f, sent=sent, data=data: completed(f, sent, data))
+            if clock() - reported >= REPORT_INTERVAL:
+                report()
+                reported = clock()
+        if pending:
+            await asyncio.wait(pending)
+        report()
+        messages.put(('done', index, verifier.finish() if verifier is not None else None, engine.reconnects))
+
+
+class LoadGenerator:
+    def __init__(self, configs, capacity=1 << 14):
+        """*configs*: one worker configuration per process, see main.calculator_load()."""
+        self.configs = configs
+        self.capacity = capacity
+        self.histogram = benchmark.LatencyHistogram()
+        self.completed = [0] * len(configs)
+        self.errors = [0] * len(configs)
+        self.addresses = [None] * len(configs)
+        self.reconnects = [0] * len(configs)
+        self.report = None
+        self.elapsed = 0.0
+
+    def run(self, frames):
+        """Send all *frames* through the workers, returns the elapsed seconds from the moment all are connected."""
+        context = multiprocessing.get_context()
+        messages = context.Queue()
+        rings = [SharedRing.create(self.capacity) for _ in self.configs]
+        processes = [context.Process(target=worker, args=(config, ring.name, self.capacity, messages), daemon=True)
+                     for config, ring in zip(self.configs, rings)]
+        try:
+            for process in processes:
+                process.start()
+            self._wait(messages, processes, 'ready')  # Until every worker is connected
+
+            start = time.perf_counter()
+            last = start
+            shards = iter(lambda: b''.join(itertools.islice(frames, SHARD)), b'')
+            shard = next(shards, None)
+            offset = 0
+            while shard is not None:
+                ring = max(rings, key=SharedRing.free)  # Faster workers drain their ring faster and get more work
+                offset += ring.put(memoryview(shard)[offset:]) * ring.record_size
+                if offset == len(shard):
+                    shard, offset = next(shards, None), 0
+                elif not ring.free():
+                    self._poll(messages, processes)  # All rings are full
+                if time.perf_counter() - last >= REPORT_INTERVAL:
+                    while not messages.empty():
+                        self._poll(messages, processes)
+                    self._check_workers(messages, processes, set(range(len(processes))))
+                    self._progress(time.perf_counter() - start)
+                    last = time.perf_counter()
+            for ring in rings:
+                ring.close()
+
+            self._wait(messages, processes, 'done', start)
+            self.elapsed = time.perf_counter() - start
+            for process in processes:
+                process.join()
+            return self.elapsed
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            for ring in rings:
+                ring.release(unlink=True)
+
+    def _wait(self, messages, processes, until, start=None):
+        """Handle messages until every worker sent *until*, shows the progress if *start* is given."""
+        waiting = set(range(len(processes)))
+        while waiting:
+            try:
+                self._handle(messages.get(timeout=REPORT_INTERVAL), waiting, until)
+            except queue.Empty:
+                self._check_workers(messages, processes, waiting, until)
+            if start is not None:
+                self._progress(time.perf_counter() - start)
+
+    def _poll(self, messages, processes, timeout=POLL_INTERVAL):
+        """Handle the next message if one comes within *timeout*, else make sure every worker still runs."""
+        try:
+            self._handle(messages.get(timeout=timeout), set(), None)
+        except queue.Empty:
+            self._check_workers(messages, processes, set(range(len(processes))))
+
+    def _check_workers(self, messages, processes, waiting, until=None):
+        """Raise if a worker in *waiting* exited before sending *until*, with its error if it sent one."""
+        for index in list(waiting):
+            if processes[index].is_alive():
+                continue
+            while index in waiting:  # Its last messages may still be queued, e.g. the error that ended it
+                try:
+                    self._handle(messages.get_nowait(), waiting, until)
+                except queue.Empty:
+                    raise RuntimeError(f"worker {index} ({self.configs[index]['name']}) exited unexpectedly "
+                                       f"(exit code {processes[index].exitcode})") from None
+
+    def _handle(self, message, waiting, until):
+        kind, index, *values = message
+        if kind == 'error':
+            raise RuntimeError(f"worker {index} ({self.configs[index]['name']}): {values[0]}")
+        if kind == 'ready':
+            self.addresses[index] = values[0]
+        elif kind == 'stats':
+            completed, errors, histogram = values
+            self.completed[index] += completed
+            self.errors[index] += errors
+            self.histogram.merge(histogram)
+        elif kind == 'done':
+            report, self.reconnects[index] = values
+            if report is not None:
+                if self.report is None:
+                    self.report = report
+                else:
+                    self.report.merge(report)
+        if kind == until:
+            waiting.discard(index)
+
+    def _progress(self, elapsed, file=sys.stderr):
+        total = sum(self.completed)
+        print(f"\r{total} operations, {total / elapsed if elapsed else 0:.0f} ops/s", end="", file=file, flush=True)
+
+    def print_report(self):
+        print(file=sys.stderr)
+        elapsed = self.elapsed or 1e-9
+        for index, config in enumerate(self.configs):
+            print(f"{config['name']:>12} {self.addresses[index]}: {self.completed[index]:>9} ops "
+                  f"{self.completed[index] / elapsed:10.1f} ops/s  errors {self.errors[index]}  "
+                  f"reconnects {self.reconnects[index]}")
+        total = sum(self.completed)
+        latency = self.histogram.summary()
+        print(f"{'aggregate':>12}: {total:>9} ops {total / elapsed:10.1f} ops/s over {len(self.configs)} "
+              f"processes  p50 {latency['p50_us'] / 1000:.2f} ms  p99 {latency['p99_us'] / 1000:.2f} ms  "
+              f"max {latency['max_us'] / 1000:.2f} ms")
+        if self.report is not None:
+            self.report.print_report()
+
+
+def add_arguments(parser):
+    """Add the load generator command line options to an argparse parser."""
+    parser.add_argument("-n", "--count", type=int, default=100000, help="number of operations")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="worker processes, each on its own (simulated) board (default: one per core)")
+    parser.add_argument("--adapters", nargs="+", metavar="<adapter>",
+                        help="one worker per Bluetooth adapter (e.g. hci0 hci1), each on its own board")
+    parser.add_argument("--mode", choices=sorted(benchmark.MODES), default='float')
+    parser.add_argument("--mix", choices=sorted(benchmark.MIXES), default='mixed')
+    parser.add_argument("--window", type=int, default=64, help="operations in flight per worker")
+    parser.add_argument("--scan-time", type=float, default=5.0, help="maximum scan duration in seconds")
+    parser.add_argument("--verify", action="store_true",
+                        help="check every result bit-exactly against the local reference model")
@@ -6,10 +6,27 @@ CDS Service Test Tool
 -------------
 Interactive terminal for BLE Calculator Application with nRF Connect SDK on Nordic Devkit
 """
+import argparse
 import asyncio
+import contextlib
 import sys
-import struct
+import time
+import async_input  # async_input.py
+import batch_mode  # batch_mode.py
+import benchmark  # benchmark.py
 import calculator  # calculator.py
+import daemon  # daemon.py
+import device_cache  # device_cache.py
+import discovery  # discovery.py
+import expression  # expression.py
+import fanout  # fanout.py
+import loadgen  # loadgen.py
+import notify_path  # notify_path.py
+import recorder  # recorder.py
+import result_cache  # result_cache.py
+import session  # session.py
+import simulator  # simulator.py
+import tracing  # tracing.py
 
 from bleak import BleakClient, BleakScanner
 from bleak.backends.characteristic import BleakGATTCharacteristic
@@ -19,75 +36,393 @@ from bleak.backends.scanner import AdvertisementData
 SERVICE_UUID = "6e7e652f-0b5d-4de6-bcd9-a071d34c3e9f"
 WRITE_UUID   = "448e4b02-b99a-4f57-a76d-d283933c2fd5"
 NOTIFY_UUID  = "4d19fe91-2164-49a8-9022-55ba662ce6fc"
+BATCH_WRITE_UUID = "448e4b03-b99a-4f57-a76d-d283933c2fd5"  # Several calculator_tasks per write (newer firmware)
 
+TERMINAL_WINDOW = 8  # Operations the interactive terminal may have in flight
 
-async def calculator_terminal():
+
+def match_cds_uuid(device: BLEDevice, adv: AdvertisementData):
+    # This assumes that the device includes the Calculator Data Service (CDS) UUID in the advertising data.
+    if SERVICE_UUID.lower() in adv.service_uuids:
+        return True
+    return False
+
+
+def match_nus_uuid(device: BLEDevice, adv: AdvertisementData):
+    return daemon.UART_SERVICE_UUID in adv.service_uuids
+
+
+def connect_cds(scanner=BleakScanner, client_class=BleakClient, cache=None, tracer=None, **client_kwargs):
+    """
+    Connect to a device with the CDS, directly from the device cache if possible, else by scanning.
+    Use with "async with", the connected client (None if no device was found) is returned.
+    """
+    return device_cache.connect(SERVICE_UUID, match_cds_uuid, scanner, client_class, cache, tracer,
+                                **client_kwargs)
+
+
+def cds_session(scanner=BleakScanner, client_class=BleakClient, cache=None, window=1, decode=bytes, tracer=None,
+                args=None):
+    """
+    Connection to a CDS board that reconnects and resends unanswered operations after a disconnect.
+    Use with "async with", the session (None if no device was found) has the interface of a
+    pipeline.RequestEngine. The reconnect and framing options are taken from *args* if given.
+    Several tasks share a write if the firmware supports batched framing.
+    """
+    options = dict(batch_write_uuid=BATCH_WRITE_UUID)
+    if args is not None:
+        options.update(retries=args.reconnect_retries, backoff=args.reconnect_backoff,
+                       batch_write_uuid=None if args.single_frame else BATCH_WRITE_UUID)
+    return session.ResilientSession(SERVICE_UUID, WRITE_UUID, NOTIFY_UUID, match_cds_uuid, scanner, client_class,
+                                    cache, window, decode, tracer, **options)
+
+
+def no_device_found():
+    print("No matching device found, you may need to edit match_cds_uuid().")
+    sys.exit(1)
+
+
+async def find_cds_devices(scanner=BleakScanner, timeout=5.0, count=None):
+    """
+    Scan for *timeout* seconds, returns every device advertising the CDS.
+    The scan stops as soon as *count* devices were found if given.
+    """
+    predicate = discovery.until_found(count, SERVICE_UUID) if count else None
+    index = await discovery.discover(predicate, scanner, timeout)
+    return [entry.device for entry in index.with_service(SERVICE_UUID)]
+
+
+async def calculator_terminal(scanner=BleakScanner, client_class=BleakClient, cache=None, tracer=None, args=None):
     """
     This is a simple "terminal" program to use the Calculator Data Service on the Nordic Board.
     It reads operands and operation from stdin and sends data to the device.
     Result received from the device is printed to stdout.
+    scanner/client_class can be replaced with simulator.SimulatedScanner/SimulatedClient.
+    Every phase and operation is recorded by *tracer* (a tracing.Tracer) if given.
+    After a disconnect the session reconnects and the pending operations are sent again.
+    Input is read without blocking the event loop: operations can be entered while earlier
+    ones are still in flight, results are printed as they arrive.
     """
-    notify_event = asyncio.Event()
-    
-    def match_cds_uuid(device: BLEDevice, adv: AdvertisementData):
-        # This assumes that the device includes the Calculator Data Service (CDS) UUID in the advertising data.
-        if SERVICE_UUID.lower() in adv.service_uuids:
-            return True
-        return False
-
-    device = await BleakScanner.find_device_by_filter(match_cds_uuid)
-
-    if device is None:
-        print("No matching device found, you may need to edit match_cds_uuid().")
-        sys.exit(1)
-
-    def handle_disconnect(_: BleakClient):
-        print("Device was disconnected, goodbye!")
-        # Cancelling all tasks effectively ends the program
-        for task in asyncio.all_tasks():
-            task.cancel()
-
-    def handle_notification(_: BleakGATTCharacteristic, data: bytearray):
-        nonlocal notify_event
-        
-        if calc.mode == 0:
-            result = struct.unpack('f', data)[0]  # Unpack little-endian byte order, [0] retrieves the first (and only) value from the tuple
-        elif calc.mode == 1:
-            result = struct.unpack('i', data)[0]  # unpack little-endian byte order, [0] retrieves the first (and only) value from the tuple
-            result = result / float(1 << 31)
-        
-        print("--------> Received operation result:", result)
-        calc.result = result  # Update result
-        notify_event.set()  # Set the event when notification is received
-        
-
-    async with BleakClient(device, disconnected_callback=handle_disconnect) as client:
-        # Start receiving notifications
-        await client.start_notify(NOTIFY_UUID, handle_notification)  # Receive data
+    # Every notification is matched to the request that caused it and decoded in place
+    decoder = notify_path.ResultDecoder()
+    async with cds_session(scanner, client_class, cache, window=TERMINAL_WINDOW, decode=decoder.decode,
+                           tracer=tracer, args=args) as engine:
+        if engine is None:
+            no_device_found()
         print("Connected!")
-        
-        cds = client.services.get_service(SERVICE_UUID)
-        write_data = cds.get_characteristic(WRITE_UUID)
 
-        calc = calculator.Calculator()
+        terminal = asyncio.current_task()
+        calc = calculator.Calculator(async_input.AsyncInput())
+
+        async def show_result(future):
+            try:
+                result = await future
+            except session.SessionLost as error:
+                print(f"Device was disconnected ({error}), goodbye!")
+                terminal.cancel()  # Stops waiting for input
+                return None
+            print("\n--------> Received operation result:", result)
+            calc.result = result  # Update result
+            return result
+
         while True:
-            data = calc.run_calculator()
-            
+            try:
+                data = await calc.run_calculator()
+            except EOFError:
+                data = 'goodbye'
+
             if data == 'mode' or data == 'go_again':
                 continue
             if data == 'goodbye':
                 break
 
-            await client.write_gatt_char(write_data, data, response=False)  # Send data
-            # print("sent:", data)
-            
-            await notify_event.wait()  # Wait for notification before proceeding to the next iteration
-            notify_event.clear()  # Reset the event for the next notification
+            if calc.mode != decoder.mode and calc.pending is not None:
+                await calc.pending  # Results in flight are decoded in the mode they were sent in
+            decoder.set_mode(calc.mode)
+            # Send data without waiting, the result is printed as soon as its notification arrives
+            try:
+                future = await engine.submit(data)
+            except session.SessionLost as error:
+                print(f"Device was disconnected ({error}), goodbye!")
+                break
+            calc.pending = asyncio.ensure_future(show_result(future))
+
+        if calc.pending is not None:
+            await calc.pending  # Results are answered in order, the last one arrives last
+
+
+async def calculator_benchmark(args, scanner=BleakScanner, client_class=BleakClient, cache=None, tracer=None):
+    """Measure round-trip latency and throughput of the CDS write/notify path."""
+    async with connect_cds(scanner, client_class, cache, tracer) as client:
+        if client is None:
+            no_device_found()
+        cds = client.services.get_service(SERVICE_UUID)
+        write_data = cds.get_characteristic(WRITE_UUID)
+        batch_char = None if args.single_frame else cds.get_characteristic(BATCH_WRITE_UUID)  # None: older firmware
+        results = await benchmark.run_suite(client, write_data, NOTIFY_UUID, args.count, args.modes,
+                                            args.mixes, args.depths, args.timeout, args.verify,
+                                            args.log_results, batch_char, args.notify_timeout, tracer)
+
+    if args.output:
+        transport = {'simulated': args.simulate}
+        if args.simulate:
+            transport.update(interval_ms=args.sim_interval, jitter_ms=args.sim_jitter,
+                             mtu=args.sim_mtu, drop_rate=args.sim_drop,
+                             packets_per_event=args.sim_packets_per_event)
+        benchmark.save(args.output, results, transport)
+
+
+async def calculator_batch(args, scanner=BleakScanner, client_class=BleakClient, cache=None, tracer=None):
+    """Stream operations from a CSV/JSONL file through the device, results go to the output file."""
+    input_file = batch_mode.open_input(args.input)
+    output_file, output_format = batch_mode.open_output(args.output, args.output_format)
+
+    async with cds_session(scanner, client_class, cache, window=args.window, tracer=tracer, args=args) as engine:
+        if engine is None:
+            no_device_found()
+
+        results = None
+        if args.result_cache:
+            results = result_cache.ResultCache(args.result_cache_memory << 20, args.spot_check)
+            results.load(args.result_cache)
+            engine = result_cache.CachedEngine(engine, results)
+
+        writer = batch_mode.ResultWriter(output_file, output_format)
+        operations = batch_mode.read_operations(input_file, batch_mode.MODES[args.mode])
+        await batch_mode.run(engine, operations, writer)
+
+    output_file.flush()
+    print(f"{writer.count} operations, {writer.errors} errors", file=sys.stderr)
+    if results is not None:
+        results.save(args.result_cache)
+        results.print_stats(engine.latency)
+
+
+async def calculator_expression(args, scanner=BleakScanner, client_class=BleakClient, cache=None, tracer=None):
+    """Compile arithmetic expressions into CDS operation graphs and evaluate them on the device."""
+    mode = batch_mode.MODES[args.mode]
+    graph = expression.compile_expressions(expression.read_expressions(args.file, args.expressions), mode)
+
+    decode = notify_path.ResultDecoder(mode).decode
+    async with cds_session(scanner, client_class, cache, window=args.window, decode=decode, tracer=tracer,
+                           args=args) as engine:
+        if engine is None:
+            no_device_found()
+
+        start = time.perf_counter()
+        results = await expression.evaluate(engine, graph)
+        elapsed = time.perf_counter() - start
+
+    for text, result in results:
+        if isinstance(result, expression.ExpressionError):
+            print(f"{text}: error: {result}")
+        else:
+            print(f"{text} = {result!r}")
+    print(f"{len(graph.nodes)} operations in {graph.depth} dependent steps, {elapsed:.3f} s", file=sys.stderr)
+
+
+async def calculator_fanout(args, scanner=BleakScanner, client_class=BleakClient):
+    """Spread a generated workload over every CDS board in range, report per-device throughput."""
+    devices = await find_cds_devices(scanner, args.scan_time, args.devices)
+    if not devices:
+        no_device_found()
+
+    scheduler = fanout.FanoutScheduler(args.window)
+    connected = await scheduler.connect_all(devices, client_class, WRITE_UUID, NOTIFY_UUID, SERVICE_UUID)
+    print(f"Connected to {connected} of {len(devices)} devices")
+
+    frames = benchmark.generate_frames(args.count, benchmark.MODES[args.mode], args.mix)
+    start = time.perf_counter()
+    try:
+        async for _ in scheduler.run(frames):
+            pass
+    except fanout.DeviceDisconnected as error:
+        print("Stopped:", error)
+    scheduler.report(time.perf_counter() - start)
+    await scheduler.disconnect_all()
+
+
+async def calculator_daemon(args, scanner=BleakScanner, client_class=BleakClient, cache=None):
+    """Hold the connection(s) and serve the calculator (and UART) to local clients, see cds_client.py."""
+    if daemon.running(args.socket):
+        print(f"A daemon is already listening on {args.socket}")
+        sys.exit(1)
+    async with contextlib.AsyncExitStack() as stack:
+        engine = await stack.enter_async_context(
+            cds_session(scanner, client_class, cache, window=args.window, args=args))
+        if engine is None:
+            no_device_found()
+        print(f"Connected to {engine.address}", file=sys.stderr)
+
+        uart = None
+        if args.uart:
+            if args.simulate:
+                simulator.add_device(simulator.UartPeripheral(), mtu=args.sim_mtu)
+            client = await stack.enter_async_context(device_cache.connect(
+                daemon.UART_SERVICE_UUID, match_nus_uuid, scanner, client_class, cache))
+            if client is None:
+                print("No device with the Nordic UART Service found.")
+                sys.exit(1)
+            print(f"Connected to UART device {client.address}", file=sys.stderr)
+            uart = daemon.UartLink(client)
+            await uart.start()
+
+        await daemon.Daemon(engine, uart).serve(args.socket)
+
+
+def calculator_load(args):
+    """
+    Drive a generated workload from several processes, one connection each, see loadgen.py.
+    Simulated: one simulated board per worker. Real: one worker per adapter, or per board
+    found on the default adapter.
+    """
+    options = dict(service_uuid=SERVICE_UUID, write_uuid=WRITE_UUID, notify_uuid=NOTIFY_UUID,
+                   batch_write_uuid=None if args.single_frame else BATCH_WRITE_UUID,
+                   window=args.window, retries=args.reconnect_retries, backoff=args.reconnect_backoff,
+                   verify=args.verify, address=None, adapter=None, simulator=None)
+    if args.simulate:
+        # Every worker registers its own simulated board, see loadgen._transport()
+        options['simulator'] = dict(single_frame=args.sim_single_frame, interval=args.sim_interval,
+                                    jitter=args.sim_jitter, mtu=args.sim_mtu, drop=args.sim_drop,
+                                    link_loss=args.sim_link_loss, packets_per_event=args.sim_packets_per_event,
+                                    seed=args.sim_seed)
+        configs = [dict(options, index=i, name=f"sim{i}") for i in range(args.workers)]
+    else:
+        adapters = args.adapters or [None] * args.workers
+        devices = asyncio.run(find_cds_devices(BleakScanner, args.scan_time, len(adapters)))
+        if not devices:
+            no_device_found()
+        if len(devices) < len(adapters):
+            print(f"Found {len(devices)} boards for {len(adapters)} workers")
+        configs = [dict(options, index=i, name=adapter or f"board{i}", adapter=adapter, address=device.address)
+                   for i, (adapter, device) in enumerate(zip(adapters, devices))]
+
+    generator = loadgen.LoadGenerator(configs)
+    try:
+        generator.run(benchmark.generate_frames(args.count, benchmark.MODES[args.mode], args.mix))
+    except RuntimeError as error:  # A worker failed or died, its share of the load was not sent
+        print(f"\nLoad aborted: {error}", file=sys.stderr)
+        sys.exit(1)
+    generator.print_report()
+
+
+def transport(args, session_recorder=None):
+    """
+    Scanner and client classes selected on the command line: real BLE, the local simulator
+    or a replayed log. With a recorder.Recorder every write and notification is recorded.
+    """
+    if getattr(args, "replay", None):
+        scanner, client_class = recorder.replay_transport(args)
+    elif args.simulate:
+        simulator.setup(args)
+        scanner, client_class = simulator.SimulatedScanner, simulator.SimulatedClient
+    else:
+        scanner, client_class = BleakScanner, BleakClient
+    if session_recorder is not None:
+        client_class = recorder.recording_client(client_class, session_recorder)
+    return scanner, client_class
+
+
+def cache(args):
+    """Device cache selected on the command line, simulated devices get their own cache file."""
+    simulated = args.simulate or getattr(args, "replay", None)
+    return device_cache.from_args(args, "simulated" if simulated else "devices")
+
+
+def shared_options(add_arguments):
+    """
+    Parser to pass as a parent to the subcommands, for an option group the top-level parser also has.
+    Its defaults are suppressed, so "--simulate bench" and "bench --simulate" both keep --simulate:
+    otherwise the defaults of the subcommand overwrite the options given before it.
+    """
+    options = argparse.ArgumentParser(add_help=False)
+    add_arguments(options)
+    for action in options._actions:
+        action.default = argparse.SUPPRESS
+    return options
 
 
 if __name__ == "__main__":
+    # The top-level parser has the options of the interactive terminal (the default command) and their defaults
+    parser = argparse.ArgumentParser(description="CDS Service Test Tool")
+    simulator.add_arguments(parser)
+    device_cache.add_arguments(parser)
+    tracing.add_arguments(parser)
+    recorder.add_arguments(parser)
+    session.add_arguments(parser)
+    parser.set_defaults(command="terminal")
+    commands = parser.add_subparsers(dest="command")
+
+    simulated = shared_options(simulator.add_arguments)
+    cached = shared_options(device_cache.add_arguments)
+    traced = shared_options(tracing.add_arguments)
+    recorded = shared_options(recorder.add_arguments)
+    reconnecting = shared_options(session.add_arguments)
+
+    commands.add_parser("terminal", parents=[simulated, cached, recorded, reconnecting, traced],
+                        help="interactive calculator (default)")
+
+    bench_parser = commands.add_parser("bench", parents=[simulated, cached, recorded, traced],
+                                       help="round-trip latency and throughput benchmark")
+    benchmark.add_arguments(bench_parser)
+
+    batch_parser = commands.add_parser("batch", parents=[simulated, cached, recorded, reconnecting, traced],
+                                       help="stream operations from a CSV/JSONL file")
+    batch_mode.add_arguments(batch_parser)
+    result_cache.add_arguments(batch_parser)
+
+    expr_parser = commands.add_parser("expr", parents=[simulated, cached, recorded, reconnecting, traced],
+                                      help="evaluate arithmetic expressions as parallel operation graphs")
+    expression.add_arguments(expr_parser)
+
+    fanout_parser = commands.add_parser("fanout", parents=[simulated],
+                                        help="spread a workload over all CDS boards in range")
+    fanout_parser.add_argument("-n", "--count", type=int, default=10000, help="number of operations")
+    fanout_parser.add_argument("--mode", choices=sorted(benchmark.MODES), default='float')
+    fanout_parser.add_argument("--mix", choices=sorted(benchmark.MIXES), default='mixed')
+    fanout_parser.add_argument("--window", type=int, default=16, help="operations in flight per device")
+    fanout_parser.add_argument("--scan-time", type=float, default=5.0, help="maximum scan duration in seconds")
+    fanout_parser.add_argument("--devices", type=int, metavar="<n>",
+                               help="stop scanning as soon as this many boards were found")
+
+    daemon_parser = commands.add_parser("daemon", parents=[simulated, cached, recorded, reconnecting],
+                                        help="hold the BLE link and serve local clients (cds_client.py)")
+    daemon.add_arguments(daemon_parser)
+
+    load_parser = commands.add_parser("load", parents=[simulated, reconnecting],
+                                      help="multi-process load generator, one connection per process")
+    loadgen.add_arguments(load_parser)
+
+    args = parser.parse_args()
+    if args.trace and args.command not in ("terminal", "bench", "batch", "expr"):
+        parser.error(f"--trace is not supported by the {args.command} command")
+    tracer = tracing.from_args(args)
+    session_recorder = recorder.from_args(args)
+
     try:
-        asyncio.run(calculator_terminal())
+        if args.command == "bench":
+            asyncio.run(calculator_benchmark(args, *transport(args, session_recorder), cache(args), tracer))
+        elif args.command == "load":
+            calculator_load(args)
+        elif args.command == "fanout":
+            asyncio.run(calculator_fanout(args, *transport(args)))
+        elif args.command == "expr":
+            asyncio.run(calculator_expression(args, *transport(args, session_recorder), cache(args), tracer))
+        elif args.command == "daemon":
+            asyncio.run(calculator_daemon(args, *transport(args, session_recorder), cache(args)))
+        elif args.command == "batch":
+            asyncio.run(calculator_batch(args, *transport(args, session_recorder), cache(args), tracer))
+        else:
+            asyncio.run(calculator_terminal(*transport(args, session_recorder), cache(args), tracer, args))
     except asyncio.CancelledError:
         # Task is cancelled on disconnect, so we ignore this error
         pass
+    except KeyboardInterrupt:
+        pass  # The usual way to stop the daemon
+    finally:
+        if tracer is not None:
+            tracer.export(args.trace, args.trace_format)
+            tracer.print_summary()
+        if session_recorder is not None:
+            session_recorder.close()
+        recorder.print_replay_report()
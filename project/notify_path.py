@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+
+"""
+notify_path.py
+-------------
+Print-free hot path for result notifications.
+ResultDecoder reads the result straight out of the notification buffer with a
+precompiled struct.Struct chosen once per mode (no format string parsing, no
+mode check and no copy per packet). ResultLogger collects decoded results in a
+preallocated ring buffer that a background task drains to a file, so terminal
+or disk I/O never runs inside the bleak callback.
+---------
+"""
+import asyncio
+import struct
+import sys
+from array import array
+
+import calculator  # calculator.py
+
+RESULT_FLOAT = calculator.RESULT_FLOAT
+RESULT_Q31 = calculator.RESULT_Q31
+Q31_SCALE = 1.0 / (1 << 31)
+
+
+class ResultDecoder:
+    def __init__(self, mode=calculator.FLOAT_MODE):
+        self.mode = None
+        self.set_mode(mode)
+
+    def set_mode(self, mode):
+        """Select the decoder of *mode*, does nothing if it is already selected."""
+        if mode == self.mode:
+            return
+        self.mode = mode
+        if mode == calculator.FLOAT_MODE:
+            self._unpack_from = RESULT_FLOAT.unpack_from
+            self._scale = 1.0
+        else:
+            self._unpack_from = RESULT_Q31.unpack_from
+            self._scale = Q31_SCALE
+
+    def decode(self, data):
+        """
+        Decode one result notification. unpack_from() reads the bytearray through
+        the buffer protocol, i.e. the same zero-copy access a memoryview gives.
+        """
+        return self._unpack_from(data)[0] * self._scale
+
+
+class ResultRing:
+    """Preallocated ring buffer of float results. When it is full the oldest results are overwritten."""
+    def __init__(self, capacity=1 << 16):
+        self.capacity = capacity
+        self.values = array('d', bytes(8 * capacity))
+        self.head = 0  # Total number of results pushed
+        self.tail = 0  # Total number of results drained
+        self.overwritten = 0
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def push(self, value):
+        self.values[self.head % self.capacity] = value
+        self.head += 1
+        if self.head - self.tail > self.capacity:
+            self.tail += 1
+            self.overwritten += 1
+
+    def drain(self):
+        """Returns the sequence number of the first result and the results pushed since the last drain."""
+        first, count = self.tail, self.head - self.tail
+        start = first % self.capacity
+        if start + count <= self.capacity:
+            values = self.values[start:start + count]
+        else:
+            values = self.values[start:] + self.values[:start + count - self.capacity]
+        self.tail = self.head
+        return first, values
+
+
+class ResultLogger:
+    """
+    Background writer of decoded results. push() only stores the value in the ring,
+    the writer task formats and writes everything collected every *interval* seconds.
+    """
+    def __init__(self, file=sys.stdout, capacity=1 << 16, interval=0.05):
+        self.file = file
+        self.ring = ResultRing(capacity)
+        self.interval = interval
+        self.push = self.ring.push  # Bound once, called for every notification
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._writer())
+
+    async def stop(self):
+        """Write the remaining results and stop the writer task."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._flush()
+
+    async def _writer(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._flush()
+
+    async def _flush(self):
+        if not len(self.ring):
+            return
+        first, values = self.ring.drain()
+        text = ''.join([f"{first + i}\t{value!r}\n" for i, value in enumerate(values)])
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._write, text)
+
+    def _write(self, text):
+        self.file.write(text)
+        self.file.flush()
+
+
+def benchmark(count=1_000_000):
+    """Per-notification cost of the old handle_notification() against the hot path."""
+    import io
+    import time
+
+    class Calc:
+        mode = calculator.FIXED_MODE
+        result = 0
+
+    calc = Calc()
+    sink = io.StringIO()
+    packets = [bytearray(RESULT_Q31.pack(i)) for i in range(1000)]
+
+    def old_handle_notification(_, data):
+        # The decoding of the original callback in main.py, printing to a memory buffer
+        if calc.mode == 0:
+            result = struct.unpack('f', data)[0]
+        elif calc.mode == 1:
+            result = struct.unpack('i', data)[0]
+            result = result / float(1 << 31)
+        print("--------> Received operation result:", result, file=sink)
+        calc.result = result
+
+    decoder = ResultDecoder(calculator.FIXED_MODE)
+    ring = ResultRing()
+    decode, push = decoder.decode, ring.push
+
+    def new_handle_notification(_, data):
+        push(decode(data))
+
+    for name, handler in (("print + struct.unpack", old_handle_notification),
+                          ("decoder + ring buffer", new_handle_notification)):
+        start = time.perf_counter()
+        for i in range(count):
+            handler(None, packets[i % 1000])
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed / count * 1e9:8.1f} ns per notification")
+        sink.seek(0)
+        sink.truncate()
+
+
+# Guard condition to check if the module is being run directly
+if __name__ == "__main__":
+    print("** microbenchmark: notify_path.py **")
+    benchmark()
@@ -0,0 +1,341 @@
+#!/usr/bin/python3
+
+"""
+pipeline.py
+-------------
+Pipelined request engine for the Calculator Data Service (CDS).
+Keeps a window of calculator_task writes in flight instead of waiting for every
+notification before the next write. The firmware answers tasks in the order it
+received them, so notifications are matched to requests in FIFO order.
+Firmware with batched framing takes several tasks per write and answers them
+with one notification carrying one 4 byte result per task (see set_batching()).
+The protocol has no sequence numbers: a lost notification shifts the matching of
+every later request by one until the device stops answering, the optional
+timeout then fails the requests left over (see NotificationLost).
+---------
+"""
+import asyncio
+import time
+from collections import deque
+
+import calculator  # calculator.py
+
+TASK_SIZE = calculator.TASK.size  # Packed calculator_task
+RESULT_SIZE = calculator.RESULT_FLOAT.size  # One result in a notification
+
+
+class NotificationLost(TimeoutError):
+    """
+    No notification came for the requests in flight within the timeout of the engine.
+    At least one notification was lost, so the results matched since that loss may
+    belong to the next request.
+    """
+
+
+class RequestEngine:
+    def __init__(self, write, window=1, decode=bytes, timeout=None):
+        """
+        write:  coroutine function sending one packed calculator_task to the device,
+                e.g. lambda data: client.write_gatt_char(char, data, response=False)
+        window: number of requests allowed in flight before submit() waits (backpressure)
+        decode: converts the notification buffer to the result of the request, the default
+                copies the raw bytes, a notify_path.ResultDecoder decodes it in place
+        timeout: seconds without any notification while requests are in flight after which they
+                 fail with NotificationLost, so the window is empty and in sync again (None: wait
+                 forever, e.g. while a session waits for a reconnect to resend them)
+        """
+        if window < 1:
+            raise ValueError("window must be at least 1")
+        self.write = write
+        self.window = window
+        self.decode = decode
+        self.pending = deque()  # Futures waiting for a notification, oldest first
+        self.frames = deque()  # The data sent for each of them, for resend()
+        self._slots = asyncio.Semaphore(window)
+        self._write_lock = asyncio.Lock()  # Keeps the order of self.pending equal to the order on air
+        self.write_batch = None  # Coroutine function sending several concatenated tasks, see set_batching()
+        self.max_tasks = 1
+        self._outbox = deque()  # (future, data) submitted but not written yet in batched mode
+        self._flusher = None
+        self.timeout = timeout
+        self.desyncs = 0  # Number of times the requests in flight failed with NotificationLost
+        self._activity = 0.0  # time.monotonic() of the last notification, or of the first request in flight
+        self._watchdog = None
+
+    def set_batching(self, write_batch, max_tasks=1):
+        """
+        Send up to *max_tasks* tasks per write with *write_batch* (a coroutine function taking the
+        concatenated tasks), the firmware answers every write with one notification holding one
+        result per task. Tasks submitted in the same event loop iteration share a write.
+        write_batch=None (or max_tasks < 2) sends every task on its own, for older firmware.
+        """
+        if max_tasks < 2:
+            write_batch = None
+        self.write_batch = write_batch
+        self.max_tasks = max_tasks if write_batch is not None else 1
+
+    @property
+    def in_flight(self):
+        return len(self.pending)
+
+    async def submit(self, data):
+        """
+        Send one packed calculator_task. Waits while the window is full.
+        Returns a future resolved with the (decoded) notification of this request.
+        """
+        await self._slots.acquire()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self.pending:
+            self._activity = time.monotonic()
+        if self.timeout is not None and self._watchdog is None:
+            self._watchdog = loop.call_later(self.timeout, self._check_timeout)
+        if self.write_batch is not None:
+            self.pending.append(future)
+            self.frames.append(data)
+            self._outbox.append((future, data))
+            if self._flusher is None:
+                self._flusher = asyncio.ensure_future(self._flush())
+            return future
+        async with self._write_lock:
+            self.pending.append(future)
+            self.frames.append(data)
+            try:
+                await self.write(data)
+            except BaseException:
+                self._forget(future)  # Nothing went on air, so no notification will come for this request
+                future.cancel()
+                raise
+        return future
+
+    async def _flush(self):
+        """Write the tasks of the outbox, up to max_tasks per write."""
+        try:
+            await asyncio.sleep(0)  # Let the other submits of this event loop iteration join
+            async with self._write_lock:
+                while self._outbox:
+                    batch = [self._outbox.popleft() for _ in range(min(self.max_tasks, len(self._outbox)))]
+                    try:
+                        if self.write_batch is not None:
+                            await self.write_batch(b''.join(data for _, data in batch))
+                        else:  # Batching was turned off meanwhile
+                            for _, data in batch:
+                                await self.write(data)
+                    except Exception as error:
+                        self._drop(batch, error)
+        finally:
+            self._flusher = None
+
+    def _drop(self, batch, error):
+        """Nothing of *batch* went on air, so no notification will come for it."""
+        for future, _ in batch:
+            self._forget(future)
+            if not future.done():
+                future.set_exception(error)
+
+    def _forget(self, future):
+        """Remove a request that was not sent, unless fail_pending() removed it during the write."""
+        try:
+            index = self.pending.index(future)
+        except ValueError:
+            return  # Its slot was released by fail_pending()
+        del self.pending[index]
+        del self.frames[index]
+        self._slots.release()
+
+    def _check_timeout(self):
+        """Fail the requests in flight if no notification came for them within the timeout."""
+        self._watchdog = None
+        if not self.pending:
+            return
+        remaining = self._activity + self.timeout - time.monotonic()
+        if remaining > 0:
+            self._watchdog = asyncio.get_running_loop().call_later(remaining, self._check_timeout)
+            return
+        self.desyncs += 1
+        self.fail_pending(NotificationLost(f"no notification for {len(self.pending)} requests "
+                                           f"within {self.timeout} s"))
+
+    async def request(self, data):
+        """Send one packed calculator_task and wait for its (decoded) result."""
+        return await (await self.submit(data))
+
+    async def map(self, frames):
+        """
+        Send every frame from *frames* keeping the window full.
+        Yields the (decoded) results in the order of *frames*.
+        """
+        futures = deque()
+        for data in frames:
+            if len(futures) >= self.window:
+                yield await futures.popleft()
+            futures.append(await self.submit(data))
+        while futures:
+            yield await futures.popleft()
+
+    def handle_notification(self, _, data: bytearray):
+        """Notification callback for BleakClient.start_notify()."""
+        self._activity = time.monotonic()
+        if len(data) <= RESULT_SIZE:
+            self._resolve(data)
+            return
+        view = memoryview(data)  # Batched results, one per task of the write
+        for offset in range(0, len(data), RESULT_SIZE):
+            self._resolve(view[offset:offset + RESULT_SIZE])
+
+    def _resolve(self, data):
+        if not self.pending:
+            return  # Unsolicited notification, nobody is waiting for it
+        try:
+            result, error = self.decode(data), None
+        except Exception as exc:  # A short or malformed notification, e.g. struct.error
+            result, error = None, exc
+        future = self.pending.popleft()
+        self.frames.popleft()
+        self._slots.release()
+        if future.done():
+            return  # The caller may have given up on (cancelled) this request
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def fail_pending(self, exc):
+        """
+        Fail every request still waiting for a notification, e.g. after a disconnect
+        or a lost notification (FIFO matching is not possible anymore in that case).
+        """
+        self._outbox.clear()
+        while self.pending:
+            future = self.pending.popleft()
+            self.frames.popleft()
+            self._slots.release()
+            if not future.done():
+                future.set_exception(exc)
+
+    async def resend(self, before=None):
+        """
+        Send the data of every request still waiting for a notification again, oldest first,
+        e.g. after a reconnect. Returns the number of requests sent again.
+        before() is called once no other write can come first, e.g. to mark the link as usable.
+        """
+        async with self._write_lock:
+            if before is not None:
+                before()
+            self._activity = time.monotonic()  # The timeout starts again for the requests sent again
+            self._outbox.clear()  # Sent below with everything else
+            frames = list(self.frames)
+            if self.write_batch is not None:
+                for start in range(0, len(frames), self.max_tasks):
+                    await self.write_batch(b''.join(frames[start:start + self.max_tasks]))
+            else:
+                for data in frames:
+                    await self.write(data)
+            return len(frames)
+
+
+def self_test(count=2000, window=8):
+    """
+    Check FIFO matching, backpressure, batching, resend, failed writes and the timeout
+    after a lost notification against the simulated peripheral.
+    """
+    import random
+
+    import simulator  # simulator.py
+
+    rng = random.Random(1)
+    frames = [calculator.pack_task(rng.randint(1, 3), rng.uniform(-0.5, 0.5), rng.uniform(-0.5, 0.5),
+                                   rng.choice((calculator.FLOAT_MODE, calculator.FIXED_MODE))) for _ in range(count)]
+    model = simulator.CalculatorPeripheral()
+    expected = [model.execute(data) for data in frames]
+
+    async def connect(device, engine):
+        client = simulator.SimulatedClient(device)
+        await client.connect()
+        await client.start_notify(simulator.NOTIFY_UUID, engine.handle_notification)
+        return client
+
+    async def run(batching=False, drop_at=None):
+        device = simulator.add_device(simulator.CalculatorPeripheral(), connect_time=0.001, jitter=0.002,
+                                      connection_interval=0.001)
+        link = {'up': True}
+
+        async def write(data):
+            if link['up']:  # While the link is down requests are kept for resend(), like session.py does
+                await link['client'].write_gatt_char(simulator.WRITE_UUID, data, response=False)
+
+        async def write_batch(data):
+            if link['up']:
+                await link['client'].write_gatt_char(simulator.BATCH_WRITE_UUID, data, response=False)
+
+        engine = RequestEngine(write, window)
+        if batching:
+            engine.set_batching(write_batch, window)
+        link['client'] = await connect(device, engine)
+        futures = []
+        for i, data in enumerate(frames):
+            futures.append(await engine.submit(data))
+            assert engine.in_flight <= window, f"{engine.in_flight} requests in flight, window {window}"
+            if i == drop_at:
+                link['up'] = False
+                device.drop_connection()  # Everything on air is lost
+                client = await connect(device, engine)
+                resent = await engine.resend(before=lambda: link.update(up=True, client=client))
+                assert resent > 0, "nothing was in flight at the link loss"
+        results = await asyncio.wait_for(asyncio.gather(*futures), 30)
+        assert results == expected, "results were not matched to their requests"
+
+    async def failed_write():
+        """fail_pending() during a write: submit() raises the write error, the window is intact."""
+        written = asyncio.Event()
+
+        async def write(data):
+            written.set()
+            await asyncio.sleep(0.01)
+            raise ConnectionError("write failed")
+
+        engine = RequestEngine(write, 1)
+        submit = asyncio.ensure_future(engine.submit(frames[0]))
+        await written.wait()
+        engine.fail_pending(ConnectionError("disconnected"))
+        try:
+            await submit
+        except ConnectionError as error:
+            assert str(error) == "write failed", error
+        assert engine.in_flight == 0 and not engine._slots.locked(), "window slot lost"
+        await engine._slots.acquire()
+        assert engine._slots.locked(), "window slot released twice"
+
+    async def lost_notification():
+        """A task lost on air: the requests left over fail after the timeout, the next ones match again."""
+        device = simulator.add_device(simulator.CalculatorPeripheral(), connection_interval=0.001)
+        sent = []
+
+        async def write(data):
+            sent.append(data)
+            if len(sent) != 5:  # The fifth task never reaches the device
+                await client.write_gatt_char(simulator.WRITE_UUID, data, response=False)
+
+        engine = RequestEngine(write, window, timeout=0.2)
+        client = await connect(device, engine)
+        futures = [await engine.submit(data) for data in frames[:20]]
+        await asyncio.gather(*futures, return_exceptions=True)
+        assert engine.desyncs == 1 and engine.in_flight == 0, "the lost notification was not detected"
+        assert isinstance(futures[-1].exception(), NotificationLost), futures[-1]
+        results = await asyncio.wait_for(asyncio.gather(*[await engine.submit(data) for data in frames[20:40]]), 5)
+        assert results == expected[20:40], "the window was not in sync after the timeout"
+
+    for name, test in (("FIFO matching and backpressure", run()),
+                       ("batched framing", run(batching=True)),
+                       ("resend after a link loss", run(drop_at=count // 2)),
+                       ("batched resend after a link loss", run(batching=True, drop_at=count // 2)),
+                       ("failed write after fail_pending()", failed_write()),
+                       ("timeout after a lost notification", lost_notification())):
+        asyncio.run(test)
+        print(f"{name}: ok")
+
+
+# Guard condition to check if the module is being run directly
+if __name__ == "__main__":
+    print("** self test: pipeline.py **")
+    self_test()
@@ -0,0 +1,344 @@
+#!/usr/bin/python3
+
+"""
+recorder.py
+-------------
+Binary GATT session recorder and replay engine.
+Recorder appends every write and notification with a monotonic timestamp to a
+compact binary log. SessionLog reads the log through mmap with a sparse index,
+so multi-gigabyte logs can be indexed and sliced without loading them.
+Recorded sessions are replayed either straight into handlers (replay()) or by
+a simulated device (ReplayPeripheral) that answers the tool's writes with the
+recorded notifications, at real-time, accelerated or as-fast-as-possible speed.
+
+Log format (little endian):
+MAGIC, then records of  int64 timestamp ns | uint8 kind | uint8 channel | uint16 length | data
+SESSION records start a session (timestamps restart at 0, data: float64 wall clock time),
+CHANNEL records define a channel of the session (data: "service_uuid char_uuid"),
+WRITE/NOTIFY records are the frames.
+---------
+"""
+import asyncio
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from collections import namedtuple
+
+import simulator  # simulator.py
+
+MAGIC = b'GATTLOG1'
+HEADER = struct.Struct('<qBBH')
+WALL_CLOCK = struct.Struct('<d')
+SESSION, CHANNEL, WRITE, NOTIFY = range(4)
+INDEX_STRIDE = 256  # Frames between two entries of the sparse index
+
+Frame = namedtuple('Frame', 'timestamp kind service_uuid char_uuid data')  # data is a memoryview into the log
+Session = namedtuple('Session', 'start stop wall_clock channels')  # Frame numbers [start, stop)
+
+
+class Recorder:
+    def __init__(self, path):
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab', buffering=1 << 20)
+        if new:
+            self.file.write(MAGIC)
+        self.clock = time.monotonic_ns
+        self.started = self.clock()
+        self.channels = {}  # (service uuid, characteristic uuid) -> channel number
+        self.frames = 0
+        self._append(SESSION, 0, WALL_CLOCK.pack(time.time()))
+
+    def _append(self, kind, channel, data):
+        self.file.write(HEADER.pack(self.clock() - self.started, kind, channel, len(data)))
+        self.file.write(data)
+
+    def channel(self, service_uuid, char_uuid):
+        key = (service_uuid.lower(), char_uuid.lower())
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = self.channels[key] = len(self.channels)
+            self._append(CHANNEL, channel, f"{key[0]} {key[1]}".encode())
+        return channel
+
+    def write(self, service_uuid, char_uuid, data):
+        self._append(WRITE, self.channel(service_uuid, char_uuid), data)
+        self.frames += 1
+
+    def notification(self, service_uuid, char_uuid, data):
+        self._append(NOTIFY, self.channel(service_uuid, char_uuid), data)
+        self.frames += 1
+
+    def wrap_notify(self, service_uuid, char_uuid, callback):
+        """Recording version of a notification callback."""
+        channel = self.channel(service_uuid, char_uuid)
+
+        def recorded_notify(sender, data):
+            self._append(NOTIFY, channel, data)
+            self.frames += 1
+            callback(sender, data)
+        return recorded_notify
+
+    def close(self):
+        self.file.close()
+
+
+def recording_client(client_class, recorder):
+    """Subclass of *client_class* (BleakClient or a stand-in) recording every write and notification."""
+    class RecordingClient(client_class):
+        def _recorded_characteristic(self, char_specifier):
+            if hasattr(char_specifier, 'uuid'):
+                return char_specifier
+            return self.services.get_characteristic(char_specifier)
+
+        async def write_gatt_char(self, char_specifier, data, response=None):
+            char = self._recorded_characteristic(char_specifier)
+            recorder.write(char.service_uuid, char.uuid, data)
+            return await super().write_gatt_char(char_specifier, data, response)
+
+        async def start_notify(self, char_specifier, callback, **kwargs):
+            char = self._recorded_characteristic(char_specifier)
+            callback = recorder.wrap_notify(char.service_uuid, char.uuid, callback)
+            return await super().start_notify(char_specifier, callback, **kwargs)
+
+    return RecordingClient
+
+
+class SessionLog:
+    """
+    Memory-mapped reader of a recorded log. Frames are numbered over all sessions;
+    the index keeps the offset of every INDEX_STRIDE-th frame only.
+    Frame data are memoryviews into the map, copy them to keep them after close().
+    """
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a GATT session log")
+        self.offsets = array('Q')  # Offset of frame number i * INDEX_STRIDE
+        self.times = array('q')  # Its timestamp
+        self.sessions = []
+        self.count = 0
+        self._index()
+
+    def _index(self):
+        offset, end, frames = len(MAGIC), len(self.map), 0
+        start, wall_clock, channels = 0, None, {}
+        unpack_from, size = HEADER.unpack_from, HEADER.size
+        while offset + size <= end:
+            timestamp, kind, channel, length = unpack_from(self.map, offset)
+            if offset + size + length > end:
+                break  # Cut off by a crash, ignore the incomplete record
+            if kind == SESSION:
+                if wall_clock is not None:
+                    self.sessions.append(Session(start, frames, wall_clock, channels))
+                start, channels = frames, {}
+                wall_clock = WALL_CLOCK.unpack_from(self.map, offset + size)[0]
+            elif kind == CHANNEL:
+                service_uuid, char_uuid = bytes(self.map[offset + size:offset + size + length]).decode().split()
+                channels[channel] = (service_uuid, char_uuid)
+            else:
+                if frames % INDEX_STRIDE == 0:
+                    self.offsets.append(offset)
+                    self.times.append(timestamp)
+                frames += 1
+            offset += size + length
+        if wall_clock is not None:
+            self.sessions.append(Session(start, frames, wall_clock, channels))
+        self.count = frames
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, number):
+        if number < 0:
+            number += self.count
+        if not 0 <= number < self.count:
+            raise IndexError("frame number out of range")
+        return next(self.frames(number, number + 1))
+
+    def session_of(self, number):
+        for session in self.sessions:
+            if session.start <= number < session.stop:
+                return session
+        return None
+
+    def frames(self, start=0, stop=None):
+        """Frames number *start* to *stop* (exclusive), read from the map while iterating."""
+        stop = self.count if stop is None else min(stop, self.count)
+        if start >= stop:
+            return
+        session = self.session_of(start)
+        channels = session.channels
+        number = start - start % INDEX_STRIDE
+        offset = self.offsets[start // INDEX_STRIDE]
+        unpack_from, size, data = HEADER.unpack_from, HEADER.size, memoryview(self.map)
+        while number < stop:
+            timestamp, kind, channel, length = unpack_from(self.map, offset)
+            if kind == SESSION:
+                session = self.session_of(number)
+                channels = session.channels
+            elif kind == CHANNEL:
+                pass  # Already known from the index
+            else:
+                if number >= start:
+                    service_uuid, char_uuid = channels[channel]
+                    yield Frame(timestamp, kind, service_uuid, char_uuid, data[offset + size:offset + size + length])
+                number += 1
+            offset += size + length
+
+    def session_frames(self, session=0):
+        """Frames of one session (negative numbers count from the last one)."""
+        session = self.sessions[session]
+        return self.frames(session.start, session.stop)
+
+    def find_time(self, session, seconds):
+        """Number of the first frame of *session* recorded at or after *seconds* from its start."""
+        session = self.sessions[session]
+        target = int(seconds * 1e9)
+        # Binary search over the index entries of the session, then a short walk
+        low, high = -(-session.start // INDEX_STRIDE), (session.stop - 1) // INDEX_STRIDE + 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[middle] < target:
+                low = middle + 1
+            else:
+                high = middle
+        first = max(session.start, (low - 1) * INDEX_STRIDE)
+        for number, frame in enumerate(self.frames(first, session.stop), first):
+            if frame.timestamp >= target:
+                return number
+        return session.stop
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+
+async def replay(frames, on_write=None, on_notify=None, speed=1.0):
+    """
+    Feed recorded *frames* to the handlers: on_write(char_uuid, data) and on_notify(char_uuid, data),
+    the notification callback signature of bleak. *speed* 1 is real time, 10 ten times faster,
+    0 as fast as possible. Returns (frames replayed, elapsed seconds).
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    first = None
+    count = 0
+    for frame in frames:
+        if first is None:
+            first = frame.timestamp
+        if speed:
+            delay = start + (frame.timestamp - first) / 1e9 / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        handler = on_write if frame.kind == WRITE else on_notify
+        if handler is not None:
+            handler(frame.char_uuid, bytearray(frame.data))
+        count += 1
+    return count, loop.time() - start
+
+
+class ReplayPeripheral(simulator.SimulatedPeripheral):
+    """
+    Simulated firmware answering every write with the notifications recorded after the
+    matching write of the session, delayed as recorded (divided by *speed*, 0 = no delay).
+    Writes that differ from the recording are counted as mismatches (regressions).
+    Only the characteristics used in the session exist, so the tool falls back to single
+    tasks per write when replaying a session recorded without batched framing.
+    """
+    NAME = "Replay"
+
+    def __init__(self, log, session=0, speed=1.0):
+        self.SERVICES = {}
+        for service_uuid, char_uuid in log.sessions[session].channels.values():
+            self.SERVICES.setdefault(service_uuid, []).append(char_uuid)
+        # The session was recorded with batched framing if the batch characteristic was used
+        self.batched = any(simulator.BATCH_WRITE_UUID.lower() in chars for chars in self.SERVICES.values())
+        self.speed = speed
+        self._frames = log.session_frames(session)
+        self._next = next(self._frames, None)
+        self.writes = 0
+        self.mismatches = 0
+        self.unrecorded = 0  # Writes beyond the end of the recording
+        self.skipped = 0  # Recorded notifications without a write before them
+
+    def _advance(self):
+        frame, self._next = self._next, next(self._frames, None)
+        return frame
+
+    def on_write(self, char_uuid, data, now):
+        self.writes += 1
+        while self._next is not None and self._next.kind != WRITE:
+            self._advance()
+            self.skipped += 1
+        write = self._advance()
+        if write is None:
+            self.unrecorded += 1
+            return []
+        if write.char_uuid != char_uuid or write.data != data:
+            self.mismatches += 1
+        responses = []
+        while self._next is not None and self._next.kind == NOTIFY:
+            frame = self._advance()
+            delay = (frame.timestamp - write.timestamp) / 1e9 / self.speed if self.speed else 0.0
+            responses.append((frame.char_uuid, bytes(frame.data), delay))
+        return responses
+
+
+def replay_transport(args):
+    """Register a simulated device replaying --replay, returns the simulated scanner and client classes."""
+    log = SessionLog(args.replay)
+    peripheral = ReplayPeripheral(log, args.replay_session, args.replay_speed)
+    if peripheral.batched and getattr(args, 'single_frame', False):
+        sys.exit(f"error: {args.replay} was recorded with batched framing, replay it without --single-frame")
+    simulator.add_device(peripheral, connection_interval=0)
+    return simulator.SimulatedScanner, simulator.SimulatedClient
+
+
+def print_replay_report(file=sys.stderr):
+    for device in simulator.devices:
+        peripheral = device.peripheral
+        if isinstance(peripheral, ReplayPeripheral):
+            print(f"replay: {peripheral.writes} writes, {peripheral.mismatches} differ from the recording, "
+                  f"{peripheral.unrecorded} beyond its end", file=file)
+
+
+def add_arguments(parser):
+    """Add the session recording and replay command line options to an argparse parser."""
+    group = parser.add_argument_group("session recording")
+    group.add_argument("--record", metavar="<file>", help="append every write and notification to this log")
+    group.add_argument("--replay", metavar="<file>", help="replay a recorded log instead of using a device")
+    group.add_argument("--replay-session", type=int, default=-1, metavar="<n>",
+                       help="session of the log to replay (default: the last one)")
+    group.add_argument("--replay-speed", type=float, default=1.0, metavar="<factor>",
+                       help="1 is real time, 10 ten times faster, 0 as fast as possible")
+
+
+def from_args(args):
+    """Recorder selected on the command line, None if recording is disabled."""
+    if not getattr(args, 'record', None):
+        return None
+    return Recorder(args.record)
+
+
+def info(path):
+    log = SessionLog(path)
+    print(f"{path}: {len(log)} frames in {len(log.sessions)} sessions")
+    for number, session in enumerate(log.sessions):
+        frames = session.stop - session.start
+        duration = log[session.stop - 1].timestamp / 1e9 if frames else 0.0
+        started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(session.wall_clock))
+        print(f"  session {number}: {started}, {frames} frames, {duration:.3f} s, "
+              f"channels {sorted(char_uuid for _, char_uuid in session.channels.values())}")
+    log.close()
+
+
+# Guard condition to check if the module is being run directly
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        info(path)
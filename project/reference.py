@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+
+"""
+reference.py
+-------------
+Bit-exact local reference model of the calculator firmware and bulk verifier
+of device results.
+The model reproduces the float32 and Q31 add/sub/mul/div of the firmware
+(same semantics as simulator.calculate_float()/calculate_q31()) on whole
+NumPy arrays, so millions of returned results can be checked at once.
+The verifier reports the error distribution in ULPs (float) or LSBs (Q31)
+and the worst-case inputs.
+---------
+"""
+import numpy as np
+
+import batch_codec  # batch_codec.py
+import calculator  # calculator.py
+
+Q31_MIN = batch_codec.Q31_MIN
+Q31_MAX = batch_codec.Q31_MAX
+
+# Upper bounds of the error histogram buckets: 0, 1, 2, 4, 8, ... ULP/LSB
+ERROR_BUCKETS = np.array([0] + [1 << i for i in range(32)], dtype=np.int64)
+
+
+def expected_float(operation, a, b):
+    """Float32 results of the firmware. Operands are float32 arrays."""
+    with np.errstate(all='ignore'):
+        a = a.astype(np.float64)
+        b = b.astype(np.float64)
+        # Float64 is wide enough that rounding it to float32 gives the correctly rounded float32 result
+        result = np.select([operation == 1, operation == 2, operation == 3, operation == 4],
+                           [a + b, a - b, a * b, a / b], 0.0)
+        return result.astype(np.float32)
+
+
+def expected_q31(operation, a, b):
+    """Q31 results of the firmware. Operands are int32 arrays."""
+    a = a.astype(np.int64)
+    b = b.astype(np.int64)
+    b_nonzero = np.where(b == 0, 1, b)
+    quotient = (np.abs(a) << 31) // np.abs(b_nonzero)
+    quotient = np.where((a < 0) == (b < 0), quotient, -quotient)
+    quotient = np.where(b == 0, np.where(a >= 0, Q31_MAX, Q31_MIN), quotient)
+    result = np.select([operation == 1, operation == 2, operation == 3, operation == 4],
+                       [a + b, a - b, ((a * b) >> 32) << 1, quotient], 0)
+    return np.clip(result, Q31_MIN, Q31_MAX).astype(np.int32)
+
+
+def expected(tasks):
+    """
+    Expected raw results (uint32 bit patterns as sent in the notifications) of decoded tasks,
+    and a mask of the tasks violating the num1_less_than_num2() constraint (result undefined).
+    """
+    fixed = tasks['mode'] == calculator.FIXED_MODE
+    operation = tasks['operation']
+    raw = expected_float(operation, tasks['f_operand_1'], tasks['f_operand_2']).view(np.uint32)
+    if fixed.any():
+        q31 = expected_q31(operation[fixed], tasks['q31_operand_1'][fixed], tasks['q31_operand_2'][fixed])
+        raw[fixed] = q31.view(np.uint32)
+    invalid = fixed & (operation == 4) & (np.abs(tasks['q31_operand_1'].astype(np.int64))
+                                          >= np.abs(tasks['q31_operand_2'].astype(np.int64)))
+    return raw, invalid
+
+
+def ulp_distance(expected_raw, got_raw):
+    """Distance in float32 ULPs between bit patterns, a NaN against a number counts as 2^32."""
+    def ordered(raw):
+        bits = raw.view(np.int32).astype(np.int64)
+        return np.where(bits < 0, -(1 << 31) - bits, bits)  # Monotonic in the float value
+
+    distance = np.abs(ordered(expected_raw) - ordered(got_raw))
+    expected_nan = np.isnan(expected_raw.view(np.float32))
+    got_nan = np.isnan(got_raw.view(np.float32))
+    distance = np.where(expected_nan & got_nan, 0, distance)
+    return np.where(expected_nan != got_nan, 1 << 32, distance)
+
+
+def lsb_distance(expected_raw, got_raw):
+    return np.abs(expected_raw.view(np.int32).astype(np.int64) - got_raw.view(np.int32).astype(np.int64))
+
+
+class Report:
+    """Error statistics accumulated over any number of verified chunks."""
+    def __init__(self, worst_count=5):
+        self.worst_count = worst_count
+        self.checked = 0
+        self.mismatches = 0
+        self.skipped = 0  # Tasks violating the division constraint
+        self.histograms = {'float': np.zeros(len(ERROR_BUCKETS) + 1, np.int64),
+                           'fixed': np.zeros(len(ERROR_BUCKETS) + 1, np.int64)}
+        self.worst = {'float': [], 'fixed': []}  # (error, operation, operand 1, operand 2, expected, got)
+
+    def update(self, tasks, got_raw):
+        expected_raw, invalid = expected(tasks)
+        self.skipped += int(invalid.sum())
+        fixed = tasks['mode'] == calculator.FIXED_MODE
+        for name, rows, distance in (('float', ~fixed & ~invalid, ulp_distance),
+                                     ('fixed', fixed & ~invalid, lsb_distance)):
+            if not rows.any():
+                continue
+            error = distance(expected_raw[rows], got_raw[rows])
+            self.checked += len(error)
+            self.mismatches += int(np.count_nonzero(error))
+            self.histograms[name] += np.bincount(np.searchsorted(ERROR_BUCKETS, error),
+                                                 minlength=len(ERROR_BUCKETS) + 1)
+            self._update_worst(name, tasks[rows], error, expected_raw[rows], got_raw[rows])
+
+    def merge(self, other):
+        """Add the statistics of another Report, e.g. of another process."""
+        self.checked += other.checked
+        self.mismatches += other.mismatches
+        self.skipped += other.skipped
+        for name in self.histograms:
+            self.histograms[name] += other.histograms[name]
+            self.worst[name] = sorted(self.worst[name] + other.worst[name], reverse=True)[:self.worst_count]
+
+    def _update_worst(self, name, tasks, error, expected_raw, got_raw):
+        top = np.argsort(error)[::-1][:self.worst_count]
+        num1, num2 = batch_codec.operands(tasks[top])
+        if name == 'float':
+            expected_values, got_values = expected_raw[top].view(np.float32), got_raw[top].view(np.float32)
+        else:
+            expected_values = batch_codec.q31_to_float(expected_raw[top].view(np.int32))
+            got_values = batch_codec.q31_to_float(got_raw[top].view(np.int32))
+        candidates = self.worst[name] + [
+            (int(error[t]), int(tasks['operation'][t]), float(num1[i]), float(num2[i]),
+             float(expected_values[i]), float(got_values[i]))
+            for i, t in enumerate(top) if error[t] > 0]
+        self.worst[name] = sorted(candidates, reverse=True)[:self.worst_count]
+
+    def print_report(self):
+        print(f"verified {self.checked} results: {self.mismatches} mismatches, "
+              f"{self.skipped} skipped (|num1| >= |num2| in fixed division)")
+        symbols = {number: symbol for symbol, number in calculator.OPERATIONS.items()}
+        for name, unit in (('float', 'ULP'), ('fixed', 'LSB')):
+            histogram = self.histograms[name]
+            if not histogram.sum():
+                continue
+            print(f"  {name} error distribution:")
+            for i, count in enumerate(histogram):
+                if count:
+                    label = "0" if i == 0 else (f"<= {ERROR_BUCKETS[i]}" if i < len(ERROR_BUCKETS) else "> 2^31")
+                    print(f"    {label:>14} {unit}: {count}")
+            for error, operation, num1, num2, expected_value, got in self.worst[name]:
+                print(f"    worst {error} {unit}: {num1!r} {symbols.get(operation, '?')} {num2!r} "
+                      f"expected {expected_value!r} got {got!r}")
+
+
+class Verifier:
+    """Collects (frame, raw result) pairs and verifies them in vectorized chunks."""
+    def __init__(self, chunk_size=65536):
+        self.chunk_size = chunk_size
+        self.frames = bytearray()
+        self.results = bytearray()
+        self.report = Report()
+
+    def add(self, frame, result):
+        self.frames += frame
+        self.results += result
+        if len(self.results) >= 4 * self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.results:
+            self.report.update(batch_codec.decode(bytes(self.frames)),
+                               np.frombuffer(bytes(self.results), dtype=np.uint32))
+            self.frames.clear()
+            self.results.clear()
+
+    def finish(self):
+        self.flush()
+        return self.report
+
+
+def self_test(count=1_000_000):
+    """Check the vectorized model against the scalar firmware model of the simulator."""
+    import struct
+    import time
+
+    import simulator  # simulator.py
+
+    rng = np.random.default_rng(1)
+    operation = rng.integers(1, 5, count, dtype=np.uint8)
+    mode = rng.integers(0, 2, count, dtype=np.uint8)
+    num1 = rng.uniform(-1.0, 1.0, count)
+    num2 = rng.uniform(-1.0, 1.0, count)
+    tasks = batch_codec.encode(operation, num1, num2, mode)
+
+    start = time.perf_counter()
+    raw, _ = expected(tasks)
+    elapsed = time.perf_counter() - start
+    print(f"reference model: {count / elapsed:14,.0f} results/s")
+
+    peripheral = simulator.CalculatorPeripheral()
+    sample = rng.choice(count, 20000, replace=False)
+    scalar = np.array([struct.unpack('<I', peripheral.execute(tasks[i:i + 1].tobytes()))[0] for i in sample],
+                      dtype=np.uint32)
+    report = Report()
+    report.update(tasks[sample], scalar)
+    report.print_report()
+
+    start = time.perf_counter()
+    Report().update(tasks, raw)
+    print(f"verification:    {count / (time.perf_counter() - start):14,.0f} results/s")
+
+    # One float result 1000 ULP off must be the worst case, with its own operands
+    row = int(np.flatnonzero(mode == calculator.FLOAT_MODE)[12345])
+    corrupted = raw.copy()
+    corrupted[row] += 1000
+    report = Report()
+    report.update(tasks, corrupted)
+    error, worst_operation, worst1, worst2, _, _ = report.worst['float'][0]
+    assert (report.mismatches, error, worst_operation) == (1, 1000, operation[row]), report.worst['float']
+    assert (worst1, worst2) == tuple(float(x[0]) for x in batch_codec.operands(tasks[row:row + 1])), (worst1, worst2)
+    print("worst case:      the corrupted result is reported")
+
+
+# Guard condition to check if the module is being run directly
+if __name__ == "__main__":
+    print("** self test: reference.py **")
+    self_test()
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+"""
+result_cache.py
+-------------
+Memoizing cache of device results, keyed by the exact packed calculator_task
+bytes. Repeated operations are answered locally instead of costing a BLE
+round trip. A configurable share of the cache hits is still sent to the device
+(spot checks) to detect firmware drift. The cache is LRU, bounded in memory,
+and can be saved to disk between runs.
+---------
+"""
+import asyncio
+import os
+import random
+import struct
+import sys
+import time
+from collections import OrderedDict
+
+MAGIC = b'CDSRC1'
+ENTRY_SIZE = 200  # Estimated memory of one entry (key, value and OrderedDict node) in bytes
+
+
+class ResultCache:
+    def __init__(self, max_memory=64 << 20, spot_check_rate=0.0, seed=None):
+        self.max_entries = max(1, max_memory // ENTRY_SIZE)
+        self.spot_check_rate = spot_check_rate
+        self.random = random.Random(seed)
+        self.entries = OrderedDict()  # Frame -> result, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.spot_checks = 0
+        self.drift = 0  # Spot checks where the device answered differently
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, frame):
+        result = self.entries.get(frame)
+        if result is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(frame)
+        self.hits += 1
+        return result
+
+    def put(self, frame, result):
+        self.entries[frame] = result
+        self.entries.move_to_end(frame)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def spot_check(self):
+        """Decide if this cache hit is sent to the device anyway."""
+        return self.spot_check_rate > 0 and self.random.random() < self.spot_check_rate
+
+    def verify(self, frame, result):
+        """Compare a spot-checked device result with the cached one, the device wins."""
+        self.spot_checks += 1
+        if self.entries.get(frame, result) != result:
+            self.drift += 1
+            print(f"Firmware drift: task {frame.hex()} returned {result.hex()}, "
+                  f"cached {self.entries[frame].hex()}", file=sys.stderr)
+        self.put(frame, result)
+
+    def load(self, path):
+        """Load entries saved with save(), a missing file is an empty cache."""
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return
+        if not data.startswith(MAGIC):
+            raise ValueError(f"{path} is not a result cache file")
+        offset = len(MAGIC)
+        while offset < len(data):
+            frame_size, result_size = struct.unpack_from('<BB', data, offset)
+            offset += 2
+            frame = data[offset:offset + frame_size]
+            offset += frame_size
+            self.put(frame, data[offset:offset + result_size])
+            offset += result_size
+
+    def save(self, path):
+        """Save all entries, least recently used first so the LRU order survives a reload."""
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(MAGIC)
+            for frame, result in self.entries.items():
+                file.write(struct.pack('<BB', len(frame), len(result)) + frame + result)
+        os.replace(temporary, path)
+
+    def print_stats(self, device_latency=None, file=sys.stderr):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0
+        print(f"result cache: {len(self)} entries, {self.hits}/{lookups} hits ({hit_rate:.1f} %), "
+              f"{self.evictions} evictions, {self.spot_checks} spot checks, {self.drift} drifted", file=file)
+        if device_latency:
+            saved = (self.hits - self.spot_checks) * device_latency
+            print(f"result cache: about {saved:.2f} s of device round trips saved "
+                  f"({device_latency * 1000:.2f} ms per round trip)", file=file)
+
+
+class CachedEngine:
+    """
+    Wraps a pipeline.RequestEngine with a ResultCache. Same submit() interface,
+    cache hits return an already completed future.
+    """
+    def __init__(self, engine, cache):
+        self.engine = engine
+        self.cache = cache
+        self.window = engine.window
+        self.latency = None  # Moving average of the device round trip in seconds
+        self.in_flight = {}  # Frame -> future of a miss still waiting for the device
+
+    async def submit(self, data):
+        data = bytes(data)
+        if data in self.in_flight:
+            self.cache.hits += 1  # Same task already on its way, share the answer
+            return self.in_flight[data]
+        result = self.cache.get(data)
+        if result is not None and not self.cache.spot_check():
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(result)
+            return future
+
+        future = await self.engine.submit(data)
+        sent = time.perf_counter()  # After waiting for a free slot in the window, the latency is the round trip only
+        if result is None:
+            self.in_flight[data] = future
+        future.add_done_callback(lambda f: self._completed(f, data, sent, result is not None))
+        return future
+
+    async def request(self, data):
+        return await (await self.submit(data))
+
+    def _completed(self, future, data, sent, spot_check):
+        if self.in_flight.get(data) is future:
+            del self.in_flight[data]
+        if future.cancelled() or future.exception() is not None:
+            return
+        latency = time.perf_counter() - sent
+        self.latency = latency if self.latency is None else self.latency + 0.05 * (latency - self.latency)
+        if spot_check:
+            self.cache.verify(data, future.result())
+        else:
+            self.cache.put(data, future.result())
+
+
+def add_arguments(parser):
+    """Add the result cache command line options to an argparse parser."""
+    group = parser.add_argument_group("result cache")
+    group.add_argument("--result-cache", metavar="<file>",
+                       help="answer repeated operations from this cache file (created if missing)")
+    group.add_argument("--result-cache-memory", type=int, default=64, metavar="<MiB>",
+                       help="memory bound of the result cache")
+    group.add_argument("--spot-check", type=float, default=0.01, metavar="<rate>",
+                       help="share of cache hits still sent to the device to detect firmware drift")
@@ -0,0 +1,308 @@
+#!/usr/bin/python3
+
+"""
+schema.py
+-------------
+Codecs generated from the C declarations of the firmware messages.
+compile() parses struct/union declarations (stdint, float, double and bool
+members, fixed size arrays, anonymous and named nested unions/structs,
+#pragma pack) and computes the layout the compiler of the firmware uses.
+Every StructSchema gives:
+  codec()  a precompiled struct.Struct for one choice of the union members,
+  dtype()  a NumPy structured dtype with every member, unions overlapping,
+  view()   a zero-copy structured array over a buffer of packed messages.
+Codecs and dtypes are cached, a new message type only needs its C declaration.
+---------
+"""
+import functools
+import re
+import struct
+
+# C type -> (struct format character, NumPy type), the size and alignment follow from the format.
+# bool is packed as an integer byte, like the firmware sees it.
+C_TYPES = {
+    'uint8_t': ('B', 'u1'), 'int8_t': ('b', 'i1'), 'char': ('b', 'i1'), 'bool': ('B', 'u1'), '_Bool': ('B', 'u1'),
+    'uint16_t': ('H', 'u2'), 'int16_t': ('h', 'i2'),
+    'uint32_t': ('I', 'u4'), 'int32_t': ('i', 'i4'),
+    'uint64_t': ('Q', 'u8'), 'int64_t': ('q', 'i8'),
+    'float': ('f', 'f4'), 'double': ('d', 'f8'),
+}
+QUALIFIERS = {'const', 'volatile'}
+
+TOKEN = re.compile(r'\s*(?:([A-Za-z_]\w*)|(0[xX][0-9a-fA-F]+|\d+)|(\S))')
+PRAGMA_PACK = re.compile(r'#\s*pragma\s+pack\s*\(\s*(push)?\s*,?\s*(\d+)?\s*\)|#\s*pragma\s+pack\s*\(\s*(pop)\s*\)')
+
+
+class SchemaError(Exception):
+    pass
+
+
+class Member:
+    """One scalar or array member at a fixed offset. *path* holds the (union id, alternative) it is part of."""
+    __slots__ = ('name', 'ctype', 'offset', 'count', 'path')
+
+    def __init__(self, name, ctype, offset, count, path):
+        self.name = name
+        self.ctype = ctype
+        self.offset = offset
+        self.count = count  # Array length, 1 for scalars
+        self.path = path
+
+    @property
+    def size(self):
+        return struct.calcsize('<' + C_TYPES[self.ctype][0]) * self.count
+
+    def format(self):
+        char = C_TYPES[self.ctype][0]
+        if self.count == 1:
+            return char
+        return f"{self.count}s" if self.ctype in ('uint8_t', 'char') else f"{self.count}{char}"
+
+    def __repr__(self):
+        return f"Member({self.name!r}, {self.ctype!r}, offset={self.offset}, count={self.count})"
+
+
+class Codec(struct.Struct):
+    """struct.Struct of one union choice, names holds the member name of every value."""
+    def __init__(self, format, names):
+        super().__init__(format)
+        self.names = names
+
+    def as_dict(self, data, offset=0):
+        return dict(zip(self.names, self.unpack_from(data, offset)))
+
+
+class StructSchema:
+    def __init__(self, name, kind, members, size, alignment, unions):
+        self.name = name
+        self.kind = kind  # 'struct' or 'union'
+        self.members = members
+        self.size = size
+        self.alignment = alignment
+        self.unions = unions  # Number of unions, union ids are 0..unions-1
+        self._codecs = {}
+        self._dtype = None
+
+    def __repr__(self):
+        return f"StructSchema({self.name!r}, size={self.size}, members={[m.name for m in self.members]})"
+
+    def member(self, name):
+        for member in self.members:
+            if member.name == name:
+                return member
+        raise SchemaError(f"{self.name} has no member {name}")
+
+    def codec(self, *names):
+        """
+        struct.Struct packing/unpacking the members of one union choice in offset order.
+        *names* select the union alternatives holding them, other unions use their first member.
+        """
+        codec = self._codecs.get(names)
+        if codec is None:
+            codec = self._codecs[names] = self._compile(names)
+        return codec
+
+    def _compile(self, names):
+        chosen = [0] * self.unions
+        for name in names:
+            for union, alternative in self.member(name).path:
+                chosen[union] = alternative
+        members = sorted((m for m in self.members if all(chosen[u] == a for u, a in m.path)),
+                         key=lambda m: m.offset)
+        format, offset = ['<'], 0
+        for member in members:
+            if member.offset < offset:
+                raise SchemaError(f"{member.name} overlaps the member before it, choose one of them")
+            if member.offset > offset:
+                format.append(f"{member.offset - offset}x")  # Padding
+            format.append(member.format())
+            offset = member.offset + member.size
+        if self.size > offset:
+            format.append(f"{self.size - offset}x")
+        names = tuple(name for m in members
+                      for name in ([m.name] if m.count == 1 or m.format().endswith('s')
+                                   else [f"{m.name}[{i}]" for i in range(m.count)]))
+        return Codec(''.join(format), names)
+
+    def dtype(self):
+        """NumPy structured dtype with every member at its offset (union members overlap)."""
+        if self._dtype is None:
+            import numpy as np  # Only the batch codecs need NumPy
+            self._dtype = np.dtype({
+                'names': [m.name for m in self.members],
+                'formats': ['<' + C_TYPES[m.ctype][1] if m.count == 1 else (('<' + C_TYPES[m.ctype][1]), (m.count,))
+                            for m in self.members],
+                'offsets': [m.offset for m in self.members],
+                'itemsize': self.size,
+            })
+        return self._dtype
+
+    def view(self, buffer):
+        """Zero-copy structured array over a buffer of packed messages."""
+        import numpy as np
+        return np.frombuffer(buffer, dtype=self.dtype())
+
+
+def _tokens(source):
+    """Tokens of the C source, '#pragma pack' lines become ('pack', value) with value 'pop' or an int or None."""
+    source = re.sub(r'/\*.*?\*/', ' ', source, flags=re.S)
+    source = re.sub(r'//[^\n]*', ' ', source)
+    for line in source.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('#'):
+            match = PRAGMA_PACK.fullmatch(stripped)
+            if match is not None:
+                push, value, pop = match.groups()
+                if pop:
+                    yield ('pack', 'pop')
+                else:
+                    yield ('pack', ('push' if push else 'set', int(value) if value else None))
+            continue  # Other preprocessor lines do not change the layout
+        for name, number, symbol in TOKEN.findall(line):
+            yield name or number or symbol
+
+
+class _Parser:
+    def __init__(self, source):
+        self.tokens = list(_tokens(source))
+        self.position = 0
+        self.pack = None  # Maximum alignment, None: natural alignment
+        self.pack_stack = []
+        self.unions = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise SchemaError("unexpected end of the declaration")
+        self.position += 1
+        return token
+
+    def expect(self, token):
+        found = self.next()
+        if found != token:
+            raise SchemaError(f"expected {token!r}, found {found!r}")
+
+    def pragma(self, value):
+        if value == 'pop':
+            self.pack = self.pack_stack.pop() if self.pack_stack else None
+        else:
+            action, pack = value
+            if action == 'push':
+                self.pack_stack.append(self.pack)
+            if pack is not None or action == 'set':
+                self.pack = pack
+
+    def align(self, alignment):
+        return min(alignment, self.pack) if self.pack else alignment
+
+    def declarations(self):
+        schemas = {}
+        while self.peek() is not None:
+            token = self.next()
+            if isinstance(token, tuple):
+                self.pragma(token[1])
+            elif token == 'typedef':
+                kind = self.next()
+                tag = self.next() if self.peek() != '{' else None
+                schema = self.aggregate(kind, tag)
+                schema.name = self.next()
+                self.expect(';')
+                schemas[schema.name] = schema
+                if tag:
+                    schemas[tag] = schema
+            elif token in ('struct', 'union'):
+                schema = self.aggregate(token, self.next())
+                self.expect(';')
+                schemas[schema.name] = schema
+            elif token != ';':
+                raise SchemaError(f"unexpected {token!r}, only struct and union declarations are supported")
+        return schemas
+
+    def aggregate(self, kind, name):
+        self.unions = 0
+        members, size, alignment = self.body(kind, ())
+        return StructSchema(name, kind, members, size, alignment, self.unions)
+
+    def body(self, kind, path):
+        """Members of a struct/union body starting at '{', returns (members, size, alignment)."""
+        if kind not in ('struct', 'union'):
+            raise SchemaError(f"expected struct or union, found {kind!r}")
+        self.expect('{')
+        union = None
+        if kind == 'union':
+            union = self.unions
+            self.unions += 1
+        members, offset, size, alignment, alternative = [], 0, 0, 1, 0
+
+        def place(field_size, field_alignment):
+            """Offset of the next field, every field of a union is an alternative at offset 0."""
+            nonlocal offset, size, alignment, alternative
+            field_offset = 0 if union is not None else _align_up(offset, field_alignment)
+            alignment = max(alignment, field_alignment)
+            offset = field_offset + field_size
+            size = max(size, offset)
+            alternative += 1
+            return field_offset
+
+        while self.peek() != '}':
+            token = self.next()
+            if isinstance(token, tuple):
+                self.pragma(token[1])
+                continue
+            member_path = path + ((union, alternative),) if union is not None else path
+            if token in ('struct', 'union'):
+                nested, nested_size, nested_alignment = self.body(token, member_path)
+                prefix = ''
+                if self.peek() != ';':
+                    prefix = self.next() + '.'
+                self.expect(';')
+                field_offset = place(nested_size, self.align(nested_alignment))
+                members.extend(Member(prefix + m.name, m.ctype, field_offset + m.offset, m.count, m.path)
+                               for m in nested)
+                continue
+            while token in QUALIFIERS:
+                token = self.next()
+            if token not in C_TYPES:
+                raise SchemaError(f"unsupported type {token!r}")
+            ctype, element = token, struct.calcsize('<' + C_TYPES[token][0])
+            while True:  # Declarators: "uint16_t x, y[2];"
+                name, count = self.next(), 1
+                if self.peek() == '[':
+                    self.next()
+                    count = int(self.next(), 0)
+                    self.expect(']')
+                if self.peek() == ':':
+                    raise SchemaError(f"bit-field {name} is not supported")
+                member_path = path + ((union, alternative),) if union is not None else path
+                members.append(Member(name, ctype, place(element * count, self.align(element)), count, member_path))
+                if self.next() == ';':
+                    break
+        self.expect('}')
+        return members, _align_up(size, alignment), alignment
+
+
+def _align_up(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+@functools.lru_cache(maxsize=None)
+def compile(source):
+    """Parse the C declarations in *source*, returns {name: StructSchema}."""
+    return _Parser(source).declarations()
+
+
+# Guard condition to check if the module is being run directly
+if __name__ == "__main__":
+    import sys
+
+    source = open(sys.argv[1]).read() if len(sys.argv) > 1 else sys.stdin.read()
+    schemas = compile(source)
+    for schema in dict.fromkeys(schemas.values()):  # A typedef with a tag is listed once
+        print(f"{schema.kind} {schema.name}: {schema.size} bytes, alignment {schema.alignment}")
+        for member in schema.members:
+            array = f"[{member.count}]" if member.count > 1 else ""
+            print(f"  {member.offset:4}  {member.ctype} {member.name}{array}")
+        print(f"  default codec: {schema.codec().format!r} {schema.codec().names}")
@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+
+"""
+session.py
+-------------
+Resilient CDS session that survives disconnects.
+Instead of cancelling every task when the link drops, the session keeps the
+queued and unanswered operations, reconnects with jittered exponential backoff
+(the last-known address first, a rescan only after that fails) and sends every
+unanswered operation again exactly once, in the original order. Callers keep
+waiting on their futures and only see a delay. Time lost to reconnects is
+reported at the end.
+---------
+"""
+import asyncio
+import contextlib
+import random
+import sys
+import time
+
+import device_cache  # device_cache.py
+import pipeline  # pipeline.py
+
+
+class SessionLost(Exception):
+    pass
+
+
+class ResilientSession:
+    """
+    Connected CDS board with the submit()/request() interface of pipeline.RequestEngine.
+    Use with "async with", which returns None if no device was found.
+    """
+    def __init__(self, service_uuid, write_uuid, notify_uuid, filterfunc, scanner, client_class, cache=None,
+                 window=1, decode=bytes, tracer=None, retries=10, backoff=0.1, max_backoff=5.0,
+                 direct_attempts=3, batch_write_uuid=None):
+        self.service_uuid = service_uuid
+        self.write_uuid = write_uuid
+        self.notify_uuid = notify_uuid
+        self.filterfunc = filterfunc
+        self.scanner = scanner
+        self.client_class = client_class
+        self.cache = cache
+        self.tracer = tracer
+        self.retries = retries
+        self.backoff = backoff  # Seconds, doubled after every failed attempt up to max_backoff
+        self.max_backoff = max_backoff
+        self.direct_attempts = direct_attempts  # Attempts with the last-known address before rescanning
+        self.batch_write_uuid = batch_write_uuid  # Characteristic of batched framing, None: single tasks only
+        self.random = random.Random()
+
+        write = self._write
+        if tracer is not None:
+            write = tracer.wrap_write(write)
+        self.engine = pipeline.RequestEngine(write, window, decode)
+        self.window = window
+        self.client = None
+        self.write_char = None
+        self.batch_char = None
+        self.address = None
+        self.connected = False
+        self.failed = None  # SessionLost once reconnecting was given up
+        self.reconnects = 0
+        self.resent = 0
+        self.downtime = 0.0  # Seconds spent reconnecting
+        self._loop = None
+        self._lost_at = None  # Time of the disconnect the running reconnect started with
+        self._reconnecting = None
+        self._closing = False
+        self._stack = contextlib.AsyncExitStack()
+
+    async def __aenter__(self):
+        self._loop = asyncio.get_running_loop()
+        client = await self._stack.enter_async_context(device_cache.connect(
+            self.service_uuid, self.filterfunc, self.scanner, self.client_class, self.cache, self.tracer,
+            disconnected_callback=self._on_disconnect))
+        if client is None:
+            await self._stack.aclose()
+            return None
+        self.address = client.address
+        # bleak resolves the services inside connect(), discovery covers the lookup and the subscription
+        if self.tracer is not None:
+            self.tracer.start("discovery")
+        await self._attach(client)
+        if self.tracer is not None:
+            self.tracer.end("discovery")
+        self.connected = True
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._closing = True
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._reconnecting
+        with contextlib.suppress(Exception):
+            await self.client.disconnect()  # The client of the last reconnect
+        await self._stack.aclose()  # Disconnects the first client
+        if self.reconnects or self.failed is not None:
+            self.print_report()
+
+    async def _attach(self, client):
+        service = client.services.get_service(self.service_uuid)
+        self.write_char = service.get_characteristic(self.write_uuid)
+        # Firmware with batched framing has the batch characteristic, older firmware gets single tasks
+        self.batch_char = None
+        if self.batch_write_uuid is not None:
+            self.batch_char = service.get_characteristic(self.batch_write_uuid)
+        if self.batch_char is not None:
+            self.engine.set_batching(self.engine.write,
+                                     self.batch_char.max_write_without_response_size // pipeline.TASK_SIZE)
+        else:
+            self.engine.set_batching(None)
+        handle_notification = self.engine.handle_notification
+        if self.tracer is not None:
+            handle_notification = self.tracer.wrap_notify(handle_notification)
+        await client.start_notify(self.notify_uuid, handle_notification)
+        if not client.is_connected:
+            raise ConnectionError(f"{client.address} was disconnected during the discovery")
+        # Only now: until then _on_disconnect() ignores the client, a failed attempt does not restart _reconnect()
+        self.client = client
+
+    async def _write(self, data):
+        if self.failed is not None:
+            raise self.failed
+        if not self.connected:
+            return  # Kept by the engine until it is answered, resend() sends it after the reconnect
+        # A single task goes to the write characteristic, several concatenated ones to the batch characteristic
+        char = self.write_char if len(data) == pipeline.TASK_SIZE or self.batch_char is None else self.batch_char
+        try:
+            await self.client.write_gatt_char(char, data, response=False)
+        except Exception:
+            if self.client.is_connected:
+                raise
+            # The link was lost during the write, resend() sends it after the reconnect
+
+    async def submit(self, data):
+        return await self.engine.submit(data)
+
+    async def request(self, data):
+        return await self.engine.request(data)
+
+    def _on_disconnect(self, client):
+        if client is not self.client or self._closing:
+            return  # A stale client of an earlier connection
+        self.connected = False
+        if self.tracer is not None:
+            self.tracer.reset('link_lost')
+        if self._lost_at is None:
+            self._lost_at = time.perf_counter()
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()  # Lost again while reconnecting, start over
+        print(f"Device {self.address} was disconnected, reconnecting "
+              f"({self.engine.in_flight} operations kept)...", file=sys.stderr)
+        self._reconnecting = self._loop.create_task(self._reconnect())
+
+    async def _connect_once(self, attempt):
+        """One reconnect attempt, returns the connected client or None."""
+        target = self.address
+        if attempt > self.direct_attempts:
+            if self.tracer is not None:
+                self.tracer.start("scan")
+            target = await self.scanner.find_device_by_filter(self.filterfunc)
+            if self.tracer is not None:
+                self.tracer.end("scan", ok=target is not None)
+            if target is None:
+                return None
+        client = self.client_class(target, disconnected_callback=self._on_disconnect)
+        try:
+            await asyncio.wait_for(client.connect(), device_cache.CONNECT_TIMEOUT)
+            await self._attach(client)
+        except Exception:  # Includes asyncio.TimeoutError
+            with contextlib.suppress(Exception):
+                await client.disconnect()
+            return None
+        if client.address != self.address and self.cache is not None:
+            self.cache.remember(self.service_uuid, client.address, getattr(target, "name", None))
+        self.address = client.address
+        return client
+
+    async def _reconnect(self):
+        lost = self._lost_at
+        if self.tracer is not None:
+            self.tracer.start("reconnect")
+        for attempt in range(1, self.retries + 1):
+            # Full jitter: boards reset together do not all come back at the same moment
+            await asyncio.sleep(self.random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+            if await self._connect_once(attempt) is None:
+                continue
+            resent = await self.engine.resend(before=self._link_up)
+            self._lost_at = None
+            self.reconnects += 1
+            self.resent += resent
+            self.downtime += time.perf_counter() - lost
+            if self.tracer is not None:
+                self.tracer.end("reconnect")
+            print(f"Reconnected to {self.address} after {time.perf_counter() - lost:.2f} s "
+                  f"({attempt} attempts), {resent} operations sent again", file=sys.stderr)
+            return
+
+        self._lost_at = None
+        self.downtime += time.perf_counter() - lost
+        if self.tracer is not None:
+            self.tracer.end("reconnect", ok=False)
+        self.failed = SessionLost(f"could not reconnect to {self.address} after {self.retries} attempts")
+        self.engine.fail_pending(self.failed)
+
+    def _link_up(self):
+        self.connected = True
+        if self.tracer is not None:
+            self.tracer.reset('resend')  # Also forgets the writes kept while the link was down
+
+    def print_report(self, file=sys.stderr):
+        print(f"session: {self.reconnects} reconnects, {self.downtime:.2f} s lost to reconnects, "
+              f"{self.resent} operations sent again", file=file)
+
+
+def add_arguments(parser):
+    """Add the reconnect and framing command line options to an argparse parser."""
+    group = parser.add_argument_group("reconnect")
+    group.add_argument("--reconnect-retries", type=int, default=10, metavar="<n>",
+                       help="reconnect attempts after a disconnect before giving up")
+    group.add_argument("--reconnect-backoff", type=float, default=0.1, metavar="<s>",
+                       help="initial reconnect backoff in seconds, doubled after every failed attempt")
+    parser.add_argument("--single-frame", action="store_true",
+                        help="one calculator_task per write even if the firmware supports batched framing")
@@ -0,0 +1,624 @@
+#!/usr/bin/python3
+
+"""
+simulator.py
+-------------
+In-process simulated peripherals for running the tools without a Nordic board.
+SimulatedScanner and SimulatedClient are drop-in stand-ins for BleakScanner and
+BleakClient, CalculatorPeripheral runs the Calculator Data Service (CDS) firmware
+arithmetic (float32 and Q31 add/sub/mul/div).
+The radio link is modelled with a connection interval, jitter, an MTU limit
+and packet drops, so timing-related code can be exercised on any machine.
+---------
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import random
+import struct
+from collections import deque
+
+import calculator  # calculator.py
+
+SERVICE_UUID = "6e7e652f-0b5d-4de6-bcd9-a071d34c3e9f"
+WRITE_UUID   = "448e4b02-b99a-4f57-a76d-d283933c2fd5"
+NOTIFY_UUID  = "4d19fe91-2164-49a8-9022-55ba662ce6fc"
+BATCH_WRITE_UUID = "448e4b03-b99a-4f57-a76d-d283933c2fd5"
+
+LBS_SERVICE_UUID = "00001523-1212-efde-1523-785feabcd123"
+LBS_BUTTON_UUID  = "00001524-1212-efde-1523-785feabcd123"
+LBS_LED_UUID     = "00001525-1212-efde-1523-785feabcd123"
+
+UART_SERVICE_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"
+UART_RX_CHAR_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"
+UART_TX_CHAR_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"
+
+Q31_MIN = -(1 << 31)
+Q31_MAX = (1 << 31) - 1
+
+ATT_HEADER_SIZE = 3  # Opcode + handle of a Write Command / Notification
+
+
+def to_float32(value):
+    """Round a Python float to float32, overflowing to +/-inf like the FPU does."""
+    try:
+        return struct.unpack('<f', struct.pack('<f', value))[0]
+    except OverflowError:
+        return math.copysign(math.inf, value)
+
+
+def saturate_q31(value):
+    return max(Q31_MIN, min(Q31_MAX, value))
+
+
+def calculate_float(operation, a, b):
+    """Float32 arithmetic of the firmware. Operands are float32 values."""
+    if operation == 1:
+        return to_float32(a + b)
+    if operation == 2:
+        return to_float32(a - b)
+    if operation == 3:
+        return to_float32(a * b)
+    if operation == 4:
+        if b == 0.0:
+            return math.nan if a == 0.0 or math.isnan(a) else math.copysign(math.inf, a) * math.copysign(1.0, b)
+        return to_float32(a / b)
+    return 0.0
+
+
+def calculate_q31(operation, a, b):
+    """
+    Q31 arithmetic of the firmware (CMSIS-DSP arm_add/sub/mult_q31 semantics):
+    add/sub saturate, mul keeps the upper 32 bits of the 64-bit product shifted left by one (saturated),
+    div computes (a << 31) / b truncated towards zero (requires |a| < |b|, see num1_less_than_num2()).
+    """
+    if operation == 1:
+        return saturate_q31(a + b)
+    if operation == 2:
+        return saturate_q31(a - b)
+    if operation == 3:
+        return saturate_q31(((a * b) >> 32) << 1)
+    if operation == 4:
+        if b == 0:
+            return Q31_MAX if a >= 0 else Q31_MIN
+        quotient = (abs(a) << 31) // abs(b)
+        return saturate_q31(quotient if (a < 0) == (b < 0) else -quotient)
+    return 0
+
+
+class SimulatedCharacteristic:
+    def __init__(self, uuid, service, handle, max_write_without_response_size=20):
+        self.uuid = uuid
+        self.service = service
+        self.handle = handle
+        self.max_write_without_response_size = max_write_without_response_size
+
+    def __str__(self):
+        return self.uuid
+
+    @property
+    def service_uuid(self):
+        return self.service.uuid
+
+
+class SimulatedService:
+    def __init__(self, uuid, characteristic_uuids, handles, max_write_without_response_size=20):
+        self.uuid = uuid
+        self.handle = next(handles)
+        self.characteristics = []
+        for char_uuid in characteristic_uuids:
+            next(handles)  # Characteristic declaration, the value follows it
+            self.characteristics.append(
+                SimulatedCharacteristic(char_uuid, self, next(handles), max_write_without_response_size))
+
+    def get_characteristic(self, uuid):
+        for characteristic in self.characteristics:
+            if characteristic.uuid.lower() == str(uuid).lower():
+                return characteristic
+        return None
+
+
+class SimulatedServices:
+    """Stand-in for BleakGATTServiceCollection."""
+    def __init__(self, services):
+        self.services = services
+
+    def __iter__(self):
+        return iter(self.services)
+
+    def get_service(self, uuid):
+        for service in self.services:
+            if service.uuid.lower() == str(uuid).lower():
+                return service
+        return None
+
+    def get_characteristic(self, uuid):
+        for service in self.services:
+            characteristic = service.get_characteristic(uuid)
+            if characteristic is not None:
+                return characteristic
+        return None
+
+
+class SimulatedPeripheral:
+    """
+    Base class of the simulated firmware. Subclasses describe their GATT table in SERVICES
+    ({service_uuid: [characteristic_uuid, ...]}) and implement on_write()/on_read().
+    """
+    SERVICES = {}
+    NAME = "Simulated"
+
+    def on_write(self, char_uuid, data, now):
+        """
+        Handle a write arriving at time *now*, returns the notifications to send as a list of
+        (characteristic uuid, data) or (characteristic uuid, data, delay in seconds).
+        """
+        return []
+
+    def on_read(self, char_uuid):
+        return b''
+
+
+class CalculatorPeripheral(SimulatedPeripheral):
+    """
+    Calculator Data Service firmware: one 10 byte calculator_task in, one 4 byte result out.
+    With batched framing a write to the batch characteristic carries several concatenated
+    tasks, answered by one notification with the concatenated results.
+    """
+    SERVICES = {SERVICE_UUID: [WRITE_UUID, NOTIFY_UUID, BATCH_WRITE_UUID]}
+    NAME = "Nordic_CDS"
+    TASK = calculator.TASK_Q31
+    TASK_FLOAT = calculator.TASK_FLOAT
+
+    def on_write(self, char_uuid, data, now):
+        if char_uuid == BATCH_WRITE_UUID:
+            if not data or len(data) % self.TASK.size:
+                return []
+            return [(NOTIFY_UUID, b''.join(self.execute(data[i:i + self.TASK.size])
+                                           for i in range(0, len(data), self.TASK.size)))]
+        if char_uuid != WRITE_UUID or len(data) != self.TASK.size:
+            return []  # The firmware ignores malformed tasks
+        return [(NOTIFY_UUID, self.execute(data))]
+
+    def execute(self, data):
+        """Run one packed calculator_task, returns the packed result."""
+        operation, q31_1, q31_2, mode = self.TASK.unpack(data)
+        if mode == calculator.FIXED_MODE:
+            return calculator.RESULT_Q31.pack(calculate_q31(operation, q31_1, q31_2))
+        _, f1, f2, _ = self.TASK_FLOAT.unpack(data)
+        return calculator.RESULT_FLOAT.pack(calculate_float(operation, f1, f2))
+
+
+class SingleFrameCalculatorPeripheral(CalculatorPeripheral):
+    """Older Calculator Data Service firmware without batched framing."""
+    SERVICES = {SERVICE_UUID: [WRITE_UUID, NOTIFY_UUID]}
+
+
+class LedButtonPeripheral(SimulatedPeripheral):
+    """
+    LED Button Service (LBS) firmware: the LED characteristic is written, the button one is
+    read or notified on every change (see set_button()).
+    """
+    SERVICES = {LBS_SERVICE_UUID: [LBS_BUTTON_UUID, LBS_LED_UUID]}
+    NAME = "Nordic_LBS"
+
+    def __init__(self):
+        self.led = 0
+        self.button = 0
+
+    def on_write(self, char_uuid, data, now):
+        if char_uuid == LBS_LED_UUID and data:
+            self.led = data[0]
+        return []
+
+    def set_button(self, state):
+        """The button was pressed (1) or released (0), returns the notifications, see SimulatedDevice.send()."""
+        self.button = state
+        return [(LBS_BUTTON_UUID, bytes([state]))]
+
+    def on_read(self, char_uuid):
+        if char_uuid == LBS_BUTTON_UUID:
+            return bytes([self.button])
+        if char_uuid == LBS_LED_UUID:
+            return bytes([self.led])
+        return b''
+
+
+class UartPeripheral(SimulatedPeripheral):
+    """
+    Nordic UART Service (NUS) firmware with a UART loopback: everything written to RX
+    is echoed on TX once it went through the UART. Data arriving while the RX buffer
+    is full is lost (buffer overrun).
+    """
+    SERVICES = {UART_SERVICE_UUID: [UART_RX_CHAR_UUID, UART_TX_CHAR_UUID]}
+    NAME = "Nordic_UART"
+
+    def __init__(self, baudrate=115200, buffer_size=2048, notify_size=244):
+        self.rate = baudrate / 10  # Bytes per second, 8N1 framing
+        self.buffer_size = buffer_size
+        self.notify_size = notify_size
+        self.busy_until = 0.0  # Time at which the UART has sent everything buffered
+        self.overruns = 0
+
+    def on_write(self, char_uuid, data, now):
+        if char_uuid != UART_RX_CHAR_UUID:
+            return []
+        buffered = max(0.0, self.busy_until - now) * self.rate
+        if buffered + len(data) > self.buffer_size:
+            self.overruns += 1
+            return []
+        self.busy_until = max(now, self.busy_until) + len(data) / self.rate
+        delay = self.busy_until - now
+        return [(UART_TX_CHAR_UUID, data[i:i + self.notify_size], delay)
+                for i in range(0, len(data), self.notify_size)]
+
+
+class SimulatedDevice:
+    """
+    Stand-in for BLEDevice plus the simulated radio link to it.
+    connection_interval and jitter are in seconds, drop_rate is the probability that a packet is lost,
+    link_loss_interval is the mean time in seconds between random link losses (0: never),
+    packets_per_event limits the packets of both directions in one connection event (0: no limit).
+    """
+    _addresses = itertools.count(1)
+
+    def __init__(self, peripheral, address=None, name=None, rssi=-50, connection_interval=0.0075,
+                 jitter=0.0, mtu=247, drop_rate=0.0, connect_time=0.05, link_loss_interval=0.0, seed=None,
+                 packets_per_event=0):
+        self.peripheral = peripheral
+        self.address = address or "SI:MU:LA:00:%02X:%02X" % divmod(next(self._addresses), 256)
+        self.name = name or peripheral.NAME
+        self.rssi = rssi
+        self.details = None
+        self.connection_interval = connection_interval
+        self.jitter = jitter
+        self.mtu = mtu
+        self.drop_rate = drop_rate
+        self.connect_time = connect_time
+        self.link_loss_interval = link_loss_interval
+        self.packets_per_event = packets_per_event
+        self.random = random.Random(seed)
+        self.client = None  # Connected SimulatedClient
+
+    def __str__(self):
+        return f"{self.address}: {self.name}"
+
+    def advertisement(self):
+        return SimulatedAdvertisementData(self)
+
+    def send(self, notifications):
+        """
+        Send notifications the firmware generates on its own (e.g. on a button press), a list like
+        SimulatedPeripheral.on_write() returns. Nothing is sent while no client is connected.
+        """
+        if self.client is not None:
+            self.client._send(notifications)
+
+    def drop_connection(self):
+        """Simulate a link loss (e.g. the board was reset or went out of range)."""
+        if self.client is not None:
+            self.client._on_link_lost()
+
+
+class SimulatedAdvertisementData:
+    """Stand-in for AdvertisementData."""
+    def __init__(self, device, rssi=None):
+        self.local_name = device.name
+        self.service_uuids = [uuid.lower() for uuid in device.peripheral.SERVICES]
+        self.rssi = device.rssi if rssi is None else rssi
+        self.manufacturer_data = {}
+        self.service_data = {}
+        self.tx_power = None
+        self.platform_data = ()
+
+    def __repr__(self):
+        return (f"AdvertisementData(local_name={self.local_name!r}, service_uuids={self.service_uuids}, "
+                f"rssi={self.rssi})")
+
+
+devices = []  # Simulated devices that are "advertising"
+
+
+def add_device(peripheral=None, **link):
+    """Register a simulated device, returns it. Keyword arguments configure the link (see SimulatedDevice)."""
+    device = SimulatedDevice(peripheral or CalculatorPeripheral(), **link)
+    devices.append(device)
+    return device
+
+
+class SimulatedScanner:
+    """
+    Stand-in for BleakScanner, "finds" the devices registered with add_device().
+    Used as an instance (detection_callback, start/stop or "async with") every device
+    advertises every ADVERTISING_INTERVAL seconds with a fluctuating RSSI.
+    """
+    ADVERTISING_DELAY = 0.02  # Time until the first advertisement of a device is received
+    ADVERTISING_INTERVAL = 0.1
+    RSSI_FLUCTUATION = 4  # dBm
+
+    def __init__(self, detection_callback=None, service_uuids=None, **kwargs):
+        self.detection_callback = detection_callback
+        self.service_uuids = [uuid.lower() for uuid in service_uuids] if service_uuids else None
+        self.random = random.Random()
+        self.seen = {}  # Address -> (device, advertisement data) received last
+        self._task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    @property
+    def discovered_devices_and_advertisement_data(self):
+        return dict(self.seen)
+
+    async def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._advertise())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _advertise(self):
+        """Deliver the advertisements of all devices in time order, the first ones at a random offset."""
+        loop = asyncio.get_running_loop()
+        start = loop.time() + self.ADVERTISING_DELAY
+        queue = [(start + self.random.uniform(0, self.ADVERTISING_INTERVAL), i) for i in range(len(devices))]
+        heapq.heapify(queue)
+        while queue:
+            due, i = heapq.heappop(queue)
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            device = devices[i]
+            adv = SimulatedAdvertisementData(device, device.rssi + self.random.randint(-self.RSSI_FLUCTUATION,
+                                                                                        self.RSSI_FLUCTUATION))
+            if self.service_uuids is None or set(self.service_uuids) & set(adv.service_uuids):
+                self.seen[device.address] = (device, adv)
+                if self.detection_callback is not None:
+                    self.detection_callback(device, adv)
+            heapq.heappush(queue, (due + self.ADVERTISING_INTERVAL, i))
+
+    @classmethod
+    async def find_device_by_filter(cls, filterfunc, timeout=10.0, **kwargs):
+        await asyncio.sleep(min(cls.ADVERTISING_DELAY, timeout))
+        for device in devices:
+            if filterfunc(device, device.advertisement()):
+                return device
+        return None
+
+    @classmethod
+    async def find_device_by_address(cls, address, timeout=10.0, **kwargs):
+        return await cls.find_device_by_filter(lambda d, _: d.address.lower() == address.lower(), timeout)
+
+    @classmethod
+    async def discover(cls, timeout=5.0, return_adv=False, **kwargs):
+        await asyncio.sleep(timeout)
+        if return_adv:
+            return {d.address: (d, d.advertisement()) for d in devices}
+        return list(devices)
+
+
+class SimulatedClient:
+    """Stand-in for BleakClient talking to a SimulatedDevice."""
+    def __init__(self, address_or_ble_device, disconnected_callback=None, timeout=10.0, **kwargs):
+        if isinstance(address_or_ble_device, SimulatedDevice):
+            self.device = address_or_ble_device
+        else:
+            self.device = next((d for d in devices if d.address.lower() == str(address_or_ble_device).lower()), None)
+        self.address = getattr(self.device, 'address', address_or_ble_device)
+        self._disconnected_callback = disconnected_callback
+        self._notify_callbacks = {}
+        self._connected = False
+        self._last_delivery = 0.0  # Keeps packets in order when jitter is used
+        self._event_packets = 0  # Packets in the connection event at _last_delivery
+        self._air = deque()  # (time, function, args) of packets on air, in time order
+        self._air_timer = None
+        self._link_loss_timer = None
+        self.services = None
+        self.stats = {'reads': 0, 'writes': 0, 'notifications': 0, 'dropped': 0}
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    @property
+    def is_connected(self):
+        return self._connected
+
+    @property
+    def mtu_size(self):
+        return self.device.mtu
+
+    async def connect(self, **kwargs):
+        if self.device is None:
+            raise RuntimeError(f"Device with address {self.address} was not found.")
+        if self.device.client is not None:
+            raise RuntimeError(f"Device {self.address} is already connected.")
+        await asyncio.sleep(self.device.connect_time)
+        max_write = self.device.mtu - ATT_HEADER_SIZE
+        handles = itertools.count(1)
+        self.services = SimulatedServices([SimulatedService(uuid, chars, handles, max_write)
+                                           for uuid, chars in self.device.peripheral.SERVICES.items()])
+        self.device.client = self
+        self._connected = True
+        if self.device.link_loss_interval:
+            delay = self.device.random.expovariate(1 / self.device.link_loss_interval)
+            self._link_loss_timer = asyncio.get_running_loop().call_later(delay, self._on_link_lost)
+        return True
+
+    async def disconnect(self):
+        if self._connected:
+            self._connected = False
+            self.device.client = None
+            if self._link_loss_timer is not None:
+                self._link_loss_timer.cancel()
+        return True
+
+    def _on_link_lost(self):
+        if self._connected:
+            self._connected = False
+            self.device.client = None
+            if self._link_loss_timer is not None:
+                self._link_loss_timer.cancel()
+            if self._disconnected_callback is not None:
+                self._disconnected_callback(self)
+
+    def _characteristic_uuid(self, char_specifier):
+        if isinstance(char_specifier, SimulatedCharacteristic):
+            return char_specifier.uuid
+        characteristic = self.services.get_characteristic(char_specifier)
+        if characteristic is None:
+            raise ValueError(f"Characteristic {char_specifier} was not found!")
+        return characteristic.uuid
+
+    def _check_connected(self):
+        if not self._connected:
+            raise RuntimeError("Not connected")
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        self._check_connected()
+        self._notify_callbacks[self._characteristic_uuid(char_specifier)] = callback
+
+    async def stop_notify(self, char_specifier):
+        self._notify_callbacks.pop(self._characteristic_uuid(char_specifier), None)
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        self._check_connected()
+        char_uuid = self._characteristic_uuid(char_specifier)
+        self.stats['reads'] += 1
+        await asyncio.sleep(2 * self.device.connection_interval)  # Request and response
+        return bytearray(self.device.peripheral.on_read(char_uuid))
+
+    async def write_gatt_char(self, char_specifier, data, response=None):
+        """response=None writes with response, like bleak does for characteristics supporting it."""
+        response = response is None or response
+        self._check_connected()
+        char_uuid = self._characteristic_uuid(char_specifier)
+        if not response and len(data) > self.device.mtu - ATT_HEADER_SIZE:
+            raise ValueError(f"Data of {len(data)} bytes does not fit in one packet (MTU {self.device.mtu})")
+        self.stats['writes'] += 1
+
+        loop = asyncio.get_running_loop()
+        arrival = self._next_event(loop.time())
+        if self._lost():
+            return
+        if response:
+            written = loop.create_future()
+            self._schedule(arrival, self._deliver, char_uuid, bytes(data))
+            self._schedule(arrival + self.device.connection_interval, written.set_result, None)
+            await written
+        else:
+            self._schedule(arrival, self._deliver, char_uuid, bytes(data))
+            await asyncio.sleep(0)
+
+    def _next_event(self, now):
+        """Time of the next connection event (plus jitter) at which a packet can go on air."""
+        interval = self.device.connection_interval
+        event = math.floor(now / interval + 1) * interval if interval > 0 else now
+        if self.device.jitter:
+            event += self.device.random.uniform(0, self.device.jitter)
+        if event <= self._last_delivery:
+            event = self._last_delivery
+            self._event_packets += 1
+            limit = self.device.packets_per_event
+            if limit and interval > 0 and self._event_packets > limit:
+                event += interval  # The connection event is full
+                self._event_packets = 1
+        else:
+            self._event_packets = 1
+        self._last_delivery = event
+        return event
+
+    def _schedule(self, when, function, *args):
+        """
+        Run *function* at *when*. Packets are kept in a FIFO instead of one loop.call_at() each,
+        because the event loop does not keep the order of timers due at the same time.
+        """
+        self._air.append((when, function, args))
+        if self._air_timer is None:
+            self._air_timer = asyncio.get_running_loop().call_at(when, self._run_air)
+
+    def _run_air(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        while self._air and self._air[0][0] <= now:
+            _, function, args = self._air.popleft()
+            function(*args)
+        self._air_timer = loop.call_at(self._air[0][0], self._run_air) if self._air else None
+
+    def _lost(self):
+        if self.device.drop_rate and self.device.random.random() < self.device.drop_rate:
+            self.stats['dropped'] += 1
+            return True
+        return False
+
+    def _deliver(self, char_uuid, data):
+        """The packet reached the peripheral, send back the notifications of the firmware."""
+        if self._connected:
+            self._send(self.device.peripheral.on_write(char_uuid, data, asyncio.get_running_loop().time()))
+
+    def _send(self, notifications):
+        """Put (characteristic uuid, data[, delay]) notifications on air."""
+        now = asyncio.get_running_loop().time()
+        for notify_uuid, payload, *delay in notifications:
+            if self._lost():
+                continue
+            self._schedule(self._next_event(now + sum(delay)), self._notify, notify_uuid, payload)
+
+    def _notify(self, char_uuid, data):
+        callback = self._notify_callbacks.get(char_uuid)
+        if self._connected and callback is not None:
+            self.stats['notifications'] += 1
+            callback(self.services.get_characteristic(char_uuid), bytearray(data))
+
+
+def add_arguments(parser):
+    """Add the command line options of the simulated link to an argparse parser."""
+    group = parser.add_argument_group("simulated peripheral")
+    group.add_argument("--simulate", action="store_true",
+                       help="use a local simulated peripheral instead of a real board")
+    group.add_argument("--sim-devices", type=int, default=1, metavar="<n>",
+                       help="number of simulated devices")
+    group.add_argument("--sim-interval", type=float, default=7.5, metavar="<ms>",
+                       help="connection interval in milliseconds")
+    group.add_argument("--sim-jitter", type=float, default=0.0, metavar="<ms>",
+                       help="maximum random delay added to every packet in milliseconds")
+    group.add_argument("--sim-mtu", type=int, default=247, metavar="<bytes>",
+                       help="ATT MTU of the link")
+    group.add_argument("--sim-drop", type=float, default=0.0, metavar="<rate>",
+                       help="probability of losing a packet (0..1)")
+    group.add_argument("--sim-link-loss", type=float, default=0.0, metavar="<s>",
+                       help="mean time between random link losses in seconds (0: never)")
+    group.add_argument("--sim-packets-per-event", type=int, default=0, metavar="<n>",
+                       help="packets per connection event, both directions (0: no limit)")
+    group.add_argument("--sim-single-frame", action="store_true",
+                       help="simulate older firmware without batched framing")
+    group.add_argument("--sim-seed", type=int, default=None, metavar="<seed>",
+                       help="seed of the random jitter and drops")
+
+
+def setup(args, peripheral_class=None):
+    """Register the simulated devices requested on the command line."""
+    if peripheral_class is None:
+        peripheral_class = SingleFrameCalculatorPeripheral if args.sim_single_frame else CalculatorPeripheral
+    for i in range(args.sim_devices):
+        add_device(peripheral_class(),
+                   connection_interval=args.sim_interval / 1000,
+                   jitter=args.sim_jitter / 1000,
+                   mtu=args.sim_mtu,
+                   drop_rate=args.sim_drop,
+                   link_loss_interval=args.sim_link_loss,
+                   packets_per_event=args.sim_packets_per_event,
+                   seed=None if args.sim_seed is None else args.sim_seed + i)
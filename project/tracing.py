@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+
+"""
+tracing.py
+-------------
+Per-request tracing and metrics export.
+A Tracer records monotonic timestamps of the connection phases (scan, connect,
+GATT discovery) and of every write and notification, tagged with a correlation
+ID, and keeps counters and latency histograms of them. The data is exported
+to a Prometheus textfile, CSV (the event log) or JSON.
+Tracing is disabled by passing None instead of a Tracer: the phase hooks are
+behind an "is not None" check and the write/notify paths are only wrapped when
+tracing is enabled, so the disabled hot path is unchanged.
+---------
+"""
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from collections import deque
+
+import benchmark  # benchmark.py
+import pipeline  # pipeline.py
+
+FORMATS = {'.prom': 'prometheus', '.csv': 'csv', '.json': 'json'}
+PHASES = ('scan', 'connect', 'discovery')
+PREFIX = 'ble_test_tool'
+
+
+class Tracer:
+    def __init__(self, max_events=1 << 20):
+        self.clock = time.monotonic_ns
+        self.started = self.clock()
+        self.events = deque(maxlen=max_events)  # (timestamp ns, event, correlation id, duration ns)
+        self.counters = {}
+        self.histograms = {}  # Name -> benchmark.LatencyHistogram
+        self.outstanding = deque()  # (correlation id, timestamp) per task waiting for its result
+        self._ids = itertools.count(1)
+        self._phases = {}  # Phase -> timestamp of the running start()
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, name, duration_ns):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = benchmark.LatencyHistogram()
+        histogram.record(duration_ns / 1e9)
+
+    def event(self, name, correlation_id=None, duration_ns=None, timestamp=None):
+        self.events.append((timestamp or self.clock(), name, correlation_id, duration_ns))
+
+    # Connection phases
+
+    def start(self, phase):
+        now = self.clock()
+        self._phases[phase] = now
+        self.event(phase + '_start', timestamp=now)
+
+    def end(self, phase, ok=True):
+        now = self.clock()
+        duration = now - self._phases.pop(phase, now)
+        self.event(phase + '_end' if ok else phase + '_failed', duration_ns=duration, timestamp=now)
+        self.count(phase + '_completed' if ok else phase + '_failed')
+        if ok:
+            self.record(phase, duration)
+
+    # Per-operation hooks, FIFO matched like pipeline.RequestEngine
+
+    def write(self, size):
+        """
+        A write is about to be sent, returns its correlation ID.
+        A batched write waits for one result per task, they share the correlation ID.
+        """
+        now = self.clock()
+        correlation_id = next(self._ids)
+        self.outstanding.extend([(correlation_id, now)] * max(1, size // pipeline.TASK_SIZE))
+        self.event('write', correlation_id, timestamp=now)
+        self.count('writes')
+        self.count('bytes_written', size)
+        return correlation_id
+
+    def write_failed(self, correlation_id):
+        self.outstanding = deque(item for item in self.outstanding if item[0] != correlation_id)
+        self.count('write_failures')
+
+    def notification(self, size):
+        """A notification arrived, it answers the oldest outstanding tasks, one per result it carries."""
+        now = self.clock()
+        self.count('notifications')
+        self.count('bytes_notified', size)
+        if not self.outstanding:
+            self.event('notification', timestamp=now)
+            self.count('unsolicited_notifications')
+            return
+        correlation_id, sent = self.outstanding[0]
+        self.event('notification', correlation_id, now - sent, timestamp=now)
+        for _ in range(min(len(self.outstanding), max(1, size // pipeline.RESULT_SIZE))):
+            _, sent = self.outstanding.popleft()
+            self.record('round_trip', now - sent)
+
+    def reset(self, reason):
+        """
+        The outstanding tasks will not be answered in order, e.g. *reason* 'link_lost' or 'resend':
+        forget them, so later notifications are not matched to them. Writes sent again are traced again.
+        """
+        self.event(reason)
+        self.count(reason)
+        self.outstanding.clear()
+
+    def wrap_write(self, write):
+        """Traced version of a write coroutine function taking one buffer."""
+        async def traced_write(data):
+            correlation_id = self.write(len(data))
+            try:
+                return await write(data)
+            except BaseException:
+                self.write_failed(correlation_id)
+                raise
+        return traced_write
+
+    def wrap_notify(self, callback):
+        """Traced version of a notification callback."""
+        def traced_notify(sender, data):
+            self.notification(len(data))
+            callback(sender, data)
+        return traced_notify
+
+    # Export
+
+    def to_prometheus(self):
+        lines = []
+        for name in sorted(self.counters):
+            metric = f"{PREFIX}_{name}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {self.counters[name]}"]
+        for name in sorted(self.histograms):
+            histogram = self.histograms[name]
+            metric = f"{PREFIX}_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            # One bucket per power of two microseconds, exact because every HDR bucket lies inside one
+            rows = {}
+            for key, count in histogram.counts.items():
+                upper = 1 << key.bit_length()
+                rows[upper] = rows.get(upper, 0) + count
+            cumulative = 0
+            for upper in sorted(rows):
+                cumulative += rows[upper]
+                lines.append(f'{metric}_bucket{{le="{upper / 1e6:g}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f"{metric}_sum {histogram.total / 1e6:.6f}")
+            lines.append(f"{metric}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        return {
+            'counters': dict(self.counters),
+            'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+            'events': [{'timestamp_ns': timestamp - self.started, 'event': name,
+                        'correlation_id': correlation_id, 'duration_ns': duration}
+                       for timestamp, name, correlation_id, duration in self.events],
+        }
+
+    def write_csv(self, file):
+        writer = csv.writer(file)
+        writer.writerow(('timestamp_ns', 'event', 'correlation_id', 'duration_ns'))
+        for timestamp, name, correlation_id, duration in self.events:
+            writer.writerow((timestamp - self.started, name,
+                             '' if correlation_id is None else correlation_id,
+                             '' if duration is None else duration))
+
+    def export(self, path, format=None):
+        """
+        Write the collected data to *path*, the format defaults to the file extension.
+        The file is replaced atomically, as the Prometheus textfile collector expects.
+        """
+        format = format or FORMATS.get(os.path.splitext(path)[1], 'json')
+        temporary = path + '.tmp'
+        with open(temporary, 'w', newline='') as file:
+            if format == 'prometheus':
+                file.write(self.to_prometheus())
+            elif format == 'csv':
+                self.write_csv(file)
+            else:
+                json.dump(self.to_dict(), file, indent=1)
+        os.replace(temporary, path)
+
+    def print_summary(self, file=sys.stderr):
+        """Where the time went: connection phases and per-operation round trip."""
+        for name in PHASES + ('round_trip',):
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                continue
+            summary = histogram.summary()
+            print(f"{name:>10}: {summary['count']:>7} x  mean {summary['mean_us'] / 1000:9.2f} ms  "
+                  f"p99 {summary['p99_us'] / 1000:9.2f} ms  max {summary['max_us'] / 1000:9.2f} ms", file=file)
+
+
+def add_arguments(parser):
+    """Add the tracing command line options to an argparse parser."""
+    group = parser.add_argument_group("tracing")
+    group.add_argument("--trace", metavar="<file>",
+                       help="record timing of every phase and operation and export it to this file on exit")
+    group.add_argument("--trace-format", choices=sorted(set(FORMATS.values())),
+                       help="export format (default: from the file extension .prom/.csv/.json)")
+
+
+def from_args(args):
+    """Tracer selected on the command line, None if tracing is disabled."""
+    if not args.trace:
+        return None
+    return Tracer()